@@ -0,0 +1,161 @@
+import math
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import metrics
+from config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_ENTRIES, ANSWER_CACHE_THRESHOLD
+
+
+# Questions are compared as sparse vectors of character trigrams and whole words, hashed into a fixed
+# number of dimensions so vectors from any process line up. Words other than stop words weigh more than
+# trigrams, so "advantages" and "disadvantages" stay apart while "of" and "in" hardly matter. A near
+# duplicate must also have the same content words (all but stop words, numbers included): however high
+# the score, "how to reduce costs" and "how to increase costs" ask different things.
+NGRAM = 3
+DIMENSIONS = 1 << 20
+WORD_WEIGHT = 3
+STOP_WORDS = frozenset(
+    "a an and are as at be by can do does did for from how in is it its of on or s that the these this "
+    "those to was were what whats when where which who why with about into".split()
+)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# (scope, normalized question) -> (vector, content words, question, result), least recently used first.
+# A scope is (document hash, answer settings), so a changed document or setting never matches.
+_entries = OrderedDict()
+_scopes = {}  # scope -> set of normalized questions cached for it
+_lock = threading.Lock()
+_counters = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+
+
+#helper functions:
+
+
+def normalize(question):
+    """Case-folded words of a question, without punctuation or extra whitespace."""
+    return " ".join(WORD_PATTERN.findall(question.casefold()))
+
+
+def content_words(normalized):
+    """The words of a normalized question other than stop words."""
+    return frozenset(word for word in normalized.split() if word not in STOP_WORDS)
+
+
+def vectorize(normalized):
+    """Unit-length sparse vector {dimension: weight} of a normalized question."""
+    counts = {}
+    padded = f" {normalized} "
+    features = [(padded[i:i + NGRAM], 1) for i in range(len(padded) - NGRAM + 1)]
+    features += [(f"w:{word}", WORD_WEIGHT) for word in normalized.split() if word not in STOP_WORDS]
+    for feature, weight in features:
+        dimension = zlib.crc32(feature.encode("utf-8")) % DIMENSIONS
+        counts[dimension] = counts.get(dimension, 0) + weight
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {dimension: count / norm for dimension, count in counts.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(dimension, 0.0) for dimension, weight in a.items())
+
+
+def _remove(key):
+    del _entries[key]
+    questions = _scopes.get(key[0])
+    if questions is not None:
+        questions.discard(key[1])
+        if not questions:
+            del _scopes[key[0]]
+
+
+
+
+#cache access
+
+
+def lookup(scope, question):
+    """A cached result for this question or a near-duplicate of it, or None.
+
+    Questions with different content words ("chapter 1" and "chapter 2", "reduce" and "increase") never
+    match, however similar; a near-duplicate differs only in stop words, word order or punctuation.
+    Returns a copy of the stored result with "cached_question" set to the question it was cached for.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    normalized = normalize(question)
+
+    with _lock:
+        entry = _entries.get((scope, normalized))
+        if entry is not None:
+            _entries.move_to_end((scope, normalized))
+            _counters["exact_hits"] += 1
+            return dict(entry[3], cached_question=entry[2])
+
+    vector = vectorize(normalized)
+    words = content_words(normalized)
+    with _lock:
+        best_key, best_score = None, ANSWER_CACHE_THRESHOLD
+        for cached in _scopes.get(scope, ()):
+            cached_vector, cached_words, _, _ = _entries[(scope, cached)]
+            if cached_words != words:
+                continue
+            score = cosine(vector, cached_vector)
+            if score >= best_score:
+                best_key, best_score = (scope, cached), score
+        if best_key is None:
+            _counters["misses"] += 1
+            return None
+        _entries.move_to_end(best_key)
+        _counters["similar_hits"] += 1
+        entry = _entries[best_key]
+        return dict(entry[3], cached_question=entry[2])
+
+
+def store(scope, question, result):
+    """Cache a result (a JSON-like dict) for a question, evicting the least recently used beyond ANSWER_CACHE_ENTRIES."""
+    if not ANSWER_CACHE_ENABLED:
+        return
+    normalized = normalize(question)
+    entry = (vectorize(normalized), content_words(normalized), question, dict(result))
+    with _lock:
+        key = (scope, normalized)
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        _scopes.setdefault(scope, set()).add(normalized)
+        while len(_entries) > ANSWER_CACHE_ENTRIES:
+            _remove(next(iter(_entries)))
+
+
+def invalidate(doc_hash=None):
+    """Drop the cached answers of one document, or of every document."""
+    with _lock:
+        for key in [key for key in _entries if doc_hash is None or key[0][0] == doc_hash]:
+            _remove(key)
+
+
+def stats():
+    with _lock:
+        result = dict(_counters, entries=len(_entries), documents=len({scope[0] for scope in _scopes}))
+    lookups = result["exact_hits"] + result["similar_hits"] + result["misses"]
+    result["hit_rate"] = (result["exact_hits"] + result["similar_hits"]) / lookups if lookups else 0.0
+    return result
+
+
+def _collect_metrics():
+    with _lock:
+        counters = dict(_counters, entries=len(_entries))
+    return [
+        ("pdf_answer_cache_exact_hits_total", "counter", "Questions answered from the cache word for word",
+         counters["exact_hits"]),
+        ("pdf_answer_cache_similar_hits_total", "counter", "Questions answered from the cache by a similar question",
+         counters["similar_hits"]),
+        ("pdf_answer_cache_misses_total", "counter", "Questions the answer cache had nothing for", counters["misses"]),
+        ("pdf_answer_cache_entries", "gauge", "Answers held in the answer cache", counters["entries"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
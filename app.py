@@ -1,25 +1,75 @@
-from flask import Flask, render_template, jsonify, request, send_from_directory
-from summarizer_methods import get_summary, get_answers
+from flask import Flask, render_template, jsonify, request, send_from_directory, send_file, Response, stream_with_context, g
+from summarizer_methods import get_summary, get_outline, get_answers, iter_summary_events, iter_answer_events, MODEL
 import os
+import json
+import logging
+import re
+import time
+import uuid
 from werkzeug.utils import secure_filename
-import PyPDF2
-import traceback
+import answer_cache
+import batch
+import chunk_reuse
+import chunked_uploads
+import document_store
+import jobs
+import llm_cache
+import metrics
+import passage_index
+import rate_limiter
+import tracing
+import warmup
+from config import UPLOAD_FOLDER, JOB_WORKER_THREADS, PRECOMPUTE_SUMMARY_ON_UPLOAD, MAX_UPLOAD_MB, UPLOAD_PART_MB
+
+tracing.configure_logging()
+logger = logging.getLogger(__name__)
 
 # Change static folder to 'static' instead of '.'
 app = Flask(__name__, static_folder='static')
 
 # Configuration
-UPLOAD_FOLDER = 'uploaded_pdfs'
 ALLOWED_EXTENSIONS = {'pdf'}
+# Incoming X-Request-ID headers are reused as trace IDs when they look like one
+TRACE_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+# Questions are answered while the user waits, so their LLM calls go ahead of summaries
+INTERACTIVE_PATHS = {'/ask', '/ask_stream'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+# Bigger files go through the resumable /uploads endpoints, one part per request
+app.config['MAX_CONTENT_LENGTH'] = max(MAX_UPLOAD_MB, UPLOAD_PART_MB) * 1024 * 1024
 
 # Create upload folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Dictionary to store extracted text from PDFs
-pdf_texts = {}
+# Job workers normally run as separate processes (python jobs.py); these are for development
+if JOB_WORKER_THREADS:
+    jobs.start_worker_threads(JOB_WORKER_THREADS)
+
+@app.before_request
+def start_trace():
+    """Give every request a trace ID (the caller's X-Request-ID if it sent one) and start its timer"""
+    trace_id = request.headers.get('X-Request-ID', '')
+    tracing.set_trace_id(trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else None)
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def set_llm_priority():
+    """Schedule this request's LLM calls by its priority class and user (X-User-ID, else the client address)"""
+    priority = rate_limiter.INTERACTIVE if request.path in INTERACTIVE_PATHS else rate_limiter.BULK
+    rate_limiter.set_caller(priority, caller_id(request.headers.get('X-User-ID', ''), request.remote_addr))
+
+@app.after_request
+def finish_trace(response):
+    """Return the trace ID to the caller and record the request in the HTTP metrics"""
+    response.headers['X-Request-ID'] = tracing.get_trace_id()
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - g.get('request_started', time.perf_counter()), endpoint=endpoint)
+    return response
+
+def caller_id(user, remote_addr):
+    """Who a request is from (its X-User-ID header, else its address), for fair queuing of LLM calls"""
+    return user if TRACE_ID_PATTERN.fullmatch(user) else (remote_addr or '-')
 
 def normalize_filename(filename):
     return filename.replace(" ", "_")
@@ -27,27 +77,34 @@ def normalize_filename(filename):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf(file_path):
-    """Extract text content from a PDF file"""
-    text = ""
+def extract_text_from_pdf(file_path, filename, doc_hash=None):
+    """Move a received PDF into the document store, extracting, tokenizing and indexing it only the first time its content is seen"""
+    meta = document_store.add_document(file_path, filename, doc_hash=doc_hash, move=True)
+    if meta is None:
+        return None
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(pdf_reader.pages)):
-                page_text = pdf_reader.pages[page_num].extract_text()
-                if page_text:
-                    text += page_text + "\n"
+        document_store.load_tokens(meta['hash'], MODEL)
+        meta['text_filter'] = document_store.load_filter_report(meta['hash'], MODEL)
+        passage_index.load_index(meta['hash'], MODEL)
+    except Exception:
+        # Tokens and the passage index are rebuilt on first use if this fails
+        logger.exception("Error tokenizing document")
+    return meta
 
-        text_file_path = file_path + ".txt"
-        with open(text_file_path, "w", encoding="utf-8") as text_file:
-            text_file.write(text)
+def enqueue_summary(pdf_name, use_cache=True):
+    """Queue a summary job for the job workers, reusing one already queued or running for this document"""
+    doc_hash = document_store.get_hash(pdf_name)
+    return jobs.enqueue('summary', pdf_name, f"summary:{doc_hash}:{use_cache}", {'use_cache': use_cache, 'user': rate_limiter.current_user()})
 
-
-    except Exception as e:
-        print(f"Error extracting text from PDF: {e}")
-        print(traceback.format_exc())
-        return None
-    return text if text.strip() else "No extractable text found in the PDF."
+def stored_upload_response(meta):
+    """Build the upload response for a document that is now in the store"""
+    logger.info("Text extracted successfully: %d characters", meta['char_count'])
+    response = {'success': True, 'filename': meta['filename'], 'duplicate': meta['duplicate'],
+                'text_filter': meta.get('text_filter'), "message": "File successfully uploaded"}
+    # Summarize right away so the first "Generate" is served from the stored summary
+    if PRECOMPUTE_SUMMARY_ON_UPLOAD and not meta['duplicate']:
+        response['job_id'] = enqueue_summary(meta['filename'])['job_id']
+    return jsonify(response), 200
 
 @app.route('/')
 def index():
@@ -73,64 +130,46 @@ def test_post():
 def upload_pdf():
     """Handle PDF upload, extract text and store it"""
     try:
-        print("Upload request received")
+        logger.debug("Upload request received")
         if 'pdf_file' not in request.files:
-            print("No file part in request")
+            logger.info("No file part in request")
             return jsonify({'error': 'No file part'}), 400
             
         file = request.files['pdf_file']
-        print(f"File received: {file.filename}")
+        logger.info("File received: %s", file.filename)
             
         if file.filename == '':
-            print("Empty filename")
+            logger.info("Empty filename")
             return jsonify({'error': 'No selected file'}), 400
             
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             filename = normalize_filename(filename)  
-            print(f"Secured filename: {filename}")
-            
-            # Check upload directory
-            upload_dir = app.config['UPLOAD_FOLDER']
-            print(f"Upload directory: {os.path.abspath(upload_dir)}")
-            print(f"Directory exists: {os.path.exists(upload_dir)}")
-            print(f"Directory is writable: {os.access(upload_dir, os.W_OK)}")
+            logger.debug("Secured filename: %s", filename)
             
-            # Ensure directory exists
-            if not os.path.exists(upload_dir):
-                print(f"Creating upload directory: {upload_dir}")
-                os.makedirs(upload_dir, exist_ok=True)
-                
-            file_path = os.path.join(upload_dir, filename)
-            print(f"Target file path: {file_path}")
+            # Save into the upload staging folder; the store files it by content hash
+            upload_dir = chunked_uploads.UPLOADS_FOLDER
+            os.makedirs(upload_dir, exist_ok=True)
+            file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}.pdf")
+            logger.debug("Target file path: %s", file_path)
             
             # Save the file
             try:
                 file.save(file_path)
-                print(f"File saved successfully to {file_path}")
-                
-                # Check if file exists after saving
-                if os.path.exists(file_path):
-                    print(f"Verified file exists at: {file_path}")
-                    print(f"File size: {os.path.getsize(file_path)} bytes")
-                else:
-                    print(f"WARNING: File not found after save: {file_path}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("File saved to %s (%d bytes)", file_path, os.path.getsize(file_path))
                     
             except Exception as e:
-                print(f"Error saving file: {e}")
-                print(traceback.format_exc())
+                logger.exception("Error saving file")
                 return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
             
              # Extract text from PDF
-            print(f"Attempting to extract text from: {file_path}")
-            text = extract_text_from_pdf(file_path)
-            if text:
-                print(f"Text extracted successfully: {len(text)} characters")
-                # Store the text with the filename as key
-                pdf_texts[filename] = text
-                return jsonify({'success': True, 'filename': filename, "message": "File successfully uploaded"}), 200
+            logger.debug("Attempting to extract text from: %s", file_path)
+            meta = extract_text_from_pdf(file_path, filename)
+            if meta:
+                return stored_upload_response(meta)
             else:
-                print("Text extraction failed or returned empty text")
+                logger.warning("Text extraction failed or returned empty text")
                 return jsonify({'error': 'Failed to extract text from PDF or PDF has no extractable text'}), 500
 
             
@@ -139,10 +178,65 @@ def upload_pdf():
         return jsonify({'error': 'Invalid file type'}), 400
         
     except Exception as e:
-        print(f"Unexpected error in upload_pdf: {e}")
-        print(traceback.format_exc())
+        logger.exception("Unexpected error in upload_pdf")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
     
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    """Start a resumable upload; the file is then sent in parts with PUT /uploads/<upload_id>"""
+    data = request.json or {}
+    filename = data.get('filename') or ''
+    if not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+    try:
+        upload = chunked_uploads.create(normalize_filename(secure_filename(filename)), int(data.get('size') or 0))
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    upload['part_size'] = UPLOAD_PART_MB * 1024 * 1024
+    return jsonify(upload), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Report how many bytes of an upload have arrived, so an interrupted upload can resume"""
+    try:
+        upload = chunked_uploads.status(upload_id)
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload), 200
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_part(upload_id):
+    """Append the request body to an upload at ?offset=N, streaming it straight to disk"""
+    try:
+        offset = chunked_uploads.append(upload_id, request.args.get('offset', type=int, default=-1), request.stream)
+    except chunked_uploads.OffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'upload_id': upload_id, 'offset': offset}), 200
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """Finish an upload and extract it, unless the same content is already stored"""
+    try:
+        file_path, filename, doc_hash = chunked_uploads.complete(upload_id)
+    except chunked_uploads.OffsetMismatch as e:
+        return jsonify({'error': 'Upload is incomplete', 'offset': e.offset}), 409
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        meta = extract_text_from_pdf(file_path, filename, doc_hash=doc_hash)
+        if meta:
+            return stored_upload_response(meta)
+        logger.warning("Text extraction failed or returned empty text")
+        return jsonify({'error': 'Failed to extract text from PDF or PDF has no extractable text'}), 500
+    except Exception as e:
+        logger.exception("Unexpected error in complete_upload")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
 @app.route('/test_json', methods=['GET'])
 def test_json():
     return jsonify({'test': 'success'}), 200
@@ -155,25 +249,28 @@ def generate_summary():
         pdf_name = data.get('pdf_name')
         pdf_name = normalize_filename(pdf_name)  # Normalize spaces
     
-        print(f"Request received to generate summary for: {pdf_name}")
-        print(f"Current stored PDFs: {list(pdf_texts.keys())}")
+        logger.info("Request received to generate summary for: %s", pdf_name)
 
-        if not pdf_name or pdf_name not in pdf_texts:
+        if not pdf_name or not document_store.has_document(pdf_name):
             return jsonify({'error': 'PDF not found or not processed'}), 404
+
+        # "async": true queues the summary for the job workers and returns a job ID right away
+        if data.get('async'):
+            return jsonify(enqueue_summary(pdf_name, use_cache=not data.get('refresh'))), 202
             
         
         try:
             # Call the get_summary function from summarizer_methods.py
-            summary = get_summary(pdf_name)
-            return jsonify({'summary': summary}), 200
+            # "refresh": true bypasses the LLM response cache
+            summary = get_summary(pdf_name, use_cache=not data.get('refresh'))
+            # "outline" is the same summary as JSON, for clients that render it themselves
+            return jsonify({'summary': summary, 'outline': get_outline(pdf_name)}), 200
         except Exception as e:
-            print(f"Error generating summary: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error generating summary")
             return jsonify({'error': f'Failed to generate summary: {str(e)}'}), 500
             
     except Exception as e:
-        print(f"Unexpected error in generate_summary: {e}")
-        print(traceback.format_exc())
+        logger.exception("Unexpected error in generate_summary")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 @app.route('/ask', methods=['POST'])
@@ -182,9 +279,9 @@ def ask_question():
     try:
         data = request.json
         question = data.get('question')
-        pdf_name = data.get('pdf_name')
+        pdf_name = normalize_filename(data.get('pdf_name') or '')
             
-        if not pdf_name or pdf_name not in pdf_texts:
+        if not pdf_name or not document_store.has_document(pdf_name):
             return jsonify({'error': 'PDF not found or not processed'}), 404
             
         if not question:
@@ -193,19 +290,138 @@ def ask_question():
         
         try:
             # Call the get_answers function from summarizer_methods.py with the correct parameters
-            answer = get_answers(question,pdf_name)
-            return jsonify({'response': answer}), 200
+            result = get_answers(question,pdf_name, use_cache=not data.get('refresh'))
+            # "cached_question" is set when a same or similar earlier question's answer was reused
+            return jsonify({'response': result['answer'], 'pages': result['pages'],
+                            'cached_question': result.get('cached_question')}), 200
         except Exception as e:
-            print(f"Error generating answer: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error generating answer")
             return jsonify({'error': f'Failed to generate answer: {str(e)}'}), 500
             
     except Exception as e:
-        print(f"Unexpected error in ask_question: {e}")
-        print(traceback.format_exc())
+        logger.exception("Unexpected error in ask_question")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+@app.route('/batch', methods=['POST'])
+def start_batch():
+    """Queue a batch summary of a directory or manifest inside BATCH_FOLDER; progress is at /jobs/<job_id>"""
+    data = request.get_json(silent=True) or {}
+    source = batch.resolve_input(data.get('input') or '')
+    if source is None:
+        return jsonify({'error': 'Batch input not found in the batch folder'}), 404
+
+    # Jobs name their input relative to the batch folder
+    source = os.path.relpath(source, os.path.realpath(batch.BATCH_FOLDER))
+    use_cache = not data.get('refresh')
+    job = jobs.enqueue('batch', source, f"batch:{source}:{use_cache}",
+                       {'use_cache': use_cache, 'user': rate_limiter.current_user()})
+    return jsonify(dict(job, results=f"/batch/{job['job_id']}/results")), 202
+
+@app.route('/batch/<job_id>/results', methods=['GET'])
+def batch_results(job_id):
+    """Download the JSONL results a batch job has written so far"""
+    job = jobs.get_job(job_id, include_partial=False)
+    if job is None or job['kind'] != 'batch' or not os.path.exists(batch.result_path(job_id)):
+        return jsonify({'error': 'Batch results not found'}), 404
+    return send_file(batch.result_path(job_id), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report a summary job's status, progress, finished chunk outlines and result"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """Cancel a queued or running summary job"""
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
+def sse_event(event):
+    """Format one event dict as a Server-Sent Event"""
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+def sse_error(error):
+    return sse_event({'event': 'error', 'error': str(error)})
+
+# Tell proxies not to buffer the stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_response(events):
+    """Send an event generator to the browser as Server-Sent Events"""
+    def generate():
+        try:
+            for event in events:
+                yield sse_event(event)
+        except Exception as e:
+            logger.exception("Error while streaming")
+            yield sse_error(e)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/generate_stream', methods=['GET'])
+def generate_summary_stream():
+    """Stream the summary of a PDF chunk by chunk as Server-Sent Events"""
+    pdf_name = normalize_filename(request.args.get('pdf_name') or '')
+    logger.info("Request received to stream summary for: %s", pdf_name)
+
+    if not pdf_name or not document_store.has_document(pdf_name):
+        return jsonify({'error': 'PDF not found or not processed'}), 404
+
+    return sse_response(iter_summary_events(pdf_name, use_cache=not request.args.get('refresh')))
+
+@app.route('/ask_stream', methods=['GET'])
+def ask_question_stream():
+    """Stream the answer to a question about a PDF as Server-Sent Events"""
+    question = request.args.get('question')
+    pdf_name = normalize_filename(request.args.get('pdf_name') or '')
+
+    if not pdf_name or not document_store.has_document(pdf_name):
+        return jsonify({'error': 'PDF not found or not processed'}), 404
+
+    if not question:
+        return jsonify({'error': 'No question provided'}), 400
+
+    return sse_response(iter_answer_events(question, pdf_name, use_cache=not request.args.get('refresh')))
+
+@app.route('/llm_cache', methods=['GET'])
+def llm_cache_stats():
+    """Report LLM response cache hits, misses and size, and those of this process's answer cache and of chunk reuse"""
+    return jsonify(dict(llm_cache.stats(), answer_cache=answer_cache.stats(), chunk_reuse=chunk_reuse.stats())), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage timings, token usage, LLM calls and cache counters in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: 200 once the tokenizer and LLM client are loaded, 503 (starting the warm-up) until then"""
+    if warmup.is_ready():
+        return jsonify(warmup.status()), 200
+    warmup.start_background()
+    return jsonify(warmup.status()), 503
+
+@app.route('/llm_cache/clear', methods=['POST'])
+def llm_cache_clear():
+    """Invalidate every cached LLM response, and the answers and chunk results built from them"""
+    llm_cache.clear()
+    answer_cache.invalidate()
+    chunk_reuse.clear()
+    return jsonify({'success': True, 'message': 'LLM response cache cleared'}), 200
+
 if __name__ == '__main__':
-    print("Starting Flask app...")
-    print(f"Routes defined: {[f'{rule}, {rule.methods}' for rule in app.url_map.iter_rules()]}")
+    logger.info("Starting Flask app...")
+    logger.debug("Routes defined: %s", [f'{rule}, {rule.methods}' for rule in app.url_map.iter_rules()])
+    # Development server; in production run the async entry point: python asgi.py
+    warmup.start_background()
     app.run(debug=True)
\ No newline at end of file
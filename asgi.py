@@ -0,0 +1,242 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+
+import document_store
+import llm_clients
+import metrics
+import rate_limiter
+import summarizer_methods
+import tracing
+import warmup
+from app import app as flask_app, caller_id, normalize_filename, sse_event, sse_error, SSE_HEADERS, TRACE_ID_PATTERN
+from config import (SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_WSGI_THREADS, SERVER_KEEPALIVE,
+                    SERVER_SHUTDOWN_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+# Every other route runs the Flask app on a bounded thread pool
+wsgi_app = WSGIMiddleware(flask_app, workers=SERVER_WSGI_THREADS)
+
+# Request bodies of the async routes are small JSON documents
+MAX_BODY_BYTES = 1024 * 1024
+
+
+#helper functions:
+
+
+def json_response(payload, status=200):
+    return status, [(b"content-type", b"application/json")], json.dumps(payload).encode() + b"\n"
+
+
+def sse_stream(events):
+    """Status, headers and body pieces sending an async event generator as Server-Sent Events."""
+    async def body():
+        try:
+            async for event in events:
+                yield sse_event(event).encode()
+        except Exception as e:
+            logger.exception("Error while streaming")
+            yield sse_error(e).encode()
+
+    headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+    headers += [(name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()]
+    return 200, headers, body()
+
+
+async def read_body(receive):
+    """The whole request body, or None if it is larger than MAX_BODY_BYTES."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return bytes(body)
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_stream(send, receive, pieces):
+    """Send body pieces as they are produced; stops producing them when the client goes away."""
+    async def pump():
+        async for piece in pieces:
+            await send({"type": "http.response.body", "body": piece, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait([pump_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_task.cancel()
+        if not pump_task.done():
+            logger.info("Client disconnected, stream stopped")
+            pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+        await pieces.aclose()
+
+
+async def document_exists(pdf_name):
+    return bool(pdf_name) and await asyncio.to_thread(document_store.has_document, pdf_name)
+
+
+
+
+#async routes: answering waits on the LLM API, so these run on the event loop instead of a thread
+
+
+async def ask_question(query, body):
+    """Answer a question about a specific PDF"""
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return json_response({'error': 'Request body is not valid JSON'}, 400)
+    data = data if isinstance(data, dict) else {}
+    question = data.get('question')
+    pdf_name = normalize_filename(data.get('pdf_name') or '')
+
+    if not await document_exists(pdf_name):
+        return json_response({'error': 'PDF not found or not processed'}, 404)
+
+    if not question:
+        return json_response({'error': 'No question provided'}, 400)
+
+    try:
+        result = await summarizer_methods.get_answers_async(question, pdf_name, use_cache=not data.get('refresh'))
+        return json_response({'response': result['answer'], 'pages': result['pages'],
+                              'cached_question': result.get('cached_question')})
+    except Exception as e:
+        logger.exception("Error generating answer")
+        return json_response({'error': f'Failed to generate answer: {str(e)}'}, 500)
+
+
+async def ask_question_stream(query, body):
+    """Stream the answer to a question about a PDF as Server-Sent Events"""
+    question = query.get('question')
+    pdf_name = normalize_filename(query.get('pdf_name') or '')
+
+    if not await document_exists(pdf_name):
+        return json_response({'error': 'PDF not found or not processed'}, 404)
+
+    if not question:
+        return json_response({'error': 'No question provided'}, 400)
+
+    return sse_stream(summarizer_methods.iter_answer_events_async(question, pdf_name,
+                                                                  use_cache=not query.get('refresh')))
+
+
+ASYNC_ROUTES = {
+    ("POST", "/ask"): ask_question,
+    ("GET", "/ask_stream"): ask_question_stream,
+}
+
+
+
+
+#ASGI application
+
+
+async def handle_async_route(route, scope, receive, send):
+    """Run an async route with the same trace ID handling and HTTP metrics as the Flask routes."""
+    started = time.perf_counter()
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    trace_id = headers.get("x-request-id", "")
+    trace_id = tracing.set_trace_id(trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else None)
+    query = {name: values[0] for name, values in parse_qs(scope["query_string"].decode("latin-1")).items()}
+    client = scope.get("client")
+    rate_limiter.set_caller(rate_limiter.INTERACTIVE, caller_id(headers.get("x-user-id", ""), client[0] if client else None))
+
+    body = await read_body(receive)
+    if body is None:
+        status, response_headers, content = json_response({'error': 'Request body too large'}, 413)
+    else:
+        try:
+            status, response_headers, content = await route(query, body)
+        except Exception as e:
+            logger.exception("Unexpected error in %s", route.__name__)
+            status, response_headers, content = json_response({'error': f'Server error: {str(e)}'}, 500)
+
+    response_headers.append((b"x-request-id", trace_id.encode()))
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    metrics.HTTP_REQUESTS.inc(endpoint=scope["path"], method=scope["method"], status=status)
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=scope["path"])
+
+    if isinstance(content, bytes):
+        await send({"type": "http.response.body", "body": content})
+    else:
+        await send_stream(send, receive, content)
+
+
+async def startup():
+    """Warm up before uvicorn accepts connections, so no request pays for loading the tokenizer or client."""
+    await llm_clients.start()
+    await asyncio.to_thread(warmup.warm_up)
+    logger.info("Server started")
+
+
+async def shutdown():
+    """Release the LLM clients after uvicorn has let in-flight requests finish."""
+    await llm_clients.close()
+    summarizer_methods.llm_pool.shutdown(wait=False, cancel_futures=True)
+    llm_clients.close_client()
+    logger.info("Server stopped")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                logger.exception("Server startup failed")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI entry point: /ask and /ask_stream run on the event loop, every other route on the Flask app."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] == "http":
+        route = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if route is not None:
+            await handle_async_route(route, scope, receive, send)
+            return
+    await wsgi_app(scope, receive, send)
+
+
+def main():
+    uvicorn.run(
+        "asgi:application",
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=SERVER_WORKERS,
+        lifespan="on",
+        timeout_keep_alive=SERVER_KEEPALIVE,
+        timeout_graceful_shutdown=SERVER_SHUTDOWN_TIMEOUT,
+        # Keep the trace ID log format set up by the app
+        log_config=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
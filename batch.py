@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from werkzeug.utils import secure_filename
+
+import metrics
+import tracing
+from config import BATCH_CONCURRENCY, BATCH_FOLDER
+from summarizer_methods import summarize_pdf, get_outline
+
+
+# Results of /batch jobs are written here, one JSONL file per job
+RESULTS_FOLDER = os.path.join(BATCH_FOLDER, "results")
+
+# Progress is reported (and jobs heartbeat) at least this often, in seconds, even while no document finishes
+PROGRESS_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+#helper functions:
+
+
+def find_inputs(source):
+    """Absolute paths of the PDFs of a batch: every PDF under a directory, or those listed in a manifest.
+
+    A manifest lists one path per line, relative to the manifest's folder (blank lines and # comments
+    are skipped), or one JSON object with a "path" per line.
+    """
+    if os.path.isdir(source):
+        paths = []
+        for folder, _, names in os.walk(source):
+            paths.extend(os.path.join(folder, name) for name in names if name.lower().endswith(".pdf"))
+        return sorted(os.path.abspath(path) for path in paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            paths.append(os.path.abspath(os.path.join(base, path)))
+    return paths
+
+
+def resolve_input(name):
+    """The directory or manifest `name` refers to inside BATCH_FOLDER, or None if there is none."""
+    root = os.path.realpath(BATCH_FOLDER)
+    path = os.path.realpath(os.path.join(root, name))
+    if not name or path == root or os.path.commonpath([root, path]) != root or not os.path.exists(path):
+        return None
+    return path
+
+
+def result_path(job_id):
+    return os.path.join(RESULTS_FOLDER, f"{job_id}.jsonl")
+
+
+def load_checkpoint(output):
+    """Paths an earlier run over the same output file already summarized."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line of an interrupted run may be cut short
+                continue
+            if record.get("status") == "done":
+                done.add(record["path"])
+    return done
+
+
+def tokens_used():
+    """Prompt and completion tokens this process's LLM calls have reported so far."""
+    return metrics.LLM_TOKENS.value(type="prompt") + metrics.LLM_TOKENS.value(type="completion")
+
+
+def throughput(documents, tokens, seconds):
+    minutes = max(seconds, 1e-9) / 60
+    return {"documents_per_minute": round(documents / minutes, 2), "tokens_per_minute": round(tokens / minutes)}
+
+
+
+
+#batch run
+
+
+def summarize_document(path, use_cache=True):
+    """Store and summarize one PDF; returns its result record, with "status" "done" or "failed"."""
+    started = time.perf_counter()
+    record = {"path": path}
+    try:
+        name = secure_filename(os.path.basename(path)).replace(" ", "_") or "document.pdf"
+        # LLM calls for the document start while its pages are still being extracted
+        meta, summary = summarize_pdf(path, name, use_cache)
+        if meta is None:
+            raise ValueError("Failed to extract text from PDF")
+        record.update(pdf_name=meta["filename"], hash=meta["hash"], pages=meta["page_count"])
+        record.update(status="done", summary=summary, outline=get_outline(meta["filename"]))
+    except Exception as e:
+        logger.exception("Failed to summarize %s", path)
+        record.update(status="failed", error=str(e))
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(paths, output, concurrency=BATCH_CONCURRENCY, use_cache=True, on_progress=None):
+    """Summarize many PDFs into `output`, one JSON line per document, `concurrency` documents at a time.
+
+    Documents are pipelined: some are extracted while others wait on the LLM, whose calls stay bounded
+    by the shared LLM pool and rate limits. Documents already recorded as done in `output` are skipped,
+    so rerunning an interrupted batch resumes it; failed ones are tried again. on_progress(done, total)
+    is called as documents finish. Returns the counts and throughput of this run.
+    """
+    done_paths = load_checkpoint(output)
+    pending = [path for path in paths if path not in done_paths]
+    total = len(pending)
+    stats = {"documents": len(paths), "skipped": len(paths) - total, "done": 0, "failed": 0}
+    logger.info("Batch of %d documents, %d already done, %d at a time", len(paths), stats["skipped"], concurrency)
+
+    started = time.perf_counter()
+    tokens_before = tokens_used()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "a+", encoding="utf-8") as file, \
+            ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch") as pool:
+        # Start on a new line if an interrupted run left half of one
+        file.seek(0, os.SEEK_END)
+        if file.tell():
+            file.seek(file.tell() - 1)
+            if file.read(1) != "\n":
+                file.write("\n")
+
+        remaining = {pool.submit(tracing.carry(summarize_document), path, use_cache) for path in pending}
+        try:
+            while remaining:
+                finished, remaining = wait(remaining, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    file.write(json.dumps(record) + "\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+                    stats[record["status"]] += 1
+
+                processed = stats["done"] + stats["failed"]
+                elapsed = time.perf_counter() - started
+                rates = throughput(processed, tokens_used() - tokens_before, elapsed)
+                logger.info("%d/%d documents (%d failed), %.1f documents/min, %d tokens/min",
+                            processed, total, stats["failed"], rates["documents_per_minute"], rates["tokens_per_minute"])
+                if on_progress is not None:
+                    on_progress(processed, total)
+        except BaseException:
+            # Documents not started yet are dropped; those in progress finish before the pool closes
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    elapsed = time.perf_counter() - started
+    tokens = tokens_used() - tokens_before
+    stats.update(seconds=round(elapsed, 3), tokens=tokens, output=output,
+                 **throughput(stats["done"] + stats["failed"], tokens, elapsed))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize every PDF of a directory or manifest into a JSONL file.")
+    parser.add_argument("input", help="directory of PDFs, or a manifest with one PDF path per line")
+    parser.add_argument("--output", default="summaries.jsonl",
+                        help="JSONL results file; running again with the same file resumes the batch")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="documents in progress at once")
+    parser.add_argument("--refresh", action="store_true", help="regenerate summaries that are already stored")
+    args = parser.parse_args()
+    tracing.configure_logging()
+    tracing.set_trace_id()
+
+    stats = run_batch(find_inputs(args.input), args.output, args.concurrency, use_cache=not args.refresh)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Rough token estimate; good enough for latency modelling and traffic accounting
+CHARS_PER_TOKEN = 4
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI chat completions API with configurable latency and rate limits.
+
+    latency: fixed seconds per request; latency_per_token: extra seconds per completion token;
+    rpm: requests per minute before 429s are returned (0 for unlimited);
+    completion_tokens: approximate length of every response.
+    """
+    daemon_threads = True
+    # Async clients open hundreds of connections at once; the default backlog of 5 refuses most of them
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.5, latency_per_token=0.002, jitter=0.1, rpm=0,
+                 completion_tokens=300, seed=0):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.jitter = jitter
+        self.rpm = rpm
+        self.completion_tokens = completion_tokens
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent_requests = deque()
+        self.stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0, "in_flight": 0,
+                      "max_in_flight": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def admit(self):
+        """Return 0 if the request may proceed, otherwise the seconds to wait (for Retry-After)."""
+        with self.lock:
+            now = time.monotonic()
+            while self.recent_requests and now - self.recent_requests[0] > 60:
+                self.recent_requests.popleft()
+            if self.rpm and len(self.recent_requests) >= self.rpm:
+                self.stats["rate_limited"] += 1
+                return 60 - (now - self.recent_requests[0])
+            self.recent_requests.append(now)
+            self.stats["requests"] += 1
+            return 0
+
+    def record(self, name, amount):
+        with self.lock:
+            self.stats[name] += amount
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def make_reply(self, prompt):
+        """A plausible outline built from words of the prompt, about completion_tokens long."""
+        words = re.findall(r"[A-Za-z]{4,}", prompt.split("TEXT TO ANALYZE:")[-1]) or ["content"]
+        lines = []
+        length = 0
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        while length < self.completion_tokens * CHARS_PER_TOKEN:
+            if not lines or rng.random() < 0.1:
+                line = f"## {rng.choice(words).capitalize()} {rng.choice(words)}"
+            elif rng.random() < 0.25:
+                line = f"### {rng.choice(words).capitalize()}"
+            else:
+                line = "- " + " ".join(rng.choice(words) for _ in range(8))
+            lines.append(line)
+            length += len(line) + 1
+        return "\n".join(lines)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.snapshot())
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+
+        server = self.server
+        retry_after = server.admit()
+        if retry_after:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                           {"Retry-After": f"{retry_after:.2f}"})
+            return
+
+        prompt = "\n".join(message.get("content") or "" for message in request.get("messages", []))
+        reply = server.make_reply(prompt)
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        completion_tokens = min(len(reply) // CHARS_PER_TOKEN, request.get("max_tokens") or 10 ** 9)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        server.record("prompt_tokens", prompt_tokens)
+        server.record("completion_tokens", completion_tokens)
+
+        server.record("in_flight", 1)
+        try:
+            delay = server.latency * (1 + server.random.uniform(-server.jitter, server.jitter))
+            if request.get("stream"):
+                self.stream_reply(request, reply, usage, delay, server.latency_per_token * completion_tokens)
+            else:
+                time.sleep(delay + server.latency_per_token * completion_tokens)
+                self.send_json(200, {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+        finally:
+            server.record("in_flight", -1)
+
+    def stream_reply(self, request, reply, usage, first_token_delay, generation_time):
+        """Send the reply as server-sent chunks, spreading generation time across them."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data):
+            payload = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        time.sleep(first_token_delay)
+        pieces = re.findall(r"\S+\s*", reply)
+        for piece in pieces:
+            time.sleep(generation_time / max(len(pieces), 1))
+            send(json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send(json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [],
+                "usage": usage,
+            }))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """Start the fake server on a background thread and return it."""
+    server = FakeOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake OpenAI chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--latency-per-token", type=float, default=0.002)
+    parser.add_argument("--rpm", type=int, default=0)
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer((args.host, args.port), latency=args.latency,
+                              latency_per_token=args.latency_per_token, rpm=args.rpm,
+                              completion_tokens=args.completion_tokens)
+    print(f"Fake OpenAI server listening on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+
+# Entry points a worker imports before it can serve; each is timed in a fresh interpreter
+MODULES = ("app", "asgi", "jobs", "batch")
+
+# Loaded on first use or by the warm-up, never by importing an entry point
+LAZY_MODULES = ("openai", "httpx", "tiktoken", "PyPDF2")
+
+# Runs in the child: import the module, then report how long that took and what it loaded
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter() - started
+result = {{"seconds": imported, "loaded": [name for name in {lazy!r} if name in sys.modules]}}
+if {warm_up!r}:
+    import warmup
+    started = time.perf_counter()
+    result["warm_up"] = dict(warmup.warm_up(), seconds=time.perf_counter() - started)
+print("IMPORT_BUDGET " + json.dumps(result))
+"""
+
+
+#helper functions:
+
+
+def slowest_imports(importtime_output, count):
+    """The `count` modules with the most self time in `python -X importtime` output, as (name, ms)."""
+    rows = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.strip(), int(self_us) / 1000))
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:count]
+
+
+def measure(module, warm_up, upload_folder):
+    env = dict(os.environ, UPLOAD_FOLDER=upload_folder, LOG_LEVEL="WARNING")
+    code = CHILD.format(module=module, lazy=LAZY_MODULES, warm_up=warm_up)
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_FOLDER, env=env,
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    line = next(line for line in completed.stdout.splitlines() if line.startswith("IMPORT_BUDGET "))
+    result = json.loads(line[len("IMPORT_BUDGET "):])
+    result["slowest"] = slowest_imports(completed.stderr, 5)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that importing the app's entry points stays fast and lazy.")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="modules to import (default: every entry point)")
+    parser.add_argument("--budget-ms", type=float, default=400, help="most milliseconds an import may take")
+    parser.add_argument("--warm-up", action="store_true", help="also time the warm-up after importing")
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as upload_folder:
+        for module in args.modules:
+            result = measure(module, args.warm_up, upload_folder)
+            milliseconds = result["seconds"] * 1000
+            print(f"{module}: {milliseconds:.0f} ms (budget {args.budget_ms:.0f} ms)")
+            print("  slowest: " + ", ".join(f"{name} {ms:.1f} ms" for name, ms in result["slowest"]))
+            if "warm_up" in result:
+                print(f"  warm-up: {result['warm_up']['seconds'] * 1000:.0f} ms {result['warm_up']['steps']}")
+            if milliseconds > args.budget_ms:
+                failures.append(f"import {module} took {milliseconds:.0f} ms")
+            if result["loaded"]:
+                failures.append(f"import {module} loaded {', '.join(result['loaded'])}")
+            if "warm_up" in result and not result["warm_up"]["ready"]:
+                failures.append(f"warm-up after import {module} failed: {result['warm_up']['error']}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
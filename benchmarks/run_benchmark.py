@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, BENCHMARKS_FOLDER)
+
+import fake_openai_server
+import synthetic_pdf
+
+RESULTS_FOLDER = os.path.join(BENCHMARKS_FOLDER, "results")
+
+# Slowdowns smaller than this are timer noise, not regressions
+MIN_REGRESSION_SECONDS = 0.005
+
+# (module, function) pairs timed as pipeline stages; looked up at call time, so wrapping the
+# module attribute catches every caller
+STAGES = {
+    "extract": ("document_store", "add_document"),
+    "tokenize": ("document_store", "load_tokens"),
+    "index": ("passage_index", "build_index"),
+    "chunk": ("chunking", "plan_document"),
+    "llm_call": ("summarizer_methods", "process_prompt"),
+    "organize": ("summarizer_methods", "build_outline"),
+}
+
+
+class Recorder:
+    """Thread-safe collection of durations per stage, plus token counts of the prompts sent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.prompt_tokens = 0
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+
+    def add_tokens(self, count):
+        with self.lock:
+            self.prompt_tokens += count
+
+    def reset(self):
+        with self.lock:
+            self.durations = {}
+            self.prompt_tokens = 0
+
+
+recorder = Recorder()
+
+
+#helper functions:
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize_durations(values):
+    return {
+        "count": len(values),
+        "total": round(sum(values), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 0.50), 4),
+        "p95": round(percentile(values, 0.95), 4),
+        "p99": round(percentile(values, 0.99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def instrument(modules):
+    """Replace every stage function with a wrapper that records its duration."""
+    for stage, (module_name, function_name) in STAGES.items():
+        module = modules[module_name]
+        original = getattr(module, function_name)
+
+        def timed(*args, _stage=stage, _original=original, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                recorder.add(_stage, time.perf_counter() - started)
+
+        setattr(module, function_name, timed)
+
+    # Count the exact prompt tokens sent, outside the timed call
+    summarizer_methods = modules["summarizer_methods"]
+    timed_process_prompt = summarizer_methods.process_prompt
+
+    def counting_process_prompt(prompt=None, *args, **kwargs):
+        response = timed_process_prompt(prompt, *args, **kwargs)
+        recorder.add_tokens(summarizer_methods.count_tokens(summarizer_methods.SYSTEM_MESSAGE + (prompt or "")))
+        return response
+
+    summarizer_methods.process_prompt = counting_process_prompt
+
+
+def timed_request(client, route, method, **kwargs):
+    started = time.perf_counter()
+    response = getattr(client, method)(route, **kwargs)
+    recorder.add(f"route {route}", time.perf_counter() - started)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{method.upper()} {route} failed with {response.status_code}: {response.get_data(as_text=True)}")
+    return response.get_json()
+
+
+def current_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_FOLDER, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_questions(count, seed):
+    rng = random.Random(seed)
+    return [
+        f"What does the document say about {rng.choice(synthetic_pdf.WORDS)} and {rng.choice(synthetic_pdf.WORDS)}?"
+        for _ in range(count)
+    ]
+
+
+
+
+#benchmark run
+
+
+def run_document(app, server, work_folder, args, page_count):
+    """Upload, summarize twice (fresh, then stored) and question one synthetic document."""
+    recorder.reset()
+    stats_before = server.snapshot()
+    path = synthetic_pdf.make_document(os.path.join(work_folder, f"synthetic-{page_count}.pdf"), page_count,
+                                       args.words_per_page, args.seed)
+    client = app.test_client()
+    timings = {}
+
+    started = time.perf_counter()
+    with open(path, "rb") as file:
+        uploaded = timed_request(client, "/upload_pdf", "post",
+                                 data={"pdf_file": (file, os.path.basename(path))},
+                                 content_type="multipart/form-data")
+    timings["upload"] = time.perf_counter() - started
+    pdf_name = uploaded["filename"]
+
+    started = time.perf_counter()
+    timed_request(client, "/generate", "post", json={"pdf_name": pdf_name})
+    timings["generate"] = time.perf_counter() - started
+
+    # Second request is served from the stored summary
+    started = time.perf_counter()
+    client.post("/generate", json={"pdf_name": pdf_name})
+    timings["generate_stored"] = time.perf_counter() - started
+
+    questions = make_questions(args.questions, args.seed + page_count)
+
+    def ask(question):
+        return timed_request(app.test_client(), "/ask", "post", json={"question": question, "pdf_name": pdf_name})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        list(pool.map(ask, questions))
+    timings["ask_all"] = time.perf_counter() - started
+
+    stats_after = server.snapshot()
+    server_stats = {name: stats_after[name] - stats_before[name]
+                    for name in ("requests", "rate_limited", "prompt_tokens", "completion_tokens")}
+    with recorder.lock:
+        durations = {name: list(values) for name, values in recorder.durations.items()}
+        prompt_tokens = recorder.prompt_tokens
+
+    return {
+        "pages": page_count,
+        "wall_seconds": {name: round(seconds, 4) for name, seconds in timings.items()},
+        "stages": {name: summarize_durations(values) for name, values in sorted(durations.items())},
+        "throughput": {
+            "upload_pages_per_second": round(page_count / timings["upload"], 2),
+            "generate_pages_per_second": round(page_count / timings["generate"], 2),
+            "questions_per_second": round(len(questions) / timings["ask_all"], 2),
+        },
+        "tokens": {
+            "prompt_tokens_sent": prompt_tokens,
+            "llm_calls": len(durations.get("llm_call", [])),
+            "server": server_stats,
+        },
+    }
+
+
+def compare(result, baseline, tolerance):
+    """List regressions of p50 latencies and wall times beyond `tolerance` (a fraction) against a baseline run."""
+    regressions = []
+    baseline_runs = {run["pages"]: run for run in baseline["runs"]}
+    for run in result["runs"]:
+        old = baseline_runs.get(run["pages"])
+        if old is None:
+            continue
+        pairs = [(f"wall {name}", seconds, old["wall_seconds"].get(name))
+                 for name, seconds in run["wall_seconds"].items()]
+        pairs += [(f"{name} p50", stage["p50"], old["stages"].get(name, {}).get("p50"))
+                  for name, stage in run["stages"].items()]
+        for name, new_value, old_value in pairs:
+            if old_value and new_value > old_value * (1 + tolerance) and new_value - old_value > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{run['pages']} pages, {name}: {old_value:.4f}s -> {new_value:.4f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark upload -> generate -> ask against a fake OpenAI server.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50], help="page counts of the synthetic PDFs")
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--questions", type=int, default=20, help="questions asked per document")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent /ask clients")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake API seconds per request")
+    parser.add_argument("--latency-per-token", type=float, default=0.0005, help="fake API seconds per completion token")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="length of fake API responses")
+    parser.add_argument("--rpm", type=int, default=0, help="fake API requests per minute before 429s (0: unlimited)")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM response, answer and chunk result caches and request coalescing enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="baseline result file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the app's log output")
+    args = parser.parse_args()
+
+    server = fake_openai_server.start_server(latency=args.latency, latency_per_token=args.latency_per_token,
+                                             rpm=args.rpm, completion_tokens=args.completion_tokens, seed=args.seed)
+    work_folder = tempfile.mkdtemp(prefix="pdf-summarizer-bench-")
+
+    # Configuration is read at import time, so the environment is set before the app is imported
+    os.environ.update({
+        "UPLOAD_FOLDER": os.path.join(work_folder, "uploaded_pdfs"),
+        "OPENAI_BASE_URL": server.base_url,
+        "API_KEY": "benchmark",
+        "LLM_CACHE_ENABLED": "1" if args.cache else "0",
+        "ANSWER_CACHE_ENABLED": "1" if args.cache else "0",
+        "CHUNK_REUSE_ENABLED": "1" if args.cache else "0",
+        "SINGLE_FLIGHT_ENABLED": "1" if args.cache else "0",
+        "JOB_WORKER_THREADS": "0",
+        "PRECOMPUTE_SUMMARY_ON_UPLOAD": "0",
+        "LOG_LEVEL": "INFO" if args.verbose else "WARNING",
+    })
+    import app as app_module
+    instrument({name: sys.modules[name] for name in ("chunking", "document_store", "passage_index", "summarizer_methods")})
+
+    result = {
+        "version": current_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {name: value for name, value in vars(args).items() if name not in ("output", "compare", "verbose")},
+        "runs": [],
+    }
+    for page_count in args.pages:
+        run = run_document(app_module.app, server, work_folder, args, page_count)
+        result["runs"].append(run)
+        print(f"{page_count} pages: upload {run['wall_seconds']['upload']:.2f}s, "
+              f"generate {run['wall_seconds']['generate']:.2f}s "
+              f"(stored {run['wall_seconds']['generate_stored']:.3f}s), "
+              f"ask p50 {run['stages']['route /ask']['p50']:.3f}s p95 {run['stages']['route /ask']['p95']:.3f}s, "
+              f"{run['tokens']['llm_calls']} LLM calls, {run['tokens']['prompt_tokens_sent']} prompt tokens")
+
+    output_path = args.output or os.path.join(RESULTS_FOLDER, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['version']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+    print(f"Results written to {output_path}")
+
+    server.shutdown()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
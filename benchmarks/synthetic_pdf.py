@@ -0,0 +1,108 @@
+import argparse
+import random
+
+
+# Vocabulary for filler text; headings and topic words repeat so retrieval has something to find
+WORDS = (
+    "system process data model analysis method result value structure function network memory "
+    "energy signal control theory design measure sample error rate layer cell protein market "
+    "policy history language logic algorithm graph matrix vector probability distribution"
+).split()
+
+LINE_CHARS = 90
+LINES_PER_PAGE = 55
+
+
+#helper functions:
+
+
+def _escape(line):
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _wrap(text):
+    lines = []
+    current = ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > LINE_CHARS:
+            lines.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        lines.append(current)
+    return lines
+
+
+def page_text(rng, page_number, words_per_page):
+    """One page of pseudo-academic text: a section heading every few pages, then paragraphs."""
+    parts = []
+    if page_number % 5 == 1:
+        topic = " ".join(rng.choice(WORDS).capitalize() for _ in range(3))
+        parts.append(f"Chapter {page_number // 5 + 1}: {topic}")
+    words = [rng.choice(WORDS) for _ in range(words_per_page)]
+    for start in range(0, len(words), 80):
+        sentence = " ".join(words[start:start + 80])
+        parts.append(sentence.capitalize() + ".")
+    parts.append(str(page_number))
+    return parts
+
+
+
+
+#pdf writing
+
+
+def write_pdf(path, pages):
+    """Write a minimal text-only PDF with one page per list of paragraphs."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for paragraphs in pages:
+        lines = [line for paragraph in paragraphs for line in _wrap(paragraph)][:LINES_PER_PAGE]
+        operations = "BT /F1 9 Tf 40 760 Td 13 TL " + " ".join(f"({_escape(line)}) '" for line in lines) + " ET"
+        content = operations.encode("latin-1", "replace")
+        page_number = len(objects) + 1
+        kids.append(page_number)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_number + 1} 0 R >>".encode()
+        )
+        objects.append(f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(file.tell())
+            file.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+        xref = file.tell()
+        file.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            file.write(f"{offset:010d} 00000 n \n".encode())
+        file.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def make_document(path, page_count, words_per_page=450, seed=0):
+    """Write a deterministic synthetic PDF of `page_count` pages."""
+    rng = random.Random(seed * 100003 + page_count)
+    write_pdf(path, [page_text(rng, page_number, words_per_page) for page_number in range(1, page_count + 1)])
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic PDF for benchmarks.")
+    parser.add_argument("path")
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_document(args.path, args.pages, args.words_per_page, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import metrics
+from config import UPLOAD_FOLDER, CHUNK_REUSE_ENABLED, CHUNK_REUSE_THRESHOLD, CHUNK_REUSE_ENTRIES
+
+
+# What the LLM made of every chunk it was sent, shared by every worker process, so that the chunks a new
+# upload shares with an earlier document (a lightly edited revision, say) are not sent again
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, ".cache")
+REUSE_DB = os.path.join(CACHE_FOLDER, "chunk_results.sqlite3")
+
+# Only a chunk with the same text reuses a result: an outline says what its chunk says, so a chunk an
+# edit touched, however little, is always sent again. To tell how much of a revision changed, chunks are
+# also compared as sets of overlapping SHINGLE_WORDS-word shingles: a stored chunk keeps a bottom-k
+# MinHash sketch of its set (the SKETCH_SIZE smallest shingle hashes), and a chunk that is sent although
+# a stored one is at least CHUNK_REUSE_THRESHOLD similar to it is counted as changed rather than new.
+SHINGLE_WORDS = 5
+SKETCH_SIZE = 128
+
+# The stored chunks sharing most sketch hashes with a changed chunk that are looked at
+CANDIDATES = 8
+
+# Trim the table every this many writes
+TRIM_INTERVAL = 100
+
+WORD_PATTERN = re.compile(r"\w+")
+
+_lock = threading.Lock()
+_local = threading.local()
+_counters = {"hits": 0, "changed": 0, "misses": 0, "writes": 0}
+
+
+#helper functions:
+
+
+def shingle_hash(shingle):
+    # 63 bits, so every hash fits an SQLite INTEGER
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") >> 1
+
+
+def fingerprint(text):
+    """Fingerprint of a chunk's text.
+
+    "exact" is a hash of the text ignoring differences in whitespace; "sketch" holds the smallest
+    SKETCH_SIZE hashes of its shingles (case and punctuation ignored), sorted.
+    """
+    words = WORD_PATTERN.findall(text.casefold())
+    shingles = {shingle_hash(" ".join(words[i:i + SHINGLE_WORDS]))
+                for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    return {
+        "exact": hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest(),
+        "sketch": sorted(heapq.nsmallest(SKETCH_SIZE, shingles)),
+    }
+
+
+def scope_id(scope):
+    """Short key of what a result depends on besides the chunk (model, prompt version, ...)."""
+    return hashlib.sha256(json.dumps(scope, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def _connection():
+    """One SQLite connection per thread."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(REUSE_DB, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY, scope TEXT NOT NULL, exact TEXT NOT NULL, sketch TEXT NOT NULL, "
+            "result TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, UNIQUE (scope, exact))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS chunks_accessed ON chunks (accessed)")
+        # One row per hash in a chunk's sketch, to find the stored chunks sharing shingles with a changed one
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sketch_hashes (scope TEXT NOT NULL, hash INTEGER NOT NULL, chunk INTEGER NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS sketch_hashes_hash ON sketch_hashes (scope, hash)")
+        connection.execute("CREATE INDEX IF NOT EXISTS sketch_hashes_chunk ON sketch_hashes (chunk)")
+        _local.connection = connection
+    return connection
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def similarity(sketch, other):
+    """Estimated Jaccard similarity of two chunks' shingle sets from their bottom-k sketches."""
+    union = heapq.nsmallest(SKETCH_SIZE, set(sketch) | set(other))
+    if not union:
+        return 0.0
+    both = set(sketch) & set(other)
+    return sum(value in both for value in union) / len(union)
+
+
+def _is_changed(connection, scope, chunk_fingerprint):
+    """Whether a stored chunk is at least CHUNK_REUSE_THRESHOLD similar to a chunk, i.e. the chunk is an edited version of it."""
+    sketch = chunk_fingerprint["sketch"]
+    if not sketch:
+        return False
+    rows = connection.execute(
+        "SELECT chunks.sketch FROM chunks JOIN ("
+        "SELECT chunk, COUNT(*) AS shared FROM sketch_hashes WHERE scope = ? AND hash IN (" + ",".join("?" * len(sketch)) + ") "
+        "GROUP BY chunk ORDER BY shared DESC LIMIT ?) AS candidates ON chunks.id = candidates.chunk",
+        (scope, *sketch, CANDIDATES),
+    ).fetchall()
+    return any(similarity(sketch, json.loads(row[0])) >= CHUNK_REUSE_THRESHOLD for row in rows)
+
+
+def _match(connection, scope, chunk_fingerprint):
+    """Result stored for a chunk with the same text, or None."""
+    row = connection.execute("SELECT id, result FROM chunks WHERE scope = ? AND exact = ?",
+                             (scope, chunk_fingerprint["exact"])).fetchone()
+    if row is None:
+        _count("changed" if _is_changed(connection, scope, chunk_fingerprint) else "misses")
+        return None
+    _count("hits")
+    with connection:
+        connection.execute("UPDATE chunks SET accessed = ? WHERE id = ?", (time.time(), row[0]))
+    return row[1]
+
+
+
+
+#reuse
+
+
+def match_chunks(scope, chunks, lookup=True):
+    """Yield (chunk, fingerprint, reused result or None) for chunks ({"text", ...} dicts) in document order.
+
+    `scope` (JSON-like) is what a result depends on besides the chunk; only a result stored for the
+    same text with an equal scope is reused, every other chunk is sent. `chunks` may be a generator.
+    With lookup=False nothing is reused; pass the fingerprints on to store().
+    """
+    if not CHUNK_REUSE_ENABLED:
+        for chunk in chunks:
+            yield chunk, None, None
+        return
+    if not lookup:
+        for chunk in chunks:
+            yield chunk, fingerprint(chunk["text"]), None
+        return
+
+    scope = scope_id(scope)
+    connection = _connection()
+    for chunk in chunks:
+        chunk_fingerprint = fingerprint(chunk["text"])
+        yield chunk, chunk_fingerprint, _match(connection, scope, chunk_fingerprint)
+
+
+def store(scope, chunk_fingerprint, result):
+    """Keep the result the LLM gave for a chunk, replacing an earlier one for the same text and scope."""
+    if not CHUNK_REUSE_ENABLED or chunk_fingerprint is None or not result:
+        return
+    scope = scope_id(scope)
+    now = time.time()
+    connection = _connection()
+    with connection:
+        inserted = connection.execute(
+            "INSERT OR IGNORE INTO chunks (scope, exact, sketch, result, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (scope, chunk_fingerprint["exact"], json.dumps(chunk_fingerprint["sketch"]), result, now, now),
+        )
+        if inserted.rowcount:
+            connection.executemany("INSERT INTO sketch_hashes (scope, hash, chunk) VALUES (?, ?, ?)",
+                                   [(scope, value, inserted.lastrowid) for value in chunk_fingerprint["sketch"]])
+        else:
+            connection.execute("UPDATE chunks SET result = ?, accessed = ? WHERE scope = ? AND exact = ?",
+                               (result, now, scope, chunk_fingerprint["exact"]))
+    with _lock:
+        _counters["writes"] += 1
+        trim = _counters["writes"] % TRIM_INTERVAL == 0
+    if trim:
+        _trim(connection)
+
+
+def _trim(connection):
+    """Drop the least recently used chunks beyond CHUNK_REUSE_ENTRIES."""
+    stale = "SELECT id FROM chunks ORDER BY accessed DESC LIMIT -1 OFFSET ?"
+    with connection:
+        connection.execute("DELETE FROM sketch_hashes WHERE chunk IN (" + stale + ")", (CHUNK_REUSE_ENTRIES,))
+        connection.execute("DELETE FROM chunks WHERE id IN (" + stale + ")", (CHUNK_REUSE_ENTRIES,))
+
+
+def clear():
+    """Forget every stored chunk result."""
+    connection = _connection()
+    with connection:
+        connection.execute("DELETE FROM sketch_hashes")
+        connection.execute("DELETE FROM chunks")
+
+
+def stats():
+    """Hit/miss counters for this process plus the number of chunk results stored."""
+    with _lock:
+        result = dict(_counters)
+    result["entries"] = _connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    lookups = result["hits"] + result["changed"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+    return result
+
+
+def _collect_metrics():
+    with _lock:
+        counters = dict(_counters)
+    return [
+        ("pdf_chunk_reuse_hits_total", "counter", "Chunks that reused the result stored for the same text",
+         counters["hits"]),
+        ("pdf_chunk_reuse_changed_total", "counter", "Chunks sent to the LLM because their text changed since a stored version",
+         counters["changed"]),
+        ("pdf_chunk_reuse_misses_total", "counter", "Chunks sent to the LLM because nothing like them was stored",
+         counters["misses"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
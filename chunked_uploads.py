@@ -0,0 +1,168 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from config import UPLOAD_FOLDER, MAX_CHUNKED_UPLOAD_MB, UPLOAD_EXPIRY
+
+
+# Resumable uploads: <id>.json holds the filename and expected size, <id>.part the bytes received
+# so far. Both live on disk, so any worker can accept the next part of an upload.
+UPLOADS_FOLDER = os.path.join(UPLOAD_FOLDER, ".uploads")
+
+BLOCK_SIZE = 1024 * 1024
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# upload id -> (bytes hashed, running sha256), so parts are hashed as they arrive
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    """A part was sent for the wrong offset; `offset` is where the upload should resume."""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+#helper functions:
+
+
+def _paths(upload_id):
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id or ""):
+        raise UploadError("Invalid upload id")
+    base = os.path.join(UPLOADS_FOLDER, upload_id)
+    return base + ".json", base + ".part"
+
+
+def _remove_expired():
+    now = time.time()
+    for name in os.listdir(UPLOADS_FOLDER):
+        path = os.path.join(UPLOADS_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) > UPLOAD_EXPIRY:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _hasher_at(upload_id, part_file, offset):
+    """Return a sha256 of the first `offset` bytes, re-reading the part file only if this process missed some.
+
+    The cached digest is copied, so bytes of a part that is then rejected never reach it.
+    """
+    with _hashers_lock:
+        state = _hashers.get(upload_id)
+    if state is not None and state[0] == offset:
+        return state[1].copy()
+
+    digest = hashlib.sha256()
+    part_file.seek(0)
+    remaining = offset
+    while remaining:
+        block = part_file.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            break
+        digest.update(block)
+        remaining -= len(block)
+    return digest
+
+
+
+
+#upload sessions
+
+
+def create(filename, size):
+    """Start a resumable upload of `size` bytes and return its status."""
+    if size <= 0 or size > MAX_CHUNKED_UPLOAD_MB * 1024 * 1024:
+        raise UploadError(f"Upload size must be between 1 byte and {MAX_CHUNKED_UPLOAD_MB} MB")
+
+    os.makedirs(UPLOADS_FOLDER, exist_ok=True)
+    _remove_expired()
+
+    upload_id = uuid.uuid4().hex
+    info_path, part_path = _paths(upload_id)
+    with open(info_path, "w", encoding="utf-8") as file:
+        json.dump({"filename": filename, "size": size}, file)
+    open(part_path, "wb").close()
+    return status(upload_id)
+
+
+def status(upload_id):
+    """Return an upload's filename, expected size and the offset to send next, or None."""
+    info_path, part_path = _paths(upload_id)
+    try:
+        with open(info_path, encoding="utf-8") as file:
+            info = json.load(file)
+        offset = os.path.getsize(part_path)
+    except FileNotFoundError:
+        return None
+    return {"upload_id": upload_id, "filename": info["filename"], "size": info["size"], "offset": offset}
+
+
+def append(upload_id, offset, stream):
+    """Append a part read from `stream` at `offset`, hashing it on the way. Returns the new offset.
+
+    The body is copied to disk block by block, so a part is never held in memory whole.
+    """
+    info = status(upload_id)
+    if info is None:
+        raise UploadError("Upload not found")
+    _, part_path = _paths(upload_id)
+
+    with open(part_path, "r+b") as part_file:
+        # Serializes parts of the same upload across threads and worker processes
+        fcntl.flock(part_file, fcntl.LOCK_EX)
+        current = os.fstat(part_file.fileno()).st_size
+        if offset != current:
+            raise OffsetMismatch(current)
+
+        digest = _hasher_at(upload_id, part_file, current)
+        part_file.seek(current)
+        written = current
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if not block:
+                break
+            if written + len(block) > info["size"]:
+                part_file.truncate(current)
+                raise UploadError("Part goes past the declared upload size")
+            part_file.write(block)
+            digest.update(block)
+            written += len(block)
+        part_file.flush()
+
+        # Only a part that was written whole moves the cached digest on
+        with _hashers_lock:
+            _hashers[upload_id] = (written, digest)
+        return written
+
+
+def complete(upload_id):
+    """Finish an upload, returning (path of the received file, filename, sha256 of its content).
+
+    The caller takes ownership of the file.
+    """
+    info = status(upload_id)
+    if info is None:
+        raise UploadError("Upload not found")
+    if info["offset"] != info["size"]:
+        raise OffsetMismatch(info["offset"])
+
+    info_path, part_path = _paths(upload_id)
+    with open(part_path, "rb") as part_file:
+        digest = _hasher_at(upload_id, part_file, info["size"])
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    os.remove(info_path)
+    return part_path, info["filename"], digest.hexdigest()
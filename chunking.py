@@ -0,0 +1,180 @@
+import math
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+import document_store
+import tokenization
+
+
+# How good a place to end a chunk each kind of boundary is. A chunk ends at the boundary with the
+# best strength plus fill (the fraction of the token budget used), so a heading halfway through the
+# window still beats a sentence end right at the budget.
+HEADING = 1.0
+PAGE = 0.8
+PARAGRAPH = 0.6
+SENTENCE = 0.3
+
+# Chunks are never cut before this fraction of the budget, which also keeps chunking linear
+MIN_FILL = 0.5
+
+BOUNDARY_PATTERN = re.compile(
+    # A heading line: "Chapter 3 ...", "2.1 Results", or a short title-cased line
+    r"(?P<heading>^[ \t]*(?:(?i:chapter|section|part|appendix)\b[^\n]{0,80}"
+    r"|\d+(?:\.\d+)*\.?[ \t]+[A-Z][^\n]{0,80}"
+    r"|[A-Z][\w'-]*(?:[ \t]+(?:[A-Z0-9][\w'-]*|of|and|the|in|for|to|on|with|a|an)){0,8}:?)[ \t]*$)"
+    # A sentence ending a line, or a blank line
+    r"|(?P<paragraph>[.!?][\"')\]]?[ \t]*\n(?=[ \t]*\S)|\n[ \t]*\n)"
+    # A sentence end inside a line
+    r"|(?P<sentence>[.!?][\"')\]]?(?=[ \t]+[\"'(]?[A-Z]))",
+    re.M,
+)
+STRENGTHS = {"heading": HEADING, "paragraph": PARAGRAPH, "sentence": SENTENCE}
+
+
+#helper functions:
+
+
+def find_boundaries(tokens, page_offsets, model):
+    """Token positions where a chunk may end, with their strengths, in increasing order.
+
+    Page starts come from the stored page offsets; headings, paragraphs and sentence ends are found
+    in each page's decoded text and mapped back to the first token starting at or after them.
+    """
+    tokenizer = tokenization.get_tokenizer(model)
+    positions = []
+    strengths = []
+
+    def add(position, strength):
+        if positions and positions[-1] == position:
+            strengths[-1] = max(strengths[-1], strength)
+        elif position > 0:
+            positions.append(position)
+            strengths.append(strength)
+
+    for page_start, page_end in zip(page_offsets, page_offsets[1:]):
+        add(page_start, PAGE)
+        text, char_offsets = tokenizer.decode_with_offsets(tokens[page_start:page_end])
+        token = 0
+        for match in BOUNDARY_PATTERN.finditer(text):
+            kind = match.lastgroup
+            char = match.start() if kind == "heading" else match.end()
+            while token < len(char_offsets) and char_offsets[token] < char:
+                token += 1
+            if token < len(char_offsets):
+                add(page_start + token, STRENGTHS[kind])
+    return positions, strengths
+
+
+def plan_chunks(length, positions, strengths, budget, overlap=0):
+    """Choose (start, end) token ranges of at most `budget` tokens covering `length` tokens.
+
+    Produces exactly as many chunks as a fixed-size split with the same budget and overlap would:
+    each end is the best boundary between the latest end that still leaves room for the remaining
+    chunks and the budget. Consecutive chunks share up to `overlap` tokens, starting on a boundary
+    when there is one. Every boundary is looked at a bounded number of times.
+    """
+    if length <= budget:
+        return [(0, length)] if length else []
+    overlap = max(0, min(overlap, budget // 4))
+    step = budget - overlap
+    count = 1 + math.ceil((length - budget) / step)
+
+    ranges = []
+    start = 0
+    for i in range(1, count):
+        high = start + budget
+        low = max(start + int(budget * MIN_FILL), length - (count - i) * step)
+        end, best = high, None
+        for b in range(bisect_left(positions, low), bisect_right(positions, high)):
+            score = strengths[b] + (positions[b] - start) / budget
+            if best is None or score >= best:
+                end, best = positions[b], score
+        ranges.append((start, end))
+
+        start = end - overlap
+        if overlap:
+            b = bisect_left(positions, start)
+            if b < len(positions) and positions[b] < end:
+                start = positions[b]
+    ranges.append((start, length))
+    return ranges
+
+
+def page_range(page_offsets, start, end):
+    """1-based first and last page of the token range [start, end)."""
+    return [bisect_right(page_offsets, start), bisect_right(page_offsets, max(start, end - 1))]
+
+
+
+
+#chunking
+
+
+def plan_document(doc_hash, model, budget, overlap=0, structured=True):
+    """Plan the chunks of a stored document without decoding them.
+
+    Returns a list of {"start", "end", "tokens", "pages": [first, last]}; chunk_text turns one into text.
+    With structured=False chunks are cut every `budget` tokens.
+    """
+    tokens = document_store.load_tokens(doc_hash, model)
+    page_offsets = document_store.load_page_token_offsets(doc_hash, model)
+    # Without boundaries every chunk ends at the budget
+    positions, strengths = find_boundaries(tokens, page_offsets, model) if structured else ([], [])
+    return [
+        {"start": start, "end": end, "tokens": end - start, "pages": page_range(page_offsets, start, end)}
+        for start, end in plan_chunks(len(tokens), positions, strengths, budget, overlap)
+    ]
+
+
+def chunk_text(doc_hash, model, chunk):
+    """Decode a planned chunk, reading only its tokens from the stored token stream."""
+    tokens = document_store.load_token_range(doc_hash, model, chunk["start"], chunk["end"])
+    return tokenization.get_tokenizer(model).decode(tokens)
+
+
+def iter_chunks(doc_hash, model, chunks):
+    """Yield planned chunks with their "text", decoding each one only when it is asked for."""
+    for chunk in chunks:
+        yield dict(chunk, text=chunk_text(doc_hash, model, chunk))
+
+
+def iter_page_chunks(pages, model, budget, overlap=0):
+    """Cut a stream of page texts into chunks of `budget` tokens as the pages arrive.
+
+    Pages are encoded one at a time into a rolling token buffer, and each chunk is yielded as soon
+    as the pages after it have started, so only about one chunk of tokens is held however long the
+    document is. Yields the chunks plan_document(..., structured=False) plans for a document whose
+    token stream was encoded from the same pages, with their "text" (as iter_chunks adds it);
+    structured chunks need the whole document, as plan_chunks balances the chunk count against its length.
+    """
+    tokenizer = tokenization.get_tokenizer(model)
+    overlap = max(0, min(overlap, budget // 4))
+    step = budget - overlap
+    buffer = array("I")  # tokens from position `offset` on
+    offset = 0
+    start = 0
+    length = 0
+    page_offsets = []
+
+    def cut(end):
+        return {
+            "start": start,
+            "end": end,
+            "text": tokenizer.decode(buffer[start - offset:end - offset]),
+            "tokens": end - start,
+            "pages": page_range(page_offsets, start, end),
+        }
+
+    for page in pages:
+        page_offsets.append(length)
+        page_tokens = tokenization.encode(page + "\n", model)
+        buffer.extend(page_tokens)
+        length += len(page_tokens)
+        while length - start > budget:
+            yield cut(start + budget)
+            start += step
+            del buffer[:start - offset]
+            offset = start
+    if length > start:
+        yield cut(length)
@@ -4,3 +4,120 @@ from dotenv import load_dotenv
 load_dotenv()
 
 API_KEY = os.environ.get("API_KEY")
+# Point at any OpenAI-compatible server, e.g. the fake one the benchmarks start; unset uses api.openai.com
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+
+# Folder holding uploaded PDFs and the extracted-text store
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "uploaded_pdfs")
+
+# LLM call concurrency and retry policy
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "1.0"))
+
+# Client-side rate limits shared by all processes: LLM requests and tokens per minute (0 turns a limit off).
+# A call counts its prompt tokens plus max_tokens, like OpenAI's own estimate; each bucket holds
+# LLM_RATE_LIMIT_BURST_SECONDS worth of its limit
+LLM_RATE_LIMIT_RPM = int(os.environ.get("LLM_RATE_LIMIT_RPM", "0"))
+LLM_RATE_LIMIT_TPM = int(os.environ.get("LLM_RATE_LIMIT_TPM", "0"))
+LLM_RATE_LIMIT_BURST_SECONDS = float(os.environ.get("LLM_RATE_LIMIT_BURST_SECONDS", "10"))
+
+# HTTP connections to the LLM API, pooled per process: pool size, idle connections kept alive and for how
+# long, and timeouts in seconds (pool: waiting for a free connection)
+LLM_POOL_CONNECTIONS = int(os.environ.get("LLM_POOL_CONNECTIONS", "100"))
+LLM_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+LLM_POOL_TIMEOUT = float(os.environ.get("LLM_POOL_TIMEOUT", "60"))
+
+# "parallel" harvests headings from every chunk first and then extracts all chunks concurrently,
+# "sequential" feeds each chunk's headings into the next chunk's prompt,
+# "tree" extracts like "parallel" and then condenses the chunk outlines with the LLM, REDUCE_FAN_IN at a time
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "parallel")
+# Outlines or answers merged per LLM call in each round of a tree reduce (also used for ASK_MODE "full")
+REDUCE_FAN_IN = max(2, int(os.environ.get("REDUCE_FAN_IN", "4")))
+
+# "structure" ends chunks on headings, pages, paragraphs or sentences near the token budget,
+# "fixed" cuts every extraction_chunk_size() tokens; overlap repeats the end of a chunk at the start of the next
+CHUNKING = os.environ.get("CHUNKING", "structure")
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "0"))
+
+# Clean the extracted text before it is tokenized: drop running headers and footers, page numbers and
+# reference sections, join hyphenated words and collapse whitespace, so none of it is sent to the LLM
+TEXT_FILTER = os.environ.get("TEXT_FILTER", "1") == "1"
+
+# Also merge outline headings and bullets that differ only in case, whitespace or trailing punctuation
+OUTLINE_MERGE_NEAR_DUPLICATES = os.environ.get("OUTLINE_MERGE_NEAR_DUPLICATES", "0") == "1"
+
+# Results of headings and extraction calls are kept per chunk and reused by later documents for a chunk
+# with the same text, so a revision only sends its changed chunks; shared by all workers. A chunk sent
+# while a stored one is at least CHUNK_REUSE_THRESHOLD similar (word shingles) is counted as changed
+CHUNK_REUSE_ENABLED = os.environ.get("CHUNK_REUSE_ENABLED", "1") == "1"
+CHUNK_REUSE_THRESHOLD = float(os.environ.get("CHUNK_REUSE_THRESHOLD", "0.5"))
+CHUNK_REUSE_ENTRIES = int(os.environ.get("CHUNK_REUSE_ENTRIES", "50000"))
+
+# "retrieval" answers /ask from the best matching passages, "full" asks every chunk
+ASK_MODE = os.environ.get("ASK_MODE", "retrieval")
+PASSAGE_TOKENS = int(os.environ.get("PASSAGE_TOKENS", "300"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", "3000"))
+
+# LLM response cache: an in-memory LRU per process in front of a SQLite file shared by all workers
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "512"))
+LLM_CACHE_DISK_ENTRIES = int(os.environ.get("LLM_CACHE_DISK_ENTRIES", "20000"))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+
+# Answers are reused for a repeated question about the same document, or one similar enough: cosine
+# similarity of hashed character n-grams of the normalized questions (1.0 = same words), among questions
+# with the same words other than stop words, per process
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_ENTRIES = int(os.environ.get("ANSWER_CACHE_ENTRIES", "2000"))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.9"))
+
+# Identical /generate and /ask requests (same document, same normalized question) arriving while one is
+# being computed join it instead of starting their own, across threads and worker processes on this host;
+# followers check for new results every SINGLE_FLIGHT_POLL_INTERVAL seconds
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.environ.get("SINGLE_FLIGHT_POLL_INTERVAL", "0.05"))
+
+# Background summarization jobs
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))  # seconds between queue polls
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", "600"))  # requeue running jobs silent this long
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", "30"))  # seconds between a running job's heartbeats
+JOB_WORKER_THREADS = int(os.environ.get("JOB_WORKER_THREADS", "0"))  # in-process workers for development
+
+# Queue a summary job for every new upload so the first /generate is served from the stored summary
+PRECOMPUTE_SUMMARY_ON_UPLOAD = os.environ.get("PRECOMPUTE_SUMMARY_ON_UPLOAD", "0") == "1"
+
+# Batch summarization (python batch.py, POST /batch): documents in progress at once, and the folder
+# /batch reads its inputs from and writes its results to
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_FOLDER = os.environ.get("BATCH_FOLDER", os.path.join(UPLOAD_FOLDER, "batch"))
+
+# Page-parallel PDF extraction: documents longer than one task are split across worker processes
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACTION_PAGES_PER_TASK = int(os.environ.get("EXTRACTION_PAGES_PER_TASK", "16"))
+
+# Upload limits: single-request uploads through /upload_pdf, and resumable uploads sent in parts
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "16"))
+UPLOAD_PART_MB = int(os.environ.get("UPLOAD_PART_MB", "8"))
+MAX_CHUNKED_UPLOAD_MB = int(os.environ.get("MAX_CHUNKED_UPLOAD_MB", "1024"))
+UPLOAD_EXPIRY = float(os.environ.get("UPLOAD_EXPIRY", str(24 * 3600)))  # seconds before unfinished uploads are removed
+
+# ASGI server (python asgi.py): address, worker processes, threads running the Flask routes per process,
+# seconds idle client connections stay open, and seconds in-flight requests get to finish on shutdown
+SERVER_HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+SERVER_WSGI_THREADS = int(os.environ.get("SERVER_WSGI_THREADS", "16"))
+SERVER_KEEPALIVE = int(os.environ.get("SERVER_KEEPALIVE", "5"))
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get("SERVER_SHUTDOWN_TIMEOUT", "30"))
+
+# Logging level (DEBUG, INFO, WARNING, ERROR); DEBUG adds per-chunk progress lines
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# USD per 1000 tokens, used for the LLM cost metric
+LLM_PROMPT_PRICE_PER_1K = float(os.environ.get("LLM_PROMPT_PRICE_PER_1K", "0.0005"))
+LLM_COMPLETION_PRICE_PER_1K = float(os.environ.get("LLM_COMPLETION_PRICE_PER_1K", "0.0015"))
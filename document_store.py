@@ -0,0 +1,420 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+import metrics
+import pdf_extraction
+import text_filter
+import tokenization
+from config import UPLOAD_FOLDER, TEXT_FILTER
+
+
+# Extracted documents live under <UPLOAD_FOLDER>/.store/<sha256 of the pdf>/; which filenames point at
+# which document, each document's metadata and its extraction state are kept in a SQLite registry
+# that every worker process shares
+STORE_FOLDER = os.path.join(UPLOAD_FOLDER, ".store")
+REGISTRY_DB = os.path.join(STORE_FOLDER, "registry.sqlite3")
+
+TEXT_FILE = "text.txt"
+SOURCE_FILE = "source.pdf"
+
+# Extraction states of a document
+EXTRACTING = "extracting"
+READY = "ready"
+FAILED = "failed"
+
+# A process extracting a document refreshes its claim this often, in seconds; claims not refreshed
+# for STALE_EXTRACTION seconds belong to a dead process and are taken over
+EXTRACTION_HEARTBEAT = 5.0
+STALE_EXTRACTION = 60.0
+# How often a process waiting on another's extraction of the same document checks on it
+EXTRACTION_POLL_INTERVAL = 0.2
+
+_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+#helper functions:
+
+
+def file_hash(file_path):
+    """Return the sha256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def document_folder(doc_hash):
+    return os.path.join(STORE_FOLDER, doc_hash)
+
+
+def _temp_path(path):
+    """A temporary name next to path that no other process or thread writes to."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _write_atomic(path, data, mode="w"):
+    """Write a file through a temporary name so readers never see it half written."""
+    tmp_path = _temp_path(path)
+    if "b" in mode:
+        with open(tmp_path, mode) as file:
+            file.write(data)
+    else:
+        with open(tmp_path, mode, encoding="utf-8", newline="") as file:
+            file.write(data)
+    os.replace(tmp_path, path)
+
+
+def _connection():
+    """One SQLite connection per thread to the registry shared by every process."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(STORE_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(REGISTRY_DB, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                hash TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                text_file TEXT NOT NULL,
+                page_count INTEGER,
+                char_count INTEGER,
+                byte_count INTEGER,
+                meta TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS names (
+                filename TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+        """)
+        _local.connection = connection
+    return connection
+
+
+def _transaction(connection, work):
+    """Run work(connection) in a write transaction and return its result."""
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        result = work(connection)
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return result
+
+
+def _insert_document(connection, meta, now):
+    connection.execute(
+        "INSERT OR REPLACE INTO documents (hash, state, text_file, page_count, char_count, byte_count, meta, "
+        "error, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)",
+        (meta["hash"], READY, meta["text_file"], meta["page_count"], meta["char_count"],
+         meta["page_byte_offsets"][-1], json.dumps(meta), now, now),
+    )
+
+
+def _claim_extraction(doc_hash):
+    """Return the metadata of a stored document, or None once this process may extract it.
+
+    Only one process extracts a document at a time: the others wait here for its result, or take
+    over if the extracting process stopped refreshing its claim or failed.
+    """
+    def work(connection):
+        now = time.time()
+        row = connection.execute("SELECT state, meta, updated FROM documents WHERE hash = ?", (doc_hash,)).fetchone()
+        if row is not None and row["state"] == READY:
+            return json.loads(row["meta"])
+        if row is not None and row["state"] == EXTRACTING and row["updated"] > now - STALE_EXTRACTION:
+            return EXTRACTING
+        connection.execute(
+            "INSERT OR REPLACE INTO documents (hash, state, text_file, created, updated) VALUES (?, ?, ?, ?, ?)",
+            (doc_hash, EXTRACTING, os.path.join(doc_hash, TEXT_FILE), now, now),
+        )
+        return None
+
+    while True:
+        result = _transaction(_connection(), work)
+        if result != EXTRACTING:
+            return result
+        time.sleep(EXTRACTION_POLL_INTERVAL)
+
+
+def _set_extraction_state(doc_hash, state, error=None):
+    _connection().execute("UPDATE documents SET state = ?, error = ?, updated = ? WHERE hash = ?",
+                          (state, error, time.time(), doc_hash))
+
+
+def _register_name(filename, doc_hash):
+    """Point `filename` at a document, or a variant tagged with the content hash if another uses it."""
+    def work(connection):
+        row = connection.execute("SELECT hash FROM names WHERE filename = ?", (filename,)).fetchone()
+        name = filename
+        if row is not None and row["hash"] != doc_hash:
+            stem, extension = os.path.splitext(filename)
+            name = f"{stem}-{doc_hash[:8]}{extension}"
+        connection.execute("INSERT OR REPLACE INTO names (filename, hash, created) VALUES (?, ?, ?)",
+                           (name, doc_hash, time.time()))
+        return name
+
+    return _transaction(_connection(), work)
+
+
+def _extract(file_path, doc_hash, on_page=None):
+    """Write a PDF's text into the store and return its metadata (without "filename").
+
+    on_page(text) is called with every page as soon as it is written.
+    """
+    folder = document_folder(doc_hash)
+    # Pages are written to the text file as they arrive instead of being joined in memory.
+    # Page i spans text[page_offsets[i]:page_offsets[i + 1]], bytes page_byte_offsets[i] to [i + 1] of the file
+    page_offsets = [0]
+    page_byte_offsets = [0]
+    page_seconds = []
+    started = time.perf_counter()
+    heartbeat = time.monotonic()
+    text_path = os.path.join(folder, TEXT_FILE)
+    tmp_path = _temp_path(text_path)
+    with open(tmp_path, "wb") as text_file:
+        for page_text, seconds in pdf_extraction.iter_pages(file_path):
+            encoded = (page_text + "\n").encode("utf-8")
+            text_file.write(encoded)
+            page_offsets.append(page_offsets[-1] + len(page_text) + 1)
+            page_byte_offsets.append(page_byte_offsets[-1] + len(encoded))
+            page_seconds.append(round(seconds, 4))
+            if on_page is not None:
+                on_page(page_text)
+            if time.monotonic() - heartbeat > EXTRACTION_HEARTBEAT:
+                _set_extraction_state(doc_hash, EXTRACTING)
+                heartbeat = time.monotonic()
+    os.replace(tmp_path, text_path)
+    elapsed = time.perf_counter() - started
+    metrics.STAGE_SECONDS.observe(elapsed, stage="extract")
+    metrics.DOCUMENT_PAGES.observe(len(page_offsets) - 1)
+
+    return {
+        "hash": doc_hash,
+        "text_file": os.path.join(doc_hash, TEXT_FILE),
+        "page_count": len(page_offsets) - 1,
+        "char_count": page_offsets[-1],
+        "page_offsets": page_offsets,
+        "page_byte_offsets": page_byte_offsets,
+        "extraction_seconds": round(elapsed, 3),
+        "page_seconds": page_seconds,
+    }
+
+
+@contextmanager
+def _mapped_text(meta):
+    """A document's text file as read-only bytes, memory-mapped rather than read.
+
+    Mapped pages live in the OS page cache, shared by every process, so no worker keeps its own copy
+    of a document's text and only the pages sliced out are read from disk.
+    """
+    with open(os.path.join(STORE_FOLDER, meta["text_file"]), "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            # Empty files cannot be mapped
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as text:
+            yield text
+
+
+#store access
+
+
+def add_document(file_path, filename, doc_hash=None, move=False, on_page=None):
+    """Register an uploaded PDF, extracting its text only if this content was never seen before.
+
+    Pass `doc_hash` if the content hash is already known. With `move=True` the file is moved into
+    the store as the document's source PDF (or deleted if the content is already stored).
+    on_page(text) is called with each page as it is extracted, which only happens if the content is new.
+
+    Returns the document metadata, with "filename" set to the name this upload was registered
+    under and "duplicate" telling whether the content was already stored, or None if the text
+    could not be extracted.
+    """
+    try:
+        doc_hash = doc_hash or file_hash(file_path)
+        meta = _claim_extraction(doc_hash)
+        duplicate = meta is not None
+
+        if meta is None:
+            try:
+                folder = document_folder(doc_hash)
+                os.makedirs(folder, exist_ok=True)
+                if move:
+                    # Stored by content hash, so uploads with the same name never overwrite each other
+                    source_path = os.path.join(folder, SOURCE_FILE)
+                    os.replace(file_path, source_path)
+                    file_path = source_path
+                meta = _extract(file_path, doc_hash, on_page)
+                _transaction(_connection(), lambda connection: _insert_document(connection, meta, time.time()))
+            except BaseException as e:
+                _set_extraction_state(doc_hash, FAILED, str(e))
+                raise
+            slowest = max(meta["page_seconds"], default=0)
+            logger.info("Extracted %d pages from %s into store %s in %.2fs (slowest page %.2fs)",
+                        meta["page_count"], filename, doc_hash[:12], meta["extraction_seconds"], slowest)
+        else:
+            logger.info("Document %s already in store as %s, skipping extraction", filename, doc_hash[:12])
+            if move:
+                os.remove(file_path)
+
+        filename = _register_name(filename, doc_hash)
+        return dict(meta, filename=filename, duplicate=duplicate)
+
+    except Exception:
+        logger.exception("Error adding document to store")
+        return None
+
+
+def get_hash(filename):
+    """Return the content hash registered for an uploaded filename, or None."""
+    if not filename:
+        return None
+    row = _connection().execute("SELECT hash FROM names WHERE filename = ?",
+                                (os.path.basename(filename),)).fetchone()
+    return row["hash"] if row else None
+
+
+def load_meta(doc_hash):
+    """Return the metadata of a document whose text is in the store, or None."""
+    row = _connection().execute("SELECT meta FROM documents WHERE hash = ? AND state = ?",
+                                (doc_hash, READY)).fetchone()
+    return json.loads(row["meta"]) if row else None
+
+
+def get_document(filename):
+    """Return the metadata of an uploaded document, or None if it was never processed."""
+    doc_hash = get_hash(filename)
+    return load_meta(doc_hash) if doc_hash else None
+
+
+def has_document(filename):
+    return get_document(filename) is not None
+
+
+def load_pages(doc_hash):
+    """Return the document text split back into its pages."""
+    meta = load_meta(doc_hash)
+    offsets = meta["page_byte_offsets"]
+    with _mapped_text(meta) as text:
+        return [text[start:end - 1].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+
+
+def token_stream_name(model):
+    """Names what a document's token stream depends on: the model's encoding and the text filter version."""
+    encoding_name = tokenization.get_tokenizer(model).name
+    return f"{encoding_name}-clean{text_filter.VERSION}" if TEXT_FILTER else encoding_name
+
+
+def _tokens_path(doc_hash, model):
+    return os.path.join(document_folder(doc_hash), f"tokens-{token_stream_name(model)}.bin")
+
+
+def _filter_report(doc_hash, pages, stats, tokens_after, model):
+    """Report of what the text filter removed from a document's pages, given its `stats` and the
+    length of the cleaned token stream."""
+    tokens_before = tokenization.count_page_tokens(pages, model)
+    report = dict(stats, version=text_filter.VERSION, tokens_before=tokens_before, tokens_after=tokens_after,
+                  tokens_removed=tokens_before - tokens_after)
+    metrics.TEXT_FILTER_TOKENS.inc(report["tokens_removed"])
+    logger.info("Text filter removed %d of %d tokens from %s (%d repeated lines, %d page numbers, "
+                "%d reference lines, %d hyphenations)", report["tokens_removed"], tokens_before, doc_hash[:12],
+                stats["repeated_lines"], stats["page_numbers"], stats["reference_lines"], stats["hyphenations"])
+    return report
+
+
+def load_tokens(doc_hash, model):
+    """Return the document's token stream for a model, encoding it once and caching it on disk."""
+    tokens_path = _tokens_path(doc_hash, model)
+
+    tokens = array("I")
+    # The page offsets are written last, so their presence means the token file is complete
+    if os.path.exists(tokens_path + ".pages.json"):
+        with open(tokens_path, "rb") as file:
+            tokens.frombytes(file.read())
+        return tokens
+
+    with metrics.STAGE_SECONDS.time(stage="tokenize"):
+        pages = load_pages(doc_hash)
+        if TEXT_FILTER:
+            # Cleaned pages stream straight into the encoder; only their tokens are kept
+            stats = Counter()
+            page_tokens, page_token_offsets = tokenization.encode_pages(text_filter.clean_pages(pages, stats), model)
+            report = _filter_report(doc_hash, pages, stats, len(page_tokens), model)
+            _write_atomic(tokens_path + ".filter.json", json.dumps(report))
+        else:
+            page_tokens, page_token_offsets = tokenization.encode_pages(pages, model)
+    tokens.extend(page_tokens)
+    _write_atomic(tokens_path, tokens.tobytes(), mode="wb")
+    _write_atomic(tokens_path + ".pages.json", json.dumps(page_token_offsets))
+    return tokens
+
+
+def load_filter_report(doc_hash, model):
+    """What the text filter removed from a document before it was tokenized, or None if it was not filtered."""
+    try:
+        with open(_tokens_path(doc_hash, model) + ".filter.json", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def load_token_range(doc_hash, model, start, end):
+    """Return tokens [start, end) of the document's token stream, read through a memory map of the token file."""
+    tokens_path = _tokens_path(doc_hash, model)
+    if not os.path.exists(tokens_path + ".pages.json"):
+        load_tokens(doc_hash, model)
+    tokens = array("I")
+    if end > start:
+        with open(tokens_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as stream:
+            tokens.frombytes(stream[start * tokens.itemsize:end * tokens.itemsize])
+    return tokens
+
+
+def load_page_token_offsets(doc_hash, model):
+    """Return where each page starts in the token stream; page i spans tokens[offsets[i]:offsets[i + 1]]."""
+    tokens_path = _tokens_path(doc_hash, model)
+    if not os.path.exists(tokens_path + ".pages.json"):
+        load_tokens(doc_hash, model)
+    with open(tokens_path + ".pages.json", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _artifact_path(doc_hash, name, key):
+    key_hash = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(document_folder(doc_hash), "artifacts", f"{name}-{key_hash}.json")
+
+
+def load_artifact(doc_hash, name, key):
+    """Return a derived result (e.g. outline segments) saved for this document under `key`, or None."""
+    try:
+        with open(_artifact_path(doc_hash, name, key), encoding="utf-8") as file:
+            artifact = json.load(file)
+    except FileNotFoundError:
+        return None
+    # Guard against a (very unlikely) truncated-hash collision
+    return artifact["value"] if artifact["key"] == key else None
+
+
+def save_artifact(doc_hash, name, key, value):
+    """Save a derived result with the document. `key` lists everything the result depends on."""
+    path = _artifact_path(doc_hash, name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomic(path, json.dumps({"key": key, "value": value}))
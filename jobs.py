@@ -0,0 +1,358 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from config import UPLOAD_FOLDER, JOB_POLL_INTERVAL, JOB_STALE_AFTER, JOB_HEARTBEAT_INTERVAL
+from summarizer_methods import iter_summary_events
+import batch
+import rate_limiter
+import tracing
+
+
+# Summaries queued by /generate run in worker processes (python jobs.py --workers N)
+# that share the queue through this SQLite file
+JOBS_FOLDER = os.path.join(UPLOAD_FOLDER, ".jobs")
+JOBS_DB = os.path.join(JOBS_FOLDER, "jobs.sqlite3")
+
+ACTIVE_STATUSES = ("queued", "running")
+
+_local = threading.local()
+# IDs of the running jobs of this process whose cancellation a heartbeat saw requested
+_cancelled = set()
+_cancelled_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+#helper functions:
+
+
+def _connection():
+    """One SQLite connection per thread; jobs are shared by every process through the file."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(JOBS_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                dedupe_key TEXT NOT NULL,
+                pdf_name TEXT,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress_done INTEGER NOT NULL DEFAULT 0,
+                progress_total INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+            CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status);
+            CREATE TABLE IF NOT EXISTS job_sections (
+                job_id TEXT NOT NULL,
+                chunk INTEGER NOT NULL,
+                outline TEXT NOT NULL,
+                PRIMARY KEY (job_id, chunk)
+            );
+        """)
+        _local.connection = connection
+    return connection
+
+
+def _job_dict(row, sections=None):
+    job = {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "pdf_name": row["pdf_name"],
+        "status": row["status"],
+        "progress": {"done": row["progress_done"], "total": row["progress_total"]},
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created": row["created"],
+        "updated": row["updated"],
+    }
+    if sections is not None:
+        job["partial"] = sections
+    return job
+
+
+
+
+#queue access
+
+
+def enqueue(kind, pdf_name, dedupe_key, params=None):
+    """Queue a job, or return the queued/running job with the same dedupe key.
+
+    The returned dict has "deduplicated" set when an existing job was reused.
+    """
+    connection = _connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE dedupe_key = ? AND status IN (?, ?) ORDER BY created LIMIT 1",
+            (dedupe_key, *ACTIVE_STATUSES),
+        ).fetchone()
+        if row is None:
+            job_id = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO jobs (id, kind, dedupe_key, pdf_name, params, status, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, dedupe_key, pdf_name, json.dumps(params or {}), now, now),
+            )
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            deduplicated = False
+        else:
+            deduplicated = True
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return dict(_job_dict(row), deduplicated=deduplicated)
+
+
+def get_job(job_id, include_partial=True):
+    """Return a job's status, progress and result (plus finished sections so far), or None."""
+    connection = _connection()
+    row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    sections = None
+    if include_partial:
+        sections = [
+            {"chunk": chunk, "outline": outline}
+            for chunk, outline in connection.execute(
+                "SELECT chunk, outline FROM job_sections WHERE job_id = ? ORDER BY chunk", (job_id,)
+            )
+        ]
+    return _job_dict(row, sections)
+
+
+def cancel(job_id):
+    """Cancel a queued job right away, or ask the worker running it to stop. Returns the job or None."""
+    connection = _connection()
+    now = time.time()
+    connection.execute(
+        "UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'", (now, job_id)
+    )
+    connection.execute(
+        "UPDATE jobs SET cancel_requested = 1, updated = ? WHERE id = ? AND status = 'running'", (now, job_id)
+    )
+    return get_job(job_id, include_partial=False)
+
+
+def claim_next(worker_id):
+    """Atomically take the oldest queued job, or a running one whose worker stopped heartbeating."""
+    connection = _connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated < ?) "
+            "ORDER BY created LIMIT 1",
+            (now - JOB_STALE_AFTER,),
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ?",
+                (worker_id, now, row["id"]),
+            )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return row
+
+
+def report_progress(job_id, done, total, chunk=None, outline=None):
+    """Record progress (and a finished chunk's outline); raise JobCancelled if cancellation was requested."""
+    connection = _connection()
+    if chunk is not None:
+        connection.execute(
+            "INSERT OR REPLACE INTO job_sections (job_id, chunk, outline) VALUES (?, ?, ?)",
+            (job_id, chunk, outline),
+        )
+    connection.execute(
+        "UPDATE jobs SET progress_done = ?, progress_total = ?, updated = ? WHERE id = ?",
+        (done, total, time.time(), job_id),
+    )
+    cancel_requested = connection.execute(
+        "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()[0]
+    if cancel_requested:
+        raise JobCancelled()
+
+
+def check_cancelled(job_id):
+    """Raise JobCancelled if a heartbeat of the job saw its cancellation requested."""
+    with _cancelled_lock:
+        if job_id in _cancelled:
+            raise JobCancelled()
+
+
+class Heartbeat:
+    """Marks a running job alive every JOB_HEARTBEAT_INTERVAL seconds from a timer thread.
+
+    Long steps that report no progress (the headings pass, a tree reduce) would otherwise leave the job
+    looking stale to claim_next, and another worker would pay for the same LLM work again. Each beat
+    also reads cancel_requested, for check_cancelled.
+    """
+
+    def __init__(self, job_id, worker_id):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"heartbeat-{job_id[:8]}", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                self.beat()
+            except sqlite3.Error:
+                logger.warning("Heartbeat of job %s failed", self.job_id, exc_info=True)
+
+    def beat(self):
+        connection = _connection()
+        # Only while this worker still holds the job
+        connection.execute(
+            "UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running' AND worker = ?",
+            (time.time(), self.job_id, self.worker_id),
+        )
+        row = connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.job_id,)).fetchone()
+        if row is not None and row[0]:
+            with _cancelled_lock:
+                _cancelled.add(self.job_id)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        with _cancelled_lock:
+            _cancelled.discard(self.job_id)
+
+
+def finish(job_id, status, result=None, error=None):
+    connection = _connection()
+    connection.execute(
+        "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?",
+        (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+    )
+
+
+
+
+#workers
+
+
+def run_summary_job(job_id, pdf_name, params):
+    """Summarize a PDF, recording each finished chunk as a partial result."""
+    done = 0
+    for event in iter_summary_events(pdf_name, use_cache=params.get("use_cache", True)):
+        check_cancelled(job_id)
+        if event["event"] == "progress":
+            report_progress(job_id, done, event["total"])
+        elif event["event"] == "section":
+            done += 1
+            report_progress(job_id, done, event["total"], event["chunk"], event["outline"])
+        elif event["event"] == "done":
+            return {"summary": event["summary"], "outline": event["outline"]}
+
+
+def run_batch_job(job_id, source, params):
+    """Summarize every PDF of a batch directory or manifest (named inside BATCH_FOLDER) into the job's JSONL file."""
+    path = batch.resolve_input(source)
+    if path is None:
+        raise FileNotFoundError(f"Batch input {source} not found")
+    return batch.run_batch(batch.find_inputs(path), batch.result_path(job_id),
+                           use_cache=params.get("use_cache", True),
+                           on_progress=lambda done, total: report_progress(job_id, done, total))
+
+
+JOB_HANDLERS = {
+    "summary": run_summary_job,
+    "batch": run_batch_job,
+}
+
+
+def run_job(row, worker_id):
+    job_id = row["id"]
+    # Log lines of a job are traced by its ID
+    tracing.set_trace_id(job_id)
+    logger.info("Running %s job %s for %s", row["kind"], job_id, row["pdf_name"])
+    params = json.loads(row["params"])
+    # Jobs are bulk work: their LLM calls wait behind interactive ones
+    rate_limiter.set_caller(rate_limiter.BULK, params.get("user") or "jobs")
+    try:
+        with Heartbeat(job_id, worker_id):
+            result = JOB_HANDLERS[row["kind"]](job_id, row["pdf_name"], params)
+        finish(job_id, "done", result=result)
+        logger.info("Finished job %s", job_id)
+    except JobCancelled:
+        finish(job_id, "cancelled")
+        logger.info("Cancelled job %s", job_id)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        finish(job_id, "failed", error=str(e))
+
+
+def worker_loop(worker_id=None, stop_event=None):
+    """Process jobs until stop_event is set (or forever)."""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    logger.info("Job worker %s started", worker_id)
+    while stop_event is None or not stop_event.is_set():
+        row = claim_next(worker_id)
+        if row is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        run_job(row, worker_id)
+
+
+def start_worker_threads(count):
+    """Run job workers as daemon threads of the current process (handy for development)."""
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=worker_loop, name=f"job-worker-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run summarization job workers.")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    args = parser.parse_args()
+    tracing.configure_logging()
+
+    processes = [multiprocessing.Process(target=worker_loop, daemon=True) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("Stopping job workers...")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from config import (UPLOAD_FOLDER, LLM_CACHE_ENABLED, LLM_CACHE_MEMORY_ENTRIES,
+                    LLM_CACHE_DISK_ENTRIES, LLM_CACHE_TTL)
+
+
+# The disk tier is one SQLite file shared by every worker process
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, ".cache")
+CACHE_DB = os.path.join(CACHE_FOLDER, "llm_responses.sqlite3")
+
+# Trim the disk tier every this many writes
+TRIM_INTERVAL = 100
+
+_memory = OrderedDict()  # key -> (created, response), least recently used first
+# Generation of the disk tier the memory tier was filled from; clear() in any process bumps the one on
+# disk, and every process then empties its memory tier on its next lookup
+_generation = None
+_lock = threading.Lock()
+_local = threading.local()
+_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+
+#helper functions:
+
+
+def make_key(payload):
+    """Hash a full request payload (model, sampling settings, messages) into a cache key."""
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _connection():
+    """One SQLite connection per thread."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(CACHE_DB, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)"
+        )
+        with connection:
+            connection.execute("INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0)")
+        _local.connection = connection
+    return connection
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def _sync_generation(connection):
+    """Empty the memory tier if the cache was cleared, by any process, since it was filled."""
+    global _generation
+    generation = connection.execute("SELECT value FROM generation").fetchone()[0]
+    with _lock:
+        if generation != _generation:
+            _memory.clear()
+            _generation = generation
+
+
+def _remember(key, created, response):
+    with _lock:
+        _memory[key] = (created, response)
+        _memory.move_to_end(key)
+        while len(_memory) > LLM_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+
+
+#cache access
+
+
+def get(key):
+    """Return the cached response for a key, or None on a miss or an expired entry."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    now = time.time()
+    connection = _connection()
+    _sync_generation(connection)
+
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if now - entry[0] <= LLM_CACHE_TTL:
+                _memory.move_to_end(key)
+                _counters["memory_hits"] += 1
+                return entry[1]
+            del _memory[key]
+
+    row = connection.execute(
+        "SELECT response, created FROM responses WHERE key = ? AND created >= ?",
+        (key, now - LLM_CACHE_TTL),
+    ).fetchone()
+    if row is None:
+        _count("misses")
+        return None
+
+    with connection:
+        connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+    _remember(key, row[1], row[0])
+    _count("disk_hits")
+    return row[0]
+
+
+def put(key, response):
+    """Store a response in both tiers."""
+    if not LLM_CACHE_ENABLED or response is None:
+        return
+    now = time.time()
+    connection = _connection()
+    _sync_generation(connection)
+    _remember(key, now, response)
+
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+    with _lock:
+        _counters["writes"] += 1
+        trim = _counters["writes"] % TRIM_INTERVAL == 0
+    if trim:
+        _trim(connection, now)
+
+
+def _trim(connection, now):
+    """Drop expired entries and the least recently used ones beyond LLM_CACHE_DISK_ENTRIES."""
+    with connection:
+        connection.execute("DELETE FROM responses WHERE created < ?", (now - LLM_CACHE_TTL,))
+        connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (LLM_CACHE_DISK_ENTRIES,),
+        )
+
+
+def clear():
+    """Invalidate every cached response, on disk and in the memory tier of every process."""
+    connection = _connection()
+    with connection:
+        connection.execute("DELETE FROM responses")
+        connection.execute("UPDATE generation SET value = value + 1")
+    _sync_generation(connection)
+
+
+def stats():
+    """Hit/miss counters for this process plus the current size of each tier."""
+    with _lock:
+        result = dict(_counters, memory_entries=len(_memory))
+    result["disk_entries"] = _connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    lookups = result["memory_hits"] + result["disk_hits"] + result["misses"]
+    result["hit_rate"] = (result["memory_hits"] + result["disk_hits"]) / lookups if lookups else 0.0
+    return result
+
+
+def _collect_metrics():
+    with _lock:
+        counters = dict(_counters, memory_entries=len(_memory))
+    return [
+        ("pdf_llm_cache_memory_hits_total", "counter", "LLM cache hits served from memory", counters["memory_hits"]),
+        ("pdf_llm_cache_disk_hits_total", "counter", "LLM cache hits served from SQLite", counters["disk_hits"]),
+        ("pdf_llm_cache_misses_total", "counter", "LLM cache lookups that missed", counters["misses"]),
+        ("pdf_llm_cache_memory_entries", "gauge", "Responses held in the in-memory tier", counters["memory_entries"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from config import (API_KEY, OPENAI_BASE_URL, LLM_POOL_CONNECTIONS, LLM_KEEPALIVE_CONNECTIONS, LLM_KEEPALIVE_EXPIRY,
+                    LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT, LLM_POOL_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+# httpx and openai are imported on first use: together they are most of the app's import time
+
+# One shared OpenAI client per process and one AsyncOpenAI client per event loop, created on first use
+# or by the warm-up at startup
+_client = None
+_client_lock = threading.Lock()
+_async_client = None
+
+
+#helper functions:
+
+
+def http_limits():
+    import httpx
+    return httpx.Limits(max_connections=LLM_POOL_CONNECTIONS, max_keepalive_connections=LLM_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+
+
+def http_timeout():
+    import httpx
+    return httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT, pool=LLM_POOL_TIMEOUT)
+
+
+def make_client():
+    """Synchronous OpenAI client on a pooled keep-alive connection pool (retries are handled by the caller)."""
+    import httpx
+    from openai import OpenAI
+    return OpenAI(
+        api_key=f"{API_KEY}",
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
+        http_client=httpx.Client(limits=http_limits(), timeout=http_timeout()),
+    )
+
+
+def make_async_client():
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=f"{API_KEY}",
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=http_limits(), timeout=http_timeout()),
+    )
+
+
+
+
+#client lifecycle
+
+
+def get_client():
+    """The process's shared synchronous OpenAI client."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = make_client()
+    return _client
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+def get_async_client():
+    """The shared AsyncOpenAI client; must be called from the event loop that will use it."""
+    global _async_client
+    if _async_client is None:
+        _async_client = make_async_client()
+    return _async_client
+
+
+async def start():
+    """Open the shared async client when the server starts, before the first request."""
+    get_async_client()
+    logger.info("LLM client pool ready (%d connections, %d kept alive for %.0fs)",
+                LLM_POOL_CONNECTIONS, LLM_KEEPALIVE_CONNECTIONS, LLM_KEEPALIVE_EXPIRY)
+
+
+async def close():
+    """Close the shared async client and its connections once in-flight requests have finished."""
+    global _async_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.close()
@@ -0,0 +1,146 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Metrics are kept per process and rendered in the Prometheus text format by GET /metrics.
+# With several worker processes, each one is scraped (or summed) separately.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_collectors = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        lines = []
+        for key, (bucket_counts, count, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        return lines
+
+
+def register_collector(collect):
+    """Add a function called at render time that returns [(name, kind, documentation, value)]."""
+    _collectors.append(collect)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    for collect in _collectors:
+        for name, kind, documentation, value in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the pipeline
+STAGE_SECONDS = Histogram(
+    "pdf_stage_seconds", "Time spent in each pipeline stage (extract, tokenize, index, chunk, retrieve, "
+    "llm_call, organize)", ["stage"])
+DOCUMENT_PAGES = Histogram(
+    "pdf_document_pages", "Pages of newly extracted documents", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+SUMMARY_CHUNKS = Histogram(
+    "pdf_summary_chunks", "Chunks sent to the LLM per generated summary", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+TEXT_FILTER_TOKENS = Counter("pdf_text_filter_removed_tokens_total",
+                             "Tokens the text filter removed from newly tokenized documents")
+SUMMARIES = Counter("pdf_summaries_total", "Summary requests by where the summary came from", ["source"])
+SINGLE_FLIGHTS = Counter("pdf_single_flights_total", "Summaries and answers computed for requests, by operation",
+                         ["operation"])
+COALESCED_REQUESTS = Counter("pdf_coalesced_requests_total",
+                             "Requests that joined an identical summary or answer already in progress, by operation",
+                             ["operation"])
+
+LLM_REQUESTS = Counter("pdf_llm_requests_total", "LLM API calls by call type and outcome", ["call", "outcome"])
+LLM_RETRIES = Counter("pdf_llm_retries_total", "LLM API calls retried, by error", ["error"])
+LLM_TOKENS = Counter("pdf_llm_tokens_total", "Tokens reported in the LLM usage field", ["type"])
+LLM_COST = Counter("pdf_llm_cost_dollars_total", "Estimated LLM spend from reported token usage")
+LLM_RATE_LIMIT_WAIT = Histogram("pdf_llm_rate_limit_wait_seconds",
+                                "Time LLM calls waited for the client-side rate limiter, by priority", ["priority"])
+LLM_RATE_LIMIT_PAUSES = Counter("pdf_llm_rate_limit_pauses_total", "429 responses whose Retry-After paused every LLM call")
+
+HTTP_REQUESTS = Counter("pdf_http_requests_total", "HTTP requests by endpoint, method and status",
+                        ["endpoint", "method", "status"])
+HTTP_SECONDS = Histogram("pdf_http_request_seconds", "HTTP request latency until the response is returned "
+                         "(streams are timed until their headers are sent)", ["endpoint"])
@@ -0,0 +1,126 @@
+import re
+
+
+# Outline lines produced by the extraction prompts
+H2_PREFIX = "## "
+H3_PREFIX = "### "
+BULLET_PREFIXES = ("- ", "* ")
+
+SUBSECTION_LABELS = "abcdefghijklmnopqrstuvwxyz"
+EMPTY_OUTLINE = "No content was extracted from the document."
+
+TRAILING_PUNCTUATION = re.compile(r"[\s.:;,]+$")
+
+
+class Section:
+    __slots__ = ("heading", "points", "subsections")
+
+    def __init__(self, heading):
+        self.heading = heading
+        self.points = {}  # key -> bullet line, an insertion-ordered set
+        self.subsections = {}  # key -> Section
+
+
+class OutlineBuilder:
+    """Merge outline segments into one outline, one segment at a time.
+
+    Headings and bullets are deduplicated through dict keys, so every line costs O(1). With
+    near_duplicates=True, lines that differ only in case, whitespace, bullet marker or trailing
+    punctuation are merged as well, keeping the first spelling.
+    """
+
+    def __init__(self, near_duplicates=False):
+        self.near_duplicates = near_duplicates
+        self.sections = {}
+        self.segments = 0
+        self._section = None
+        self._subsection = None
+
+    def _key(self, text):
+        if not self.near_duplicates:
+            return text
+        return TRAILING_PUNCTUATION.sub("", " ".join(text.casefold().split()))
+
+    def add(self, outline):
+        """Merge one outline segment; content before its first "## " heading joins no section."""
+        self.segments += 1
+        for line in outline.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith(H2_PREFIX):
+                heading = line[len(H2_PREFIX):].strip()
+                key = self._key(heading)
+                self._section = self.sections.get(key)
+                if self._section is None:
+                    self._section = self.sections[key] = Section(heading)
+                self._subsection = None
+
+            elif line.startswith(H3_PREFIX):
+                if self._section is not None:
+                    heading = line[len(H3_PREFIX):].strip()
+                    key = self._key(heading)
+                    self._subsection = self._section.subsections.get(key)
+                    if self._subsection is None:
+                        self._subsection = self._section.subsections[key] = Section(heading)
+
+            elif line.startswith(BULLET_PREFIXES):
+                target = self._subsection or self._section
+                if target is not None:
+                    key = self._key(line[2:] if self.near_duplicates else line)
+                    target.points.setdefault(key, line)
+        return self
+
+    def extend(self, outlines):
+        for outline in outlines:
+            self.add(outline)
+        return self
+
+    def _subsections_with_points(self, section):
+        """(label, subsection) pairs of the subsections that have content."""
+        subsections = [subsection for subsection in section.subsections.values() if subsection.points]
+        return [
+            (SUBSECTION_LABELS[i] if i < len(SUBSECTION_LABELS) else str(i), subsection)
+            for i, subsection in enumerate(subsections)
+        ]
+
+    def render(self, prefix="", suffix=""):
+        """The merged outline as text: numbered sections, lettered subsections, tab-indented bullets."""
+        if not self.segments:
+            return prefix + EMPTY_OUTLINE + suffix
+        if not self.sections:
+            return prefix + "#" + suffix
+
+        parts = [prefix + next(iter(self.sections.values())).heading]
+        for number, section in enumerate(self.sections.values(), 1):
+            parts.append(f"\n{number}. {section.heading}")
+            parts.extend("\t" + point for point in section.points.values())
+            for label, subsection in self._subsections_with_points(section):
+                parts.append(f"\n\t{label}. {subsection.heading}")
+                # Bold bullets are usually nested points, so they are indented one level deeper
+                parts.extend(("\t\t\t" if "**" in point else "\t\t") + point for point in subsection.points.values())
+        parts[-1] += suffix
+        return "\n".join(parts)
+
+    def to_json(self):
+        """The merged outline as nested dicts, for clients that render it themselves."""
+        return {
+            "title": next(iter(self.sections.values())).heading if self.sections else None,
+            "sections": [
+                {
+                    "number": number,
+                    "heading": section.heading,
+                    "points": [point[2:] for point in section.points.values()],
+                    "subsections": [
+                        {
+                            "label": label,
+                            "heading": subsection.heading,
+                            "points": [point[2:] for point in subsection.points.values()],
+                        }
+                        for label, subsection in self._subsections_with_points(section)
+                    ],
+                }
+                for number, section in enumerate(self.sections.values(), 1)
+            ],
+        }
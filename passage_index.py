@@ -0,0 +1,150 @@
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+
+import document_store
+import metrics
+import tokenization
+from config import PASSAGE_TOKENS
+
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+WORD_PATTERN = re.compile(r"\w+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which",
+    "who", "why", "with",
+}
+
+logger = logging.getLogger(__name__)
+
+
+#helper functions:
+
+
+def terms(text):
+    """Lowercased word terms of a text, without stopwords."""
+    return [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+
+
+def index_path(doc_hash, stream_name):
+    return os.path.join(document_store.document_folder(doc_hash), f"index-{stream_name}-{PASSAGE_TOKENS}.json")
+
+
+def split_passages(doc_hash, model):
+    """Cut every page into passages of at most PASSAGE_TOKENS tokens, remembering the page they came from.
+
+    Yields ({"page", "start", "end", "tokens"}, text) pairs. Passages are sliced from the document's
+    stored token stream, so nothing is encoded again; only their token range is kept in the index.
+    """
+    tokenizer = tokenization.get_tokenizer(model)
+    page_offsets = document_store.load_page_token_offsets(doc_hash, model)
+
+    for page_number in range(1, len(page_offsets)):
+        page_start, page_end = page_offsets[page_number - 1], page_offsets[page_number]
+        # One page of tokens at a time, so the whole stream is never held in memory
+        tokens = document_store.load_token_range(doc_hash, model, page_start, page_end)
+        for i in range(page_start, page_end, PASSAGE_TOKENS):
+            end = min(i + PASSAGE_TOKENS, page_end)
+            text = tokenizer.decode(tokens[i - page_start:end - page_start])
+            if not text.strip():
+                continue
+            yield {"page": page_number, "start": i, "end": end, "tokens": end - i}, text
+
+
+def passage_text(doc_hash, model, passage):
+    """Decode a passage, reading only its tokens from the stored token stream."""
+    tokens = document_store.load_token_range(doc_hash, model, passage["start"], passage["end"])
+    return tokenization.get_tokenizer(model).decode(tokens)
+
+
+
+
+#index building and search
+
+
+def build_index(doc_hash, model):
+    """Build the BM25 passage index of a stored document and save it next to the document.
+
+    The index holds each passage's token range and the term statistics, not the passage text.
+    """
+    started = time.perf_counter()
+
+    # postings[term] = [[passage id, term frequency], ...]
+    passages = []
+    postings = {}
+    lengths = []
+    for passage_id, (passage, text) in enumerate(split_passages(doc_hash, model)):
+        passages.append(passage)
+        passage_terms = terms(text)
+        lengths.append(len(passage_terms))
+        for term, frequency in Counter(passage_terms).items():
+            postings.setdefault(term, []).append([passage_id, frequency])
+
+    index = {
+        "passages": passages,
+        "lengths": lengths,
+        "average_length": sum(lengths) / len(lengths) if lengths else 0,
+        "postings": postings,
+    }
+    document_store._write_atomic(index_path(doc_hash, document_store.token_stream_name(model)), json.dumps(index))
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="index")
+    logger.info("Indexed %d passages for %s", len(passages), doc_hash[:12])
+    return index
+
+
+@lru_cache(maxsize=16)
+def load_index(doc_hash, model):
+    """Load a document's passage index, building it first if it does not exist yet."""
+    try:
+        with open(index_path(doc_hash, document_store.token_stream_name(model)), encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return build_index(doc_hash, model)
+
+
+def search(doc_hash, model, question, top_k, token_budget):
+    """Return the best matching passages for a question, in document order.
+
+    At most `top_k` passages are returned, and together they stay within `token_budget` tokens. Only
+    the returned passages are decoded, into their "text".
+    """
+    index = load_index(doc_hash, model)
+    passages = index["passages"]
+    if not passages:
+        return []
+
+    scores = Counter()
+    average_length = index["average_length"] or 1
+    for term in set(terms(question)):
+        postings = index["postings"].get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (len(passages) - len(postings) + 0.5) / (len(postings) + 0.5))
+        for passage_id, frequency in postings:
+            length_norm = 1 - BM25_B + BM25_B * index["lengths"][passage_id] / average_length
+            scores[passage_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+
+    # Nothing matched: fall back to the start of the document
+    ranked = [passage_id for passage_id, _ in scores.most_common()] or list(range(len(passages)))
+
+    selected = []
+    used_tokens = 0
+    for passage_id in ranked:
+        if len(selected) == top_k:
+            break
+        if used_tokens + passages[passage_id]["tokens"] > token_budget:
+            continue
+        selected.append(passage_id)
+        used_tokens += passages[passage_id]["tokens"]
+
+    return [dict(passages[passage_id], text=passage_text(doc_hash, model, passages[passage_id]))
+            for passage_id in sorted(selected)]
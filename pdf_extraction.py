@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from config import EXTRACTION_WORKERS, EXTRACTION_PAGES_PER_TASK
+
+
+# PyPDF2 is imported where pages are read, which is mostly in the worker processes.
+# It is pure Python, so pages are extracted in worker processes rather than threads
+_pool = None
+_pool_lock = threading.Lock()
+
+
+#helper functions:
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+        return _pool
+
+
+def extract_page_range(file_path, start, end):
+    """Extract pages [start, end) of a PDF, returning (text, seconds) for each page."""
+    import PyPDF2
+    pages = []
+    with open(file_path, "rb") as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page_num in range(start, end):
+            started = time.perf_counter()
+            text = pdf_reader.pages[page_num].extract_text() or ""
+            pages.append((text, time.perf_counter() - started))
+    return pages
+
+
+def page_count(file_path):
+    import PyPDF2
+    with open(file_path, "rb") as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+
+
+#extraction
+
+
+def iter_pages(file_path):
+    """Yield (text, seconds) for every page of a PDF, in page order.
+
+    Large documents are split into page ranges that run on the process pool. At most two
+    ranges per worker are in flight, so memory stays bounded however long the document is.
+    """
+    total = page_count(file_path)
+    if EXTRACTION_WORKERS <= 1 or total <= EXTRACTION_PAGES_PER_TASK:
+        yield from extract_page_range(file_path, 0, total)
+        return
+
+    pool = get_pool()
+    ranges = deque(
+        (start, min(start + EXTRACTION_PAGES_PER_TASK, total))
+        for start in range(0, total, EXTRACTION_PAGES_PER_TASK)
+    )
+    in_flight = deque()
+    while ranges or in_flight:
+        while ranges and len(in_flight) < 2 * EXTRACTION_WORKERS:
+            start, end = ranges.popleft()
+            in_flight.append(pool.submit(extract_page_range, file_path, start, end))
+        yield from in_flight.popleft().result()
+
+
+def extract_text(file_path):
+    """Extract the whole text of a PDF, pages joined without separators."""
+    return "".join(text for text, _ in iter_pages(file_path))
@@ -0,0 +1,246 @@
+import asyncio
+import contextvars
+import email.utils
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+from config import UPLOAD_FOLDER, LLM_RATE_LIMIT_RPM, LLM_RATE_LIMIT_TPM, LLM_RATE_LIMIT_BURST_SECONDS
+
+
+# Every LLM call of every process takes its budget from token buckets kept in this SQLite file
+LIMITER_FOLDER = os.path.join(UPLOAD_FOLDER, ".cache")
+LIMITER_DB = os.path.join(LIMITER_FOLDER, "rate_limits.sqlite3")
+
+# Priority classes; lower goes first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Longest sleep between scheduling rounds, which also refresh the queued call's heartbeat
+MAX_SLEEP = 1.0
+# Queued calls without a heartbeat for this long belong to a dead process and are dropped
+STALE_WAITER = 10.0
+# Users not served for this long are forgotten by the fair queue
+USER_EXPIRY = 3600.0
+
+# Priority and user of the code calling the LLM, set per request or job
+_priority = contextvars.ContextVar("llm_priority", default=BULK)
+_user = contextvars.ContextVar("llm_user", default="-")
+
+_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+#helper functions:
+
+
+def _connection():
+    """One SQLite connection per thread."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(LIMITER_FOLDER, exist_ok=True)
+        connection = sqlite3.connect(LIMITER_DB, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                level REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS waiters (
+                id TEXT PRIMARY KEY,
+                priority INTEGER NOT NULL,
+                user TEXT NOT NULL,
+                cost REAL NOT NULL,
+                enqueued REAL NOT NULL,
+                heartbeat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS users (
+                user TEXT PRIMARY KEY,
+                served REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pauses (
+                name TEXT PRIMARY KEY,
+                until REAL NOT NULL
+            );
+        """)
+        _local.connection = connection
+    return connection
+
+
+def enabled():
+    return LLM_RATE_LIMIT_RPM > 0 or LLM_RATE_LIMIT_TPM > 0
+
+
+def _limits():
+    """(bucket name, refill per second, capacity) of every enabled limit."""
+    limits = []
+    for name, per_minute in (("requests", LLM_RATE_LIMIT_RPM), ("tokens", LLM_RATE_LIMIT_TPM)):
+        if per_minute > 0:
+            rate = per_minute / 60
+            limits.append((name, rate, max(1.0, rate * LLM_RATE_LIMIT_BURST_SECONDS)))
+    return limits
+
+
+def set_caller(priority, user=None):
+    """Set the priority class (and user, for fair queuing) of the LLM calls made from this context."""
+    _priority.set(priority)
+    if user:
+        _user.set(user)
+
+
+def current_user():
+    return _user.get()
+
+
+def retry_after(error):
+    """Seconds an API error's Retry-After (or retry-after-ms) header asks to wait, or None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+
+
+#scheduling
+
+
+def _schedule(waiter_id, priority, user, cost):
+    """One scheduling round for a call: take its budget or report how long it should wait.
+
+    The call is queued on its first round. It may go once the buckets hold its cost plus the cost of
+    every call ahead of it: higher priority classes first, then users served least recently, then
+    arrival order. Calls that fit together all go at once. Returns 0 when the budget was taken.
+    """
+    connection = _connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - STALE_WAITER,))
+        connection.execute(
+            "INSERT INTO waiters (id, priority, user, cost, enqueued, heartbeat) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat",
+            (waiter_id, priority, user, cost, now, now),
+        )
+
+        # Costs of the calls ahead in line, this one included
+        costs = []
+        for row_id, row_cost in connection.execute(
+            "SELECT waiters.id, waiters.cost FROM waiters LEFT JOIN users ON users.user = waiters.user "
+            "ORDER BY waiters.priority, COALESCE(users.served, 0), waiters.enqueued, waiters.id"
+        ):
+            costs.append(row_cost)
+            if row_id == waiter_id:
+                break
+
+        paused = connection.execute("SELECT until FROM pauses WHERE name = 'retry_after'").fetchone()
+        wait = paused[0] - now if paused else 0.0
+
+        levels = {}
+        for name, rate, capacity in _limits():
+            row = connection.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            # A call bigger than the bucket waits for a full bucket instead of forever
+            need = len(costs) if name == "requests" else sum(min(capacity, row_cost) for row_cost in costs)
+            wait = max(wait, (need - level) / rate)
+            levels[name] = level
+
+        if wait > 0:
+            connection.execute("COMMIT")
+            return wait
+
+        for name, rate, capacity in _limits():
+            spent = 1 if name == "requests" else min(capacity, cost)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                (name, levels[name] - spent, now),
+            )
+        connection.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+        connection.execute("INSERT OR REPLACE INTO users (user, served) VALUES (?, ?)", (user, now))
+        connection.execute("DELETE FROM users WHERE served < ?", (now - USER_EXPIRY,))
+        connection.execute("COMMIT")
+        return 0
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def _leave(waiter_id):
+    """Drop a call from the queue when it gives up waiting."""
+    connection = _connection()
+    connection.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+
+
+def acquire(cost):
+    """Block until the rate limits allow one LLM request costing `cost` tokens."""
+    if not enabled():
+        return
+    waiter_id, priority, user = uuid.uuid4().hex, _priority.get(), _user.get()
+    started = time.perf_counter()
+    try:
+        while True:
+            wait = _schedule(waiter_id, priority, user, cost)
+            if not wait:
+                break
+            time.sleep(min(wait, MAX_SLEEP))
+    except BaseException:
+        _leave(waiter_id)
+        raise
+    _record_wait(priority, started)
+
+
+async def acquire_async(cost):
+    """acquire for the event loop: waiting holds no thread."""
+    if not enabled():
+        return
+    waiter_id, priority, user = uuid.uuid4().hex, _priority.get(), _user.get()
+    started = time.perf_counter()
+    try:
+        while True:
+            wait = await asyncio.to_thread(_schedule, waiter_id, priority, user, cost)
+            if not wait:
+                break
+            await asyncio.sleep(min(wait, MAX_SLEEP))
+    except BaseException:
+        await asyncio.to_thread(_leave, waiter_id)
+        raise
+    _record_wait(priority, started)
+
+
+def _record_wait(priority, started):
+    waited = time.perf_counter() - started
+    metrics.LLM_RATE_LIMIT_WAIT.observe(waited, priority=PRIORITY_NAMES.get(priority, priority))
+    if waited > MAX_SLEEP:
+        logger.debug("Waited %.1fs for the LLM rate limits", waited)
+
+
+def pause(seconds):
+    """Hold every process's LLM calls for `seconds`, e.g. after a 429 with a Retry-After header."""
+    if not enabled() or seconds <= 0:
+        return
+    connection = _connection()
+    connection.execute(
+        "INSERT INTO pauses (name, until) VALUES ('retry_after', ?) "
+        "ON CONFLICT (name) DO UPDATE SET until = MAX(until, excluded.until)",
+        (time.time() + seconds,),
+    )
+    metrics.LLM_RATE_LIMIT_PAUSES.inc()
@@ -2,6 +2,10 @@ let selectedPDF = null;
 let pdfCounter = 1;
 let generateBtn;
 
+// Files bigger than this are sent in resumable parts instead of a single request
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const UPLOAD_PART_RETRIES = 3;
+
 // Initialize the UI when the document is fully loaded
 document.addEventListener('DOMContentLoaded', function() {
     generateBtn = document.getElementById('generate-btn');
@@ -95,41 +99,108 @@ function generateSummary() {
     }
     
     // Show loading indicator
-    document.getElementById('loading-summary').style.display = 'flex';
-    document.getElementById('summary-content').innerHTML = '';
+    const loadingSummary = document.getElementById('loading-summary');
+    const summaryContent = document.getElementById('summary-content');
+    loadingSummary.firstChild.textContent = 'Generating Outline... ';
+    loadingSummary.style.display = 'flex';
+    summaryContent.innerHTML = '';
     
     // Switch to summary screen
     goToSummaryScreen();
-    // Request summary from server
-    fetch('/generate', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            pdf_name: selectedPDF
-        })
-    })
-    .then(response => {
-        if (!response.ok) {
-            return response.json().then(data => {
-                throw new Error(data.error || 'Network response was not ok');
-            });
+
+    // Stream the outline from the server, showing each chunk's section as it is written
+    const params = new URLSearchParams({ pdf_name: selectedPDF });
+    const source = new EventSource(`/generate_stream?${params}`);
+    const sections = [];
+
+    function sectionElement(chunk, total) {
+        // One placeholder per chunk keeps sections in document order whatever order they arrive in
+        while (sections.length < total) {
+            const section = document.createElement('pre');
+            section.className = 'summary-section';
+            summaryContent.appendChild(section);
+            sections.push(section);
+        }
+        return sections[chunk - 1];
+    }
+
+    source.addEventListener('progress', event => {
+        const data = JSON.parse(event.data);
+        sectionElement(1, data.total);
+        if (data.chunk) {
+            loadingSummary.firstChild.textContent = `Generating Outline... chunk ${data.chunk}/${data.total} `;
         }
-        return response.json();
-    })
-    .then(data => {
+    });
+
+    source.addEventListener('token', event => {
+        const data = JSON.parse(event.data);
+        sectionElement(data.chunk, Math.max(data.chunk, sections.length)).textContent += data.text;
+    });
+
+    source.addEventListener('section', event => {
+        const data = JSON.parse(event.data);
+        sectionElement(data.chunk, data.total).textContent = data.outline;
+    });
+
+    source.addEventListener('done', event => {
+        source.close();
+        const data = JSON.parse(event.data);
+        
         // Hide loading indicator
-        document.getElementById('loading-summary').style.display = 'none';
+        loadingSummary.style.display = 'none';
         
-        // Display the summary
-        document.getElementById('summary-content').innerHTML = data.summary;
-    })
-    .catch(error => {
-        console.error('Error:', error);
-        document.getElementById('loading-summary').style.display = 'none';
-        document.getElementById('summary-content').innerHTML = '<p class="error">Error generating summary. Please try again.</p>';
+        // Replace the per-chunk sections with the organized summary
+        if (data.outline && data.outline.sections.length) {
+            summaryContent.innerHTML = '';
+            summaryContent.appendChild(renderOutline(data.outline));
+        } else {
+            summaryContent.innerHTML = data.summary;
+        }
     });
+
+    source.addEventListener('error', event => {
+        source.close();
+        console.error('Error:', event.data || 'stream failed');
+        loadingSummary.style.display = 'none';
+        summaryContent.innerHTML = '<p class="error">Error generating summary. Please try again.</p>';
+    });
+}
+
+function renderOutline(outline) {
+    // Build the outline from its JSON form; text is set with textContent, never parsed as HTML
+    const container = document.createElement('div');
+    container.className = 'outline';
+
+    function addElement(parent, tag, className, text) {
+        const element = document.createElement(tag);
+        element.className = className;
+        if (text !== undefined) {
+            element.textContent = text;
+        }
+        parent.appendChild(element);
+        return element;
+    }
+
+    function addPoints(parent, points) {
+        if (!points.length) {
+            return;
+        }
+        const list = addElement(parent, 'ul', 'outline-points');
+        points.forEach(point => addElement(list, 'li', 'outline-point', point));
+    }
+
+    addElement(container, 'h3', 'outline-title', outline.title);
+    outline.sections.forEach(section => {
+        const sectionElement = addElement(container, 'section', 'outline-section');
+        addElement(sectionElement, 'h4', 'outline-heading', `${section.number}. ${section.heading}`);
+        addPoints(sectionElement, section.points);
+        section.subsections.forEach(subsection => {
+            const subsectionElement = addElement(sectionElement, 'div', 'outline-subsection');
+            addElement(subsectionElement, 'h5', 'outline-subheading', `${subsection.label}. ${subsection.heading}`);
+            addPoints(subsectionElement, subsection.points);
+        });
+    });
+    return container;
 }
 
 function goToSummaryScreen() {
@@ -176,42 +247,58 @@ function sendMessage() {
         // Auto scroll to bottom
         chatMessages.scrollTop = chatMessages.scrollHeight;
         
-        // Make API call to Flask backend
-        fetch('/ask', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                question: message,
-                pdf_name: selectedPDF
-            })
-        })
-        .then(response => {
-            if (!response.ok) {
-                return response.json().then(data => {
-                    throw new Error(data.error || 'Network response was not ok');
-                });
+        // Stream the answer from the Flask backend
+        const params = new URLSearchParams({ question: message, pdf_name: selectedPDF });
+        const source = new EventSource(`/ask_stream?${params}`);
+        let responseContent = null;
+
+        function responseElement() {
+            // Replace the typing indicator with the answer on its first piece
+            if (!responseContent) {
+                document.getElementById(loadingMsgId).remove();
+                const responseMessage = document.createElement('div');
+                responseMessage.className = 'message message-ai';
+                responseContent = document.createElement('div');
+                responseContent.className = 'message-content';
+                responseMessage.appendChild(responseContent);
+                chatMessages.appendChild(responseMessage);
             }
-            return response.json();
-        })
-        .then(data => {
-            // Remove loading message
-            document.getElementById(loadingMsgId).remove();
-            
-            // Add AI response
-            chatMessages.innerHTML += `
-                <div class="message message-ai">
-                    <div class="message-content">${data.response}</div>
-                </div>
-            `;
+            return responseContent;
+        }
+
+        source.addEventListener('token', event => {
+            const data = JSON.parse(event.data);
+            responseElement().appendChild(document.createTextNode(data.text));
             chatMessages.scrollTop = chatMessages.scrollHeight;
-        })
-        .catch(error => {
-            console.error('Error:', error);
+        });
+
+        source.addEventListener('done', event => {
+            source.close();
+            const data = JSON.parse(event.data);
+            const content = responseElement();
+            content.textContent = data.answer;
+
+            // Note which pages the answer came from
+            if (data.pages && data.pages.length) {
+                const sources = document.createElement('div');
+                sources.className = 'message-sources';
+                sources.textContent = `Pages: ${data.pages.join(', ')}`;
+                content.appendChild(sources);
+            }
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+
+        source.addEventListener('error', event => {
+            source.close();
+            console.error('Error:', event.data || 'stream failed');
             
-            // Remove loading message
-            document.getElementById(loadingMsgId).remove();
+            // Remove loading message or partial answer
+            const loadingMsg = document.getElementById(loadingMsgId);
+            if (loadingMsg) {
+                loadingMsg.remove();
+            } else if (responseContent) {
+                responseContent.parentElement.remove();
+            }
             
             // Add error message
             chatMessages.innerHTML += `
@@ -258,19 +345,25 @@ function handleFileUpload(e) {
           `;
           pdfGallery.prepend(loadingCard);
           
-          // Upload file to server
-          fetch('/upload_pdf', {
-              method: 'POST',
-              body: formData
-          })
-          .then(response => {
-              if (!response.ok) {
-                  throw new Error(`Server error: ${response.status} ${response.statusText}`);
-              }
-              return response.json();
-          })
-          .then(data => {
+          // Upload file to server; large files go up in resumable parts
+          const upload = file.size > CHUNKED_UPLOAD_THRESHOLD
+              ? uploadInParts(file)
+              : fetch('/upload_pdf', {
+                  method: 'POST',
+                  body: formData
+              })
+              .then(response => {
+                  if (!response.ok) {
+                      throw new Error(`Server error: ${response.status} ${response.statusText}`);
+                  }
+                  return response.json();
+              });
+
+          upload.then(data => {
               console.log('Upload successful:', data);
+
+              // The server may rename the file to keep it apart from a different PDF with the same name
+              const storedName = data.filename || fileName;
               
               // Remove loading card
               loadingCard.remove();
@@ -300,7 +393,7 @@ function handleFileUpload(e) {
               const infoDiv = document.createElement('div');
               infoDiv.className = 'pdf-info';
               infoDiv.innerHTML = `
-                  <h3 class="pdf-title">${fileName}</h3>
+                  <h3 class="pdf-title">${storedName}</h3>
                   <p class="pdf-details">Uploaded just now</p>
               `;
               
@@ -320,7 +413,7 @@ function handleFileUpload(e) {
               
               // Add click event to select this PDF
               newCard.onclick = function() {
-                  selectPDF(this, fileName);
+                  selectPDF(this, storedName);
               };
               
               // Add to gallery
@@ -330,7 +423,7 @@ function handleFileUpload(e) {
               checkEmptyGallery();
               
               // Auto-select the new PDF
-              selectPDF(newCard, fileName);
+              selectPDF(newCard, storedName);
           })
           .catch(error => {
               console.error('Detailed error:', error);
@@ -346,6 +439,50 @@ function handleFileUpload(e) {
   }
 }
 
+// Upload a large file in parts, resuming from the server's offset after a failed part
+async function uploadInParts(file) {
+  const readJson = async response => {
+      const data = await response.json();
+      if (!response.ok && response.status !== 409) {
+          throw new Error(data.error || `Server error: ${response.status}`);
+      }
+      return data;
+  };
+
+  const upload = await readJson(await fetch('/uploads', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size })
+  }));
+
+  let offset = upload.offset;
+  let failures = 0;
+  while (offset < file.size) {
+      const part = file.slice(offset, offset + upload.part_size);
+      try {
+          const data = await readJson(await fetch(`/uploads/${upload.upload_id}?offset=${offset}`, {
+              method: 'PUT',
+              body: part
+          }));
+          offset = data.offset;
+          failures = 0;
+      } catch (error) {
+          if (++failures > UPLOAD_PART_RETRIES) {
+              throw error;
+          }
+          // Ask the server how much arrived and carry on from there
+          const status = await readJson(await fetch(`/uploads/${upload.upload_id}`));
+          offset = status.offset;
+      }
+  }
+
+  const response = await fetch(`/uploads/${upload.upload_id}/complete`, { method: 'POST' });
+  if (!response.ok) {
+      throw new Error(`Server error: ${response.status} ${response.statusText}`);
+  }
+  return response.json();
+}
+
 // Function to generate PDF preview thumbnail
 function generatePDFThumbnail(file) {
   return new Promise((resolve, reject) => {
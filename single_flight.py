@@ -0,0 +1,281 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+import answer_cache
+import metrics
+from config import UPLOAD_FOLDER, SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_POLL_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+# One lock file and one events file per computation in progress. The process holding the lock (the
+# leader) runs the computation and appends every event it produces to the events file as a JSON line;
+# identical requests in any thread or process of this host (the followers) read the file from the start,
+# so a late follower still gets the whole stream. Both files are removed when the computation ends.
+FLIGHTS_FOLDER = os.path.join(UPLOAD_FOLDER, ".cache", "flights")
+
+
+class FlightLost(Exception):
+    """The leader stopped without finishing, e.g. its client went away or its process died."""
+
+
+#helper functions:
+
+
+def flight_key(document, operation, question=None, settings=None):
+    """Key of one computation: the document's content hash, the operation, the normalized question (if
+    any) and whatever else its result depends on. Questions differing only in case or punctuation share one."""
+    payload = [document, operation, answer_cache.normalize(question or ""), settings]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _paths(key):
+    return os.path.join(FLIGHTS_FOLDER, f"{key}.lock"), os.path.join(FLIGHTS_FOLDER, f"{key}.events")
+
+
+def _is_current(file, path):
+    """Whether `path` still names the open `file` (the leader removes both files when it is done)."""
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+class Flight:
+    """The leader's side: holds the key's lock and publishes records to the events file."""
+
+    def __init__(self, key, lock_file):
+        self.lock_path, self.events_path = _paths(key)
+        self.lock_file = lock_file
+        # Left behind by a leader that died; its followers notice the lock was freed
+        try:
+            os.unlink(self.events_path)
+        except FileNotFoundError:
+            pass
+        self.events_file = open(self.events_path, "x", encoding="utf-8")
+
+    def publish(self, record):
+        # One write per line, so followers never see records interleaved
+        self.events_file.write(json.dumps(record) + "\n")
+        self.events_file.flush()
+
+    def close(self):
+        """Remove the files, then release the lock: a request arriving later starts a new computation."""
+        for path in (self.events_path, self.lock_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.events_file.close()
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def _lead(key):
+    """A Flight for the key if no computation is in progress, or None if another leader holds it."""
+    os.makedirs(FLIGHTS_FOLDER, exist_ok=True)
+    lock_path, _ = _paths(key)
+    while True:
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        # The previous leader may have removed the file between our open and our lock
+        if _is_current(lock_file, lock_path):
+            return Flight(key, lock_file)
+        lock_file.close()
+
+
+class Follower:
+    """A follower's side: reads the records the leader publishes, as they arrive."""
+
+    def __init__(self, key, events_file):
+        self.lock_path, self.events_path = _paths(key)
+        self.events_file = events_file
+        self.partial = ""
+
+    def read(self):
+        """The complete records published since the last read."""
+        self.partial += self.events_file.read()
+        lines = self.partial.split("\n")
+        self.partial = lines.pop()
+        return [json.loads(line) for line in lines if line]
+
+    def leader_gone(self):
+        """Whether the leader released the lock or removed the events file without ending it."""
+        if not _is_current(self.events_file, self.events_path):
+            return True
+        try:
+            with open(self.lock_path) as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except FileNotFoundError:
+            return True
+        except BlockingIOError:
+            return False
+        return True
+
+    def poll(self):
+        """Records published since the last poll; raises FlightLost once the leader stopped without ending."""
+        records = self.read()
+        if not records and self.leader_gone():
+            # Whatever the leader wrote before leaving is complete now
+            records = self.read()
+            if not records or not _is_end(records[-1]):
+                raise FlightLost()
+        return records
+
+    def close(self):
+        self.events_file.close()
+
+
+def _follow(key):
+    """A Follower of the computation in progress for the key, or None if its events file is not there
+    (the leader is just starting or just finished)."""
+    _, events_path = _paths(key)
+    try:
+        return Follower(key, open(events_path, encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def _is_end(record):
+    return "end" in record or "error" in record
+
+
+def _unwrap(record):
+    """The event of a record; raises the leader's error."""
+    if "error" in record:
+        raise RuntimeError(record["error"])
+    return record.get("event")
+
+
+def _count_joined(operation):
+    metrics.COALESCED_REQUESTS.inc(operation=operation)
+    logger.info("Joined the %s already in progress", operation)
+
+
+
+
+#single flight
+
+
+def stream(operation, key, make_events):
+    """Iterate make_events() once per key at a time across the threads and processes of this host.
+
+    The first caller runs it; callers arriving while it runs get the same events, from the first one
+    on, as they are produced, and its error if it fails. Events must be JSON-serializable. If the
+    leader stops early (its client went away) a follower that has not received anything yet runs the
+    computation itself; one that has raises RuntimeError. A key of None runs make_events() alone.
+    """
+    if not SINGLE_FLIGHT_ENABLED or key is None:
+        yield from make_events()
+        return
+
+    attached = False
+    while True:
+        flight = _lead(key)
+        if flight is not None:
+            metrics.SINGLE_FLIGHTS.inc(operation=operation)
+            try:
+                for event in make_events():
+                    flight.publish({"event": event})
+                    yield event
+                flight.publish({"end": True})
+            except Exception as e:
+                flight.publish({"error": str(e)})
+                raise
+            finally:
+                flight.close()
+            return
+
+        follower = _follow(key)
+        if follower is None:
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            continue
+        if not attached:
+            _count_joined(operation)
+            attached = True
+        received = False
+        try:
+            while True:
+                for record in follower.poll():
+                    if "end" in record:
+                        return
+                    event = _unwrap(record)
+                    received = True
+                    yield event
+                time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        except FlightLost:
+            if received:
+                raise RuntimeError(f"The {operation} this request was waiting on stopped")
+        finally:
+            follower.close()
+
+
+def run(operation, key, compute):
+    """compute() once per key at a time across the threads and processes of this host; callers arriving
+    while it runs wait for it and get its result. The result must be JSON-serializable."""
+    return list(stream(operation, key, lambda: iter([compute()])))[0]
+
+
+async def stream_async(operation, key, make_events):
+    """stream for async generators: make_events() returns one, and followers poll without blocking the loop."""
+    if not SINGLE_FLIGHT_ENABLED or key is None:
+        async for event in make_events():
+            yield event
+        return
+
+    attached = False
+    while True:
+        flight = _lead(key)
+        if flight is not None:
+            metrics.SINGLE_FLIGHTS.inc(operation=operation)
+            try:
+                async for event in make_events():
+                    flight.publish({"event": event})
+                    yield event
+                flight.publish({"end": True})
+            except Exception as e:
+                flight.publish({"error": str(e)})
+                raise
+            finally:
+                flight.close()
+            return
+
+        follower = _follow(key)
+        if follower is None:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            continue
+        if not attached:
+            _count_joined(operation)
+            attached = True
+        received = False
+        try:
+            while True:
+                for record in follower.poll():
+                    if "end" in record:
+                        return
+                    event = _unwrap(record)
+                    received = True
+                    yield event
+                await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        except FlightLost:
+            if received:
+                raise RuntimeError(f"The {operation} this request was waiting on stopped")
+        finally:
+            follower.close()
+
+
+async def run_async(operation, key, compute):
+    """run for coroutines: compute() returns an awaitable."""
+    async def events():
+        yield await compute()
+
+    return [event async for event in stream_async(operation, key, events)][0]
@@ -1,23 +1,58 @@
+import asyncio
+import logging
 import os
-
-import PyPDF2
-import tiktoken
-from openai import OpenAI
-from config import API_KEY
-
-
-# Initialize OpenAI client
-client = OpenAI(
-    api_key=f"{API_KEY}"
-)
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from config import (UPLOAD_FOLDER, PASSAGE_TOKENS, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES,
+                    LLM_RETRY_BASE_DELAY, SUMMARY_MODE, REDUCE_FAN_IN, ASK_MODE, RETRIEVAL_TOP_K,
+                    RETRIEVAL_TOKEN_BUDGET, CHUNKING, CHUNK_OVERLAP_TOKENS, OUTLINE_MERGE_NEAR_DUPLICATES, TEXT_FILTER, LLM_PROMPT_PRICE_PER_1K, LLM_COMPLETION_PRICE_PER_1K)
+import answer_cache
+import chunk_reuse
+import chunking
+import document_store
+import llm_cache
+import llm_clients
+import metrics
+import outline_builder
+import passage_index
+import pdf_extraction
+import rate_limiter
+import single_flight
+import text_filter
+import tokenization
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Shared pool bounding how many LLM calls this process has in flight
+llm_pool = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+# Prompts a pipeline stage has submitted but not yet handed on. Prompts (and the chunk text in them)
+# are only built as slots free up, so a stage holds about this many chunks however long the document is
+PIPELINE_WINDOW = 2 * LLM_MAX_CONCURRENCY
 
 # Constants
 MODEL = "gpt-3.5-turbo-0125"
 TEMPERATURE = 0.2  # Lowered temperature for more factual responses
 MAX_TOKENS = 1000
+HEADINGS_MAX_TOKENS = 300
 MODEL_TOKEN_LIMIT = 16385
 SAFETY_MARGIN = 1000
 
+# Bump a version when its prompt or code changes so stored summaries built with the old one are rebuilt
+HEADINGS_PROMPT_VERSION = 2
+EXTRACTION_PROMPT_VERSION = 1
+ORGANIZE_VERSION = 2
+MERGE_PROMPT_VERSION = 1
+ANSWER_PROMPT_VERSION = 1
+
+NO_TEXT_ANSWER = "No extractable text found in the PDF."
+
 
 # System message for the OpenAI model - completely rewritten for extraction focus
 SYSTEM_MESSAGE = """
@@ -37,8 +72,7 @@ IMPORTANT RULES:
 
 def count_tokens(text):
     """Count tokens in provided text using the appropriate tokenizer."""
-    tokenizer = tiktoken.encoding_for_model(MODEL)
-    return len(tokenizer.encode(text))
+    return len(tokenization.encode(text, MODEL))
 
 
 
@@ -48,39 +82,15 @@ def read_pdf(file=None):
     """Read a PDF file and extract its text content."""
     if file is None:
         file = input("What is the book/document you want to summarize?\n\t")
-    file_path = os.path.join(os.getcwd(), "uploaded_pdfs", f"{file}")
+    file_path = os.path.join(os.getcwd(), UPLOAD_FOLDER, f"{file}")
     
     try:
-        with open(file_path, "rb") as file:
-            reader = PyPDF2.PdfReader(file)
-            total_pages = len(reader.pages)
-            text = ""
-            #choice = input(f"Do you want to read all {total_pages} pages? (y/n) \n\t").strip().lower()
-            for page in reader.pages:
-                    text += page.extract_text()
-            # 
-            # if choice == "y":
-            #     #print(f"Reading {total_pages} pages...\n")
-            #     for page in reader.pages:
-            #         text += page.extract_text()
-            # else:
-            #     start_page = int(input("What page do you want to start from? \n\t"))
-            #     end_page = int(input("What page do you want to end with? \n\t"))
-                
-            #     if 1 <= start_page <= end_page <= total_pages:
-            #         #print(f"Reading pages {start_page} to {end_page}...\n")
-            #         for page_num in range(start_page-1, end_page):
-            #             text += reader.pages[page_num].extract_text()
-            #     else:
-            #         #print(f"Invalid page range. Please specify pages between 1 and {total_pages}.")
-            #         return None
-            
-            return text
+        # Pages are extracted in parallel and joined once
+        return pdf_extraction.extract_text(file_path)
     except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        print("Please make sure the file is in the correct directory.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error("File not found: %s. Please make sure the file is in the correct directory.", file_path)
+    except Exception:
+        logger.exception("Could not read %s", file_path)
     
     return None
 
@@ -88,10 +98,14 @@ def read_pdf(file=None):
 
 
 
-def chunk_text(text, max_chunk_size):
-    """Split text into chunks of specified token size."""
-    tokenizer = tiktoken.encoding_for_model(MODEL)
-    tokens = tokenizer.encode(text)
+def chunk_text(text, max_chunk_size, tokens=None):
+    """Split text into chunks of specified token size.
+
+    Pass the already computed token stream as `tokens` to skip re-encoding the text.
+    """
+    tokenizer = tokenization.get_tokenizer(MODEL)
+    if tokens is None:
+        tokens = tokenization.encode(text, MODEL)
     
     chunks = []
     for i in range(0, len(tokens), max_chunk_size):
@@ -104,21 +118,265 @@ def chunk_text(text, max_chunk_size):
 
 
 #api call is completed here
-def process_prompt(prompt=None):
-    """Process a prompt"""
-    
+def is_retryable(error):
+    """Rate limits, timeouts, dropped connections and 5xx responses are worth retrying."""
+    import openai
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def record_usage(usage):
+    """Count the tokens an API response reports in its usage field, and what they cost."""
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    else:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    metrics.LLM_TOKENS.inc(prompt_tokens, type="prompt")
+    metrics.LLM_TOKENS.inc(completion_tokens, type="completion")
+    metrics.LLM_COST.inc(prompt_tokens / 1000 * LLM_PROMPT_PRICE_PER_1K
+                         + completion_tokens / 1000 * LLM_COMPLETION_PRICE_PER_1K)
+
+
+def retry_delay(error, attempt, call):
+    """Seconds to wait before the next attempt of a failed call; re-raises if it should not be retried."""
+    if attempt == LLM_MAX_RETRIES or not is_retryable(error):
+        metrics.LLM_REQUESTS.inc(call=call, outcome="error")
+        raise error
+    metrics.LLM_RETRIES.inc(error=error.__class__.__name__)
+    delay = LLM_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(1, 1.5)
+    server_delay = rate_limiter.retry_after(error)
+    if server_delay is not None:
+        # The API says when to come back; every process holds its calls until then
+        delay = server_delay * random.uniform(1, 1.1)
+        rate_limiter.pause(delay)
+    logger.warning("API call failed (%s), retrying in %.1fs...", error.__class__.__name__, delay)
+    return delay
+
+
+def retry_or_raise(error, attempt, call):
+    """Sleep before the next attempt of a failed call, or re-raise if it should not be retried."""
+    time.sleep(retry_delay(error, attempt, call))
+
+
+async def retry_or_raise_async(error, attempt, call):
+    """retry_or_raise for the event loop: the pause every process shares is written on a worker thread."""
+    await asyncio.sleep(await asyncio.to_thread(retry_delay, error, attempt, call))
+
+
+def request_cost(prompt, max_tokens, prompt_tokens=None):
+    """Tokens a call counts against the rate limits: its whole prompt plus max_tokens.
+
+    0 when no rate limit is set, so nothing is encoded. Pass `prompt_tokens` when the size of the
+    prompt is already known, so it is not encoded again.
+    """
+    if not rate_limiter.enabled():
+        return 0
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt or "")
+    return system_tokens() + prompt_tokens + max_tokens
+
+
+async def request_cost_async(prompt, max_tokens, prompt_tokens=None):
+    """request_cost for the event loop: a prompt that has to be encoded is encoded on a worker thread."""
+    if prompt_tokens is None and rate_limiter.enabled():
+        return await asyncio.to_thread(request_cost, prompt, max_tokens)
+    return request_cost(prompt, max_tokens, prompt_tokens)
+
+
+
+
+def build_request(prompt, max_tokens):
+    """The chat messages for a prompt and the cache key of the full request."""
     messages = [
         {"role": "system", "content": SYSTEM_MESSAGE},
         {"role": "user", "content": prompt}
     ]
-    
-    completion = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        temperature=TEMPERATURE,
-        max_tokens=MAX_TOKENS
+    cache_key = llm_cache.make_key(
+        {"model": MODEL, "temperature": TEMPERATURE, "max_tokens": max_tokens, "messages": messages}
     )
-    return completion.choices[0].message.content
+    return messages, cache_key
+
+
+def process_prompt(prompt=None, max_tokens=MAX_TOKENS, use_cache=True, prompt_tokens=None):
+    """Process a prompt, retrying with exponential backoff on transient API errors
+
+    Responses are cached by a hash of the full request; pass use_cache=False to force a fresh call.
+    `prompt_tokens`, if known, is what the call counts against the rate limits (see request_cost).
+    """
+    messages, cache_key = build_request(prompt, max_tokens)
+    if use_cache:
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    cost = request_cost(prompt, max_tokens, prompt_tokens)
+    with metrics.STAGE_SECONDS.time(stage="llm_call"):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            rate_limiter.acquire(cost)
+            try:
+                completion = llm_clients.get_client().chat.completions.create(
+                    model=MODEL,
+                    messages=messages,
+                    temperature=TEMPERATURE,
+                    max_tokens=max_tokens
+                )
+                break
+            except Exception as e:
+                retry_or_raise(e, attempt, "complete")
+
+    metrics.LLM_REQUESTS.inc(call="complete", outcome="success")
+    record_usage(completion.usage)
+    response = completion.choices[0].message.content
+    llm_cache.put(cache_key, response)
+    return response
+
+
+def map_calls(function, items):
+    """Call function(item) for every item concurrently on the shared LLM pool, yielding results in item order.
+
+    `items` may be a generator: the next item is only taken once fewer than PIPELINE_WINDOW are
+    pending, and each is released as soon as its result has been yielded.
+    """
+    call = tracing.carry(function)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(llm_pool.submit(call, item))
+            if len(pending) >= PIPELINE_WINDOW:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_prompts(prompts, max_tokens=MAX_TOKENS, use_cache=True):
+    """Process prompts concurrently on the shared LLM pool, yielding results in prompt order (see map_calls)."""
+    return map_calls(lambda prompt: process_prompt(prompt, max_tokens, use_cache), prompts)
+
+
+def process_prompts(prompts, max_tokens=MAX_TOKENS, use_cache=True):
+    """Process prompts concurrently on the shared LLM pool, returning results in prompt order."""
+    return list(map_prompts(prompts, max_tokens, use_cache))
+
+
+def stream_prompt(prompt=None, max_tokens=MAX_TOKENS, use_cache=True, prompt_tokens=None):
+    """Process a prompt with stream=True, yielding the response text piece by piece.
+
+    Retries only happen before the first piece arrives; a cached response is yielded whole.
+    """
+    messages, cache_key = build_request(prompt, max_tokens)
+    if use_cache:
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    cost = request_cost(prompt, max_tokens, prompt_tokens)
+    started = time.perf_counter()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        rate_limiter.acquire(cost)
+        try:
+            stream = llm_clients.get_client().chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens,
+                stream=True,
+                # The last event then carries the usage of the whole stream
+                extra_body={"stream_options": {"include_usage": True}}
+            )
+            break
+        except Exception as e:
+            retry_or_raise(e, attempt, "stream")
+
+    pieces = []
+    for event in stream:
+        record_usage(getattr(event, "usage", None))
+        if not event.choices:
+            continue
+        piece = event.choices[0].delta.content
+        if piece:
+            pieces.append(piece)
+            yield piece
+    metrics.LLM_REQUESTS.inc(call="stream", outcome="success")
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_call")
+    llm_cache.put(cache_key, "".join(pieces))
+
+
+async def process_prompt_async(prompt=None, max_tokens=MAX_TOKENS, use_cache=True, prompt_tokens=None):
+    """process_prompt on the shared AsyncOpenAI client: waiting on the API holds no thread."""
+    messages, cache_key = build_request(prompt, max_tokens)
+    if use_cache:
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    cost = await request_cost_async(prompt, max_tokens, prompt_tokens)
+    started = time.perf_counter()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await rate_limiter.acquire_async(cost)
+        try:
+            completion = await llm_clients.get_async_client().chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens
+            )
+            break
+        except Exception as e:
+            await retry_or_raise_async(e, attempt, "complete")
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_call")
+
+    metrics.LLM_REQUESTS.inc(call="complete", outcome="success")
+    record_usage(completion.usage)
+    response = completion.choices[0].message.content
+    await asyncio.to_thread(llm_cache.put, cache_key, response)
+    return response
+
+
+async def stream_prompt_async(prompt=None, max_tokens=MAX_TOKENS, use_cache=True, prompt_tokens=None):
+    """stream_prompt on the shared AsyncOpenAI client, as an async generator."""
+    messages, cache_key = build_request(prompt, max_tokens)
+    if use_cache:
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    cost = await request_cost_async(prompt, max_tokens, prompt_tokens)
+    started = time.perf_counter()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await rate_limiter.acquire_async(cost)
+        try:
+            stream = await llm_clients.get_async_client().chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens,
+                stream=True,
+                extra_body={"stream_options": {"include_usage": True}}
+            )
+            break
+        except Exception as e:
+            await retry_or_raise_async(e, attempt, "stream")
+
+    pieces = []
+    async for event in stream:
+        record_usage(getattr(event, "usage", None))
+        if not event.choices:
+            continue
+        piece = event.choices[0].delta.content
+        if piece:
+            pieces.append(piece)
+            yield piece
+    metrics.LLM_REQUESTS.inc(call="stream", outcome="success")
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_call")
+    await asyncio.to_thread(llm_cache.put, cache_key, "".join(pieces))
 
 
 
@@ -167,6 +425,26 @@ def generate_extraction_prompt(chunk_text, previous_headings=None):
     """
 
 
+def generate_headings_prompt(chunk_text):
+    """Create prompt for listing only the main headings of a chunk."""
+
+    return f"""
+    TASK: Carefully read the following text and list the main topics it covers.
+
+    RULES:
+    1. Output ONLY main topic headings, one per line, using ## format
+
+    2. CRITICAL: ONLY include topics that ACTUALLY EXIST in the provided text
+
+    3. Use the EXACT terminology and concepts from the text
+
+    4. CRITICAL: OMIT BIBLIOGRAPHIC LIKE CONTENT
+
+    TEXT TO ANALYZE:
+    {chunk_text}
+    """
+
+
 def generate_answers_prompt(chunk_text, question):
     """Create prompt for content extraction and answering the question."""
 
@@ -222,11 +500,68 @@ def generate_refined_answer(answer):
     """
 
 
+def generate_merge_outlines_prompt(outlines):
+    """Create prompt for merging several consecutive outlines into one."""
+
+    return f"""
+    TASK: The following outlines cover consecutive parts of one document, in order. Merge them into a single outline.
+
+    MERGING RULES:
+    1. Keep the hierarchical format:
+       - Main topics (use ## format)
+       - Subtopics (use ### format)
+       - Key points as bullet points (use - format)
+
+    2. Combine headings that cover the same topic and drop repeated points
+
+    3. CRITICAL: ONLY include information that ACTUALLY EXISTS in the outlines
+
+    4. Keep the document order and the EXACT terminology of the outlines
+
+    5. Condense where needed, keeping the main topics of every part
+
+    OUTLINES TO MERGE:
+    {outlines}
+    """
+
+
+
+
+
+
+
+
+
+
+
+# Token overheads of the fixed parts of every request, computed once on first use (or by the warm-up)
+# rather than at import, which would load the tokenizer
+@lru_cache(maxsize=None)
+def system_tokens():
+    return count_tokens(SYSTEM_MESSAGE)
+
+
+def room_for_text(template):
+    """Tokens of text that fit in a prompt built from `template` alongside the system message and answer."""
+    return MODEL_TOKEN_LIMIT - (system_tokens() + count_tokens(template) + SAFETY_MARGIN + MAX_TOKENS)
+
+
+@lru_cache(maxsize=None)
+def extraction_chunk_size():
+    return room_for_text(generate_extraction_prompt("", None))
 
 
+@lru_cache(maxsize=None)
+def refine_answer_size():
+    return room_for_text(generate_refined_answer(""))
 
 
+@lru_cache(maxsize=None)
+def merge_outlines_size():
+    return room_for_text(generate_merge_outlines_prompt(""))
 
+# Texts reduced together are joined with this separator
+REDUCE_SEPARATOR = "\n\n"
 
 
 
@@ -247,178 +582,863 @@ def extract_main_headings(outline):
 
 
 
+def build_outline(outline_segments):
+    """Merge outline segments into an OutlineBuilder, which renders both the summary text and its JSON form."""
+    with metrics.STAGE_SECONDS.time(stage="organize"):
+        return outline_builder.OutlineBuilder(OUTLINE_MERGE_NEAR_DUPLICATES).extend(outline_segments)
+
+
 def organize_sections(outlines):
     """Organize sections from multiple outline segments into a coherent structure."""
-    if not outlines:
-        return "No content was extracted from the document."
-    
-    # Extract all headings and their content
-    document_structure = {}
-    current_h2 = None
-    current_h3 = None
-    
-    for outline in outlines:
-        for line in outline.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Check for main heading (H2)
-            if line.startswith('## '):
-                current_h2 = line[3:].strip() #gather heading
-                current_h3 = None
-                if current_h2 not in document_structure:
-                    document_structure[current_h2] = {"content": [], "subsections": {}}
-            
-            # Check for subheading (H3)
-            elif line.startswith('### '):
-                if current_h2:
-                    current_h3 = line[4:].strip() 
-                    if current_h3 not in document_structure[current_h2]["subsections"]:
-                        document_structure[current_h2]["subsections"][current_h3] = []
-            
-            # Handle bullet points and other content
-            elif line.startswith('- ') or line.startswith('* '):
-                if current_h3 and current_h2:
-                    # Check for duplicates before adding
-                    if line not in document_structure[current_h2]["subsections"][current_h3]:
-                        document_structure[current_h2]["subsections"][current_h3].append(line)
-                elif current_h2:
-                    if line not in document_structure[current_h2]["content"]:
-                        document_structure[current_h2]["content"].append(line)
-    
-    # Generate final organized outline
-    organized_outline = []
-    
-    # Add title
-    
-    if current_h2:
-        first_topic = list(document_structure.keys())[0]
-        title_subject = first_topic
-        
-        organized_outline.append(f"{title_subject}")
-    else:
-        organized_outline.append(f"#")
-    
-    # Add content organized by sections
-    header_count=1
-    alphabet= ["a","b","c","d","e","f","g","h","i","j","k","l","m","n","o","p","q","r","s","t","u","v","w","x","y","z"]
-    sub_header_count=0
-    next_is_tabbed= False
-    for h2, section in document_structure.items():
-        organized_outline.append(f"\n{header_count}. {h2}")
-        
-        # Add direct content under h2
-        for item in section["content"]:
-            organized_outline.append("\t"+item)
-        
-        # Add all h3 subsections
-        for h3, content in section["subsections"].items():
-            if content:  # Only add subsections that have content
-                if sub_header_count<26:
-                    organized_outline.append(f"\n\t{alphabet[sub_header_count]}. {h3}")
-                else:
-                    organized_outline.append(f"\n\t{sub_header_count}. {h3}")
-                for item in content:
-                    if "**" in item:
-                        next_is_tabbed=True
-                    if next_is_tabbed:
-                        organized_outline.append("\t\t\t"+ item)
-                        next_is_tabbed=False
-                    else: 
-                        organized_outline.append("\t\t"+ item)
+    return build_outline(outlines).render()
 
-                sub_header_count+=1
-        sub_header_count=0
-        header_count+=1
-    
-    return "\n".join(organized_outline)
 
 
 
 
+def load_document(file):
+    """Return the store metadata for an uploaded PDF, extracting it into the store if it is not there yet."""
+    meta = document_store.get_document(file)
+    if meta is None:
+        file_path = os.path.join(os.getcwd(), UPLOAD_FOLDER, f"{file}")
+        if not os.path.exists(file_path):
+            logger.error("File not found: %s", file_path)
+            return None
+        meta = document_store.add_document(file_path, file)
+    return meta
 
-def file_handler(file):
-    # Read PDF if text not provided
-    text = read_pdf(file)
-    if not text:
-        return
-    
-     # Calculate available tokens for chunks
-    base_tokens = count_tokens(SYSTEM_MESSAGE) + count_tokens(generate_extraction_prompt("", None)) + SAFETY_MARGIN + MAX_TOKENS
-    chunk_size = MODEL_TOKEN_LIMIT - base_tokens
-    
-    # Chunk the text
-    chunks = chunk_text(text, chunk_size)
-    print(f"Processing document in {len(chunks)} chunks...")
+
+@lru_cache(maxsize=8)
+def document_chunks(doc_hash, chunk_size, structured):
+    """Planned chunks of a stored document ({"start", "end", "tokens", "pages"}), planned once per process.
+
+    Only the plan is cached; decoded_chunks decodes the text of each chunk when it is used.
+    """
+    with metrics.STAGE_SECONDS.time(stage="chunk"):
+        return tuple(chunking.plan_document(doc_hash, MODEL, chunk_size, CHUNK_OVERLAP_TOKENS, structured))
+
+
+def planned_chunks(meta):
+    """Planned chunks of a stored document, or None if it has no text."""
+    if not meta or not meta["char_count"]:
+        return None
+    # The chunk size leaves room for the precomputed prompt overhead
+    chunks = list(document_chunks(meta["hash"], extraction_chunk_size(), CHUNKING == "structure"))
+    logger.info("Processing document in %d chunks...", len(chunks))
     return chunks
 
 
+def file_chunks(file):
+    """Planned chunks of an uploaded PDF ({"start", "end", "tokens", "pages"}), or None if it has no text."""
+    # Tokens come from the document store, so the PDF is only parsed once
+    return planned_chunks(load_document(file))
 
 
+def decoded_chunks(doc_hash, chunks):
+    """Planned chunks with their "text", each decoded from the stored tokens only when it is reached."""
+    return chunking.iter_chunks(doc_hash, MODEL, chunks)
+
+
+def heading_windows(doc_hash):
+    """Chunks the headings pass reads: cut every extraction_chunk_size() tokens whatever CHUNKING is,
+    so that the pass can also run on pages while they are being extracted (see summarize_pdf)."""
+    return decoded_chunks(doc_hash, document_chunks(doc_hash, extraction_chunk_size(), False))
+
+
+def file_handler(file):
+    chunks = file_chunks(file)
+    return chunks and [chunk["text"] for chunk in decoded_chunks(load_document(file)["hash"], chunks)]
+
+
+@lru_cache(maxsize=64)
+def template_tokens(template):
+    return count_tokens(template)
+
+
+def chunk_prompt_tokens(make_prompt, chunk):
+    """Tokens of make_prompt(chunk["text"]), from the chunk's known token count and the prompt template's,
+    or None when no rate limit is set (see request_cost)."""
+    if not rate_limiter.enabled():
+        return None
+    return template_tokens(make_prompt("")) + chunk["tokens"]
+
 
 
-def get_summary(file=None):
-    
-    """Main function to generate an outline from text."""
-   
 
-    chunks=file_handler(file)
 
-    # Process each chunk with context from previous chunks
+
+def reuse_scope(kind, max_tokens):
+    """What a chunk's headings or extraction result depends on besides the chunk itself (see chunk_reuse).
+
+    The headings of the rest of the document that extraction prompts carry as context are left out, so
+    the chunks a revision shares with an earlier upload reuse its outlines although its headings changed.
+    """
+    prompt_version = HEADINGS_PROMPT_VERSION if kind == "headings" else EXTRACTION_PROMPT_VERSION
+    return {"kind": kind, "prompt": prompt_version, "encoding": document_store.token_stream_name(MODEL),
+            "model": MODEL, "temperature": TEMPERATURE, "max_tokens": max_tokens}
+
+
+def process_chunk(scope, match, make_prompt, max_tokens=MAX_TOKENS, use_cache=True):
+    """The result for one (chunk, fingerprint, reused) match from chunk_reuse.match_chunks: the reused
+    result, or process_prompt(make_prompt(chunk["text"])), which is then stored for later documents."""
+    chunk, fingerprint, reused = match
+    if reused is not None:
+        return reused
+    result = process_prompt(make_prompt(chunk["text"]), max_tokens, use_cache, chunk_prompt_tokens(make_prompt, chunk))
+    chunk_reuse.store(scope, fingerprint, result)
+    return result
+
+
+def stream_chunk(scope, match, make_prompt, max_tokens=MAX_TOKENS, use_cache=True):
+    """process_chunk with stream=True, yielding the response text piece by piece; a reused result is yielded whole."""
+    chunk, fingerprint, reused = match
+    if reused is not None:
+        yield reused
+        return
+    pieces = []
+    for piece in stream_prompt(make_prompt(chunk["text"]), max_tokens, use_cache, chunk_prompt_tokens(make_prompt, chunk)):
+        pieces.append(piece)
+        yield piece
+    chunk_reuse.store(scope, fingerprint, "".join(pieces))
+
+
+def map_chunks(kind, chunks, make_prompt, max_tokens=MAX_TOKENS, use_cache=True):
+    """Like map_prompts(make_prompt(chunk["text"]) for chunk in chunks), but chunks an earlier document already had
+    reuse its results instead of being sent (see chunk_reuse); use_cache=False sends every chunk."""
+    scope = reuse_scope(kind, max_tokens)
+    matches = chunk_reuse.match_chunks(scope, chunks, use_cache)
+    return map_calls(lambda match: process_chunk(scope, match, make_prompt, max_tokens, use_cache), matches)
+
+
+def extract_outlines_sequential(chunks, use_cache=True):
+    """Extract chunk outlines one at a time, giving each chunk the previous chunk's headings."""
     outline_segments = []
     previous_headings = None
+    scope = reuse_scope("extraction", MAX_TOKENS)
     
-    for i, chunk in enumerate(chunks, 1):
-        print(f"Processing chunk {i}/{len(chunks)}...")
-        outline = process_prompt(generate_extraction_prompt(chunk, previous_headings))
+    for i, match in enumerate(chunk_reuse.match_chunks(scope, chunks, use_cache), 1):
+        logger.debug("Processing chunk %d...", i)
+        make_prompt = partial(generate_extraction_prompt, previous_headings=previous_headings)
+        outline = process_chunk(scope, match, make_prompt, use_cache=use_cache)
         
         if outline:
             outline_segments.append(outline)
             # Extract headings for context in next chunk
             previous_headings = extract_main_headings(outline)
+    return outline_segments
+
+
+def harvest_headings(chunks, use_cache=True):
+    """Ask every chunk for its main headings and return them deduplicated, in document order.
+
+    `chunks` ({"text", "tokens", ...} dicts) may be a generator; each is asked as soon as it arrives.
+    """
+    logger.info("Harvesting headings...")
+    heading_lists = map_chunks("headings", chunks, generate_headings_prompt, HEADINGS_MAX_TOKENS, use_cache)
+
+    # Keep the first occurrence of every heading, in document order
+    headings = {}
+    for heading_list in heading_lists:
+        for heading in extract_main_headings(heading_list or "").split('\n'):
+            if heading:
+                headings.setdefault(heading, None)
+    return '\n'.join(headings) or None
+
+
+def extract_outlines_parallel(chunks, document_headings, use_cache=True):
+    """Extract chunk outlines concurrently.
+
+    Every extraction prompt gets the main headings of the whole document (from a first, cheap
+    harvest_headings pass) as context, instead of waiting on the chunk before it. Chunks an earlier
+    document already had reuse its outlines (see map_chunks), so a revision only sends what changed.
+    """
+    logger.info("Processing chunks in parallel...")
+    make_prompt = partial(generate_extraction_prompt, previous_headings=document_headings)
+    return [outline for outline in map_chunks("extraction", chunks, make_prompt, use_cache=use_cache) if outline]
+
+
+def group_for_reduce(sizes, input_size):
+    """Pack consecutive texts into groups of at most REDUCE_FAN_IN texts and `input_size` tokens.
+
+    Returns lists of indexes; a text too big to share a prompt gets a group of its own.
+    """
+    groups = []
+    group, group_size = [], 0
+    for i, size in enumerate(sizes):
+        if group and (len(group) == REDUCE_FAN_IN or group_size + size > input_size):
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(i)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+def tree_reduce(texts, make_prompt, input_size, use_cache=True):
+    """Condense texts level by level until together they fit one prompt of `input_size` tokens.
+
+    Every level merges groups of up to REDUCE_FAN_IN neighbouring texts with one LLM call per
+    group, all groups of a level at once, so the number of sequential rounds grows with the
+    logarithm of the document length. Nothing is truncated. Returns the remaining texts in order.
+    """
+    texts = [text for text in texts if text]
+    sizes = [count_tokens(text + REDUCE_SEPARATOR) for text in texts]
+    level = 0
+    while len(texts) > 1 and sum(sizes) > input_size:
+        groups = group_for_reduce(sizes, input_size)
+        merged = [group for group in groups if len(group) > 1]
+        if not merged:
+            break
+        level += 1
+        logger.info("Reduce level %d: merging %d texts into %d", level, len(texts), len(groups))
+        results = iter(process_prompts(
+            [make_prompt(REDUCE_SEPARATOR.join(texts[i] for i in group)) for group in merged], use_cache=use_cache))
+        texts = [next(results) if len(group) > 1 else texts[group[0]] for group in groups]
+        texts = [text for text in texts if text]
+        sizes = [count_tokens(text + REDUCE_SEPARATOR) for text in texts]
+    return texts
+
+
+def reduce_outlines(outline_segments, use_cache=True):
+    """Condense chunk outlines into one outline with a tree of merge calls."""
+    outlines = tree_reduce(outline_segments, generate_merge_outlines_prompt, merge_outlines_size(), use_cache)
+    if len(outlines) <= 1:
+        return outlines
+    return [process_prompt(generate_merge_outlines_prompt(REDUCE_SEPARATOR.join(outlines)), use_cache=use_cache)]
+
+
+def format_summary(outline):
+    """Render an organized outline (an OutlineBuilder) for display, in a single pass."""
+    return outline.render(prefix="<pre>", suffix="</pre>")
+
+
+def organize_summary(outline_segments, use_cache=True):
+    """Build the final summary and its JSON outline from chunk outlines.
+
+    "tree" mode condenses the chunk outlines with the LLM first.
+    """
+    if SUMMARY_MODE == "tree":
+        outline_segments = reduce_outlines(outline_segments, use_cache)
+    outline = build_outline(outline_segments)
+    return format_summary(outline), outline.to_json()
+
+
+def summary_keys(meta):
+    """What the stored outline segments and the organized summary of a document depend on.
+
+    Segments depend on the chunking, the model and the prompts; the organized summary depends on
+    the segments plus the organize step, so changing only that step reuses the stored segments.
+    """
+    segments_key = {
+        "document": meta["hash"],
+        "encoding": document_store.token_stream_name(MODEL),
+        "chunk_size": extraction_chunk_size(),
+        "chunking": CHUNKING,
+        "chunk_overlap": CHUNK_OVERLAP_TOKENS,
+        "mode": SUMMARY_MODE,
+        "model": MODEL,
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+        "headings_prompt": HEADINGS_PROMPT_VERSION,
+        "extraction_prompt": EXTRACTION_PROMPT_VERSION,
+    }
+    summary_key = dict(segments_key, organize=ORGANIZE_VERSION, near_duplicates=OUTLINE_MERGE_NEAR_DUPLICATES)
+    if SUMMARY_MODE == "tree":
+        summary_key.update(fan_in=REDUCE_FAN_IN, merge_prompt=MERGE_PROMPT_VERSION)
+    return segments_key, summary_key
+
+
+def store_summary(meta, outline_segments, use_cache=True):
+    """Save a document's outline segments, organized summary and JSON outline with it.
+
+    Returns the summary and the JSON outline.
+    """
+    segments_key, summary_key = summary_keys(meta)
+    document_store.save_artifact(meta["hash"], "outline-segments", segments_key, outline_segments)
+    summary, outline = organize_summary(outline_segments, use_cache)
+    document_store.save_artifact(meta["hash"], "summary", summary_key, summary)
+    document_store.save_artifact(meta["hash"], "outline", summary_key, outline)
+    return summary, outline
+
+
+def load_stored_summary(meta):
+    """Return the stored (summary, JSON outline, outline segments) of a document, rebuilding only stale stages.
+
+    The summary and outline are None when they have to be regenerated with the LLM, and so are the
+    segments.
+    """
+    segments_key, summary_key = summary_keys(meta)
+    summary = document_store.load_artifact(meta["hash"], "summary", summary_key)
+    outline = document_store.load_artifact(meta["hash"], "outline", summary_key)
+    outline_segments = document_store.load_artifact(meta["hash"], "outline-segments", segments_key)
+    if (summary is None or outline is None) and outline_segments is not None:
+        # Only the organize step (or, in "tree" mode, the merge settings) changed
+        summary, outline = organize_summary(outline_segments)
+        document_store.save_artifact(meta["hash"], "summary", summary_key, summary)
+        document_store.save_artifact(meta["hash"], "outline", summary_key, outline)
+    elif outline is None:
+        summary = None
+    return summary, outline, outline_segments
+
+
+def get_summary(file=None, use_cache=True):
+    
+    """Main function to generate an outline from text.
+
+    The result is stored with the document, so later calls are served without any LLM call;
+    use_cache=False regenerates it. Requests for a summary that is being generated, in any worker
+    process, wait for it instead of generating another (see single_flight).
+    """
+   
+    meta = load_document(file)
+    return single_flight.run("summary", summary_flight_key("summary", meta, use_cache),
+                             lambda: summarize_document(meta, file, use_cache))
+
+
+def summary_flight_key(operation, meta, use_cache):
+    """single_flight key of a document's summary: the same document, summary settings and use_cache."""
+    return meta and single_flight.flight_key(meta["hash"], operation, settings=[summary_keys(meta)[1], use_cache])
+
+
+def summarize_document(meta, file, use_cache=True):
+    """The stored summary of a document, or a new one generated with the LLM."""
+    if meta and use_cache:
+        summary, _, _ = load_stored_summary(meta)
+        if summary is not None:
+            logger.info("Serving stored summary for %s", file)
+            metrics.SUMMARIES.inc(source="stored")
+            return summary
+    return generate_summary(meta, use_cache)
+
+
+def generate_summary(meta, use_cache=True, document_headings=None):
+    """Summarize a stored document with the LLM and store the summary.
+
+    Chunks are decoded one at a time as the LLM pool takes them. Pass the `document_headings` if they
+    were already harvested (see summarize_pdf); "" means the document has none.
+    """
+    chunks = planned_chunks(meta)
+    metrics.SUMMARIES.inc(source="generated")
+    if not chunks:
+        # No extractable text: the empty outline, without any LLM call
+        summary, _ = store_summary(meta, [], use_cache)
+        return summary
+    metrics.SUMMARY_CHUNKS.observe(len(chunks))
+    decoded = decoded_chunks(meta["hash"], chunks)
+
+    # Process chunks, either concurrently or each with context from the previous one
+    if SUMMARY_MODE == "sequential" or len(chunks) == 1:
+        outline_segments = extract_outlines_sequential(decoded, use_cache)
+    else:
+        if document_headings is None:
+            document_headings = harvest_headings(heading_windows(meta["hash"]), use_cache)
+        outline_segments = extract_outlines_parallel(decoded, document_headings, use_cache)
     
     # Organize outline segments
     #print("Organizing content...")
-    organized_outline = organize_sections(outline_segments)
-    
-    
-    # print("\n" + "="*50 + "\n")
-    # print(organized_outline)
-    formatted_output = organized_outline.replace("\n", "<br>")
-    formatted_output = organized_outline.replace("\t", "&nbsp;&nbsp;&nbsp;&nbsp;")
+    summary, _ = store_summary(meta, outline_segments, use_cache)
+    return summary
+
+
+def iter_extracted_pages(file_path, filename, result):
+    """Add a PDF to the document store on a background thread, yielding its pages as they are extracted.
 
-    formatted_output = f"<pre>{organized_outline}</pre>"
-    return formatted_output
+    At most PIPELINE_WINDOW pages wait to be read, so extraction stays only a little ahead. Nothing
+    is yielded if the content is already stored. Once the generator is exhausted, result["meta"]
+    holds what document_store.add_document returned; closing it early abandons the extraction.
+    """
+    pages = queue.Queue(maxsize=PIPELINE_WINDOW)
+    stopped = threading.Event()
+    finished = object()
+
+    def deliver(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("Extraction abandoned")
+
+    def run():
+        try:
+            result["meta"] = document_store.add_document(file_path, filename, on_page=deliver)
+        finally:
+            try:
+                deliver(finished)
+            except RuntimeError:
+                pass
+
+    thread = threading.Thread(target=tracing.carry(run), name="extract", daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is finished:
+                break
+            yield page
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def summarize_pdf(file_path, filename, use_cache=True):
+    """Add a PDF to the document store and summarize it, starting LLM calls before extraction finishes.
+
+    Pages are cut into chunks as they arrive, and the headings pass runs on those chunks while the
+    rest is still being extracted; the extraction calls follow once the text is stored (structured
+    chunking needs the whole document). A document already stored is summarized like get_summary.
+    Returns (meta, summary); both are None if the text could not be extracted.
+    """
+    extracted = {}
+    pages = iter_extracted_pages(file_path, filename, extracted)
+    if SUMMARY_MODE == "sequential":
+        # Each extraction call waits on the previous chunk's outline, so there is nothing to start early
+        for _ in pages:
+            pass
+        document_headings = None
+    else:
+        if TEXT_FILTER:
+            # Cleaned the same way as when the stored text is tokenized, so the chunks match
+            pages = text_filter.clean_pages(pages)
+        chunks = chunking.iter_page_chunks(pages, MODEL, extraction_chunk_size(), CHUNK_OVERLAP_TOKENS)
+        document_headings = harvest_headings(chunks, use_cache) or ""
+
+    meta = extracted.get("meta")
+    if meta is None:
+        return None, None
+    if meta["duplicate"]:
+        return meta, get_summary(meta["filename"], use_cache)
+    return meta, generate_summary(meta, use_cache, document_headings)
+
+
+def get_outline(file):
+    """The stored JSON outline of a PDF ({"title", "sections": [...]}), or None before it is summarized."""
+    meta = load_document(file)
+    if meta is None:
+        return None
+    _, outline, _ = load_stored_summary(meta)
+    return outline
+
+
+def stream_outlines(chunks, make_prompt, use_cache=True):
+    """Stream the extraction of several chunks at once on the LLM pool (see stream_chunk).
+
+    Yields ("token", i, text) pieces as they arrive from any chunk and ("section", i, outline)
+    once chunk i is complete; i is 1-based. `chunks` may be a generator: at most PIPELINE_WINDOW
+    chunks are taken ahead of the sections that finished. Once the stream fails or is closed, no
+    further chunks are submitted and the ones already running stop at their next piece.
+    """
+    events = queue.Queue()
+    scope = reuse_scope("extraction", MAX_TOKENS)
+    stopped = threading.Event()
+
+    def run(i, match):
+        if stopped.is_set():
+            return
+        stream = stream_chunk(scope, match, make_prompt, use_cache=use_cache)
+        try:
+            pieces = []
+            for piece in stream:
+                if stopped.is_set():
+                    return
+                pieces.append(piece)
+                events.put(("token", i, piece))
+            events.put(("section", i, "".join(pieces)))
+        except Exception as e:
+            events.put(("error", i, e))
+        finally:
+            stream.close()
+
+    run = tracing.carry(run)
+    numbered = enumerate(chunk_reuse.match_chunks(scope, chunks, use_cache), 1)
+    in_flight = 0
+
+    def submit_next():
+        if stopped.is_set():
+            return 0
+        for i, match in numbered:
+            llm_pool.submit(run, i, match)
+            return 1
+        return 0
+
+    try:
+        while in_flight < PIPELINE_WINDOW and submit_next():
+            in_flight += 1
+        while in_flight:
+            kind, i, value = events.get()
+            if kind == "error":
+                raise value
+            if kind == "section":
+                in_flight += submit_next() - 1
+            yield kind, i, value
+    finally:
+        stopped.set()
+
+
+def iter_summary_events(file=None, use_cache=True):
+    """Generate the outline of a PDF as a stream of events.
+
+    Each event is a dict with an "event" name: "progress" (chunk i/N, covering "pages", started), "token"
+    (a piece of chunk i's outline), "section" (chunk i's complete outline) and finally
+    "done" with the organized summary and its JSON outline. A stored summary is replayed without any LLM call.
+    Streams requested while the same one is being generated, in any worker process, get its events
+    from the start instead of generating another (see single_flight).
+    """
+    meta = load_document(file)
+    return single_flight.stream("summary_stream", summary_flight_key("summary_stream", meta, use_cache),
+                                lambda: summary_events(file, use_cache))
+
+
+def summary_events(file=None, use_cache=True):
+    """The events of iter_summary_events, generated by this request."""
+    meta = load_document(file)
+    if meta and use_cache:
+        summary, outline, outline_segments = load_stored_summary(meta)
+        if summary is not None:
+            logger.info("Serving stored summary for %s", file)
+            metrics.SUMMARIES.inc(source="stored")
+            total = len(outline_segments or [])
+            for i, segment in enumerate(outline_segments or [], 1):
+                yield {"event": "section", "chunk": i, "total": total, "outline": segment}
+            yield {"event": "done", "summary": summary, "outline": outline}
+            return
+
+    chunk_infos = file_chunks(file)
+    metrics.SUMMARIES.inc(source="generated")
+    if not chunk_infos:
+        summary, outline = store_summary(meta, [], use_cache)
+        yield {"event": "done", "summary": summary, "outline": outline}
+        return
+    chunks = decoded_chunks(meta["hash"], chunk_infos)
+    total = len(chunk_infos)
+    outline_segments = [None] * total
+    metrics.SUMMARY_CHUNKS.observe(total)
+
+    if SUMMARY_MODE == "sequential" or total == 1:
+        previous_headings = None
+        scope = reuse_scope("extraction", MAX_TOKENS)
+        for i, match in enumerate(chunk_reuse.match_chunks(scope, chunks, use_cache), 1):
+            logger.debug("Processing chunk %d/%d...", i, total)
+            yield {"event": "progress", "chunk": i, "total": total, "pages": chunk_infos[i - 1]["pages"]}
+            pieces = []
+            make_prompt = partial(generate_extraction_prompt, previous_headings=previous_headings)
+            for piece in stream_chunk(scope, match, make_prompt, use_cache=use_cache):
+                pieces.append(piece)
+                yield {"event": "token", "chunk": i, "text": piece}
+            outline = "".join(pieces)
+            outline_segments[i - 1] = outline
+            yield {"event": "section", "chunk": i, "total": total, "outline": outline}
+            if outline:
+                previous_headings = extract_main_headings(outline)
+    else:
+        yield {"event": "progress", "stage": "headings", "chunk": 0, "total": total}
+        document_headings = harvest_headings(heading_windows(meta["hash"]), use_cache)
+        logger.info("Processing %d chunks in parallel...", total)
+        make_prompt = partial(generate_extraction_prompt, previous_headings=document_headings)
+        started = set()
+        for kind, i, value in stream_outlines(chunks, make_prompt, use_cache):
+            if i not in started:
+                started.add(i)
+                logger.debug("Processing chunk %d/%d...", i, total)
+                yield {"event": "progress", "chunk": i, "total": total, "pages": chunk_infos[i - 1]["pages"]}
+            if kind == "token":
+                yield {"event": "token", "chunk": i, "text": value}
+            else:
+                outline_segments[i - 1] = value
+                yield {"event": "section", "chunk": i, "total": total, "outline": value}
+
+    if SUMMARY_MODE == "tree":
+        yield {"event": "progress", "stage": "reduce", "chunk": total, "total": total}
+    summary, outline = store_summary(meta, [segment for segment in outline_segments if segment], use_cache)
+    yield {"event": "done", "summary": summary, "outline": outline}
     
     
-def get_answers(question,file):    
-    chunks=file_handler(file)
-    #put prompt call here
-    answer=""
-    for i, chunk in enumerate(chunks, 1):
-        print(f"Processing chunk {i}/{len(chunks)}...")
-        prompt= generate_answers_prompt(chunk, question)
-        chunk_answer = process_prompt(prompt)  
-        
-        if chunk_answer:
-            answer+=chunk_answer
+def build_passages_prompt(question, file):
+    """Build the answer prompt from the best matching passages.
 
-     # Calculate available tokens for prompt
-    base_tokens = count_tokens(SYSTEM_MESSAGE) + count_tokens(generate_refined_answer("")) + SAFETY_MARGIN + MAX_TOKENS
-    answer_size = MODEL_TOKEN_LIMIT - base_tokens
+    Returns the prompt and the pages it draws from, or (None, []) if the document has no text.
+    """
+    meta = load_document(file)
+    with metrics.STAGE_SECONDS.time(stage="retrieve"):
+        passages = passage_index.search(meta["hash"], MODEL, question, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET)
+    if not passages:
+        return None, []
+
+    logger.info("Answering from %d passages...", len(passages))
+    context = "\n\n".join(f"[Page {passage['page']}]\n{passage['text']}" for passage in passages)
+    pages = sorted({passage["page"] for passage in passages})
+    return generate_answers_prompt(context, question), pages
 
-    #reduces answer to fit amount of tokens for model to process
-    tokenizer = tiktoken.encoding_for_model(MODEL)
-    tokens = tokenizer.encode(answer)
-    answer= tokenizer.decode(tokens[0:answer_size])
-   
 
-    prompt= generate_refined_answer(answer)
-    refined_answer= process_prompt(prompt)
+def get_answers_from_passages(question, file, use_cache=True):
+    """Answer a question from the passages that best match it, with a single LLM call."""
+    prompt, pages = build_passages_prompt(question, file)
+    if prompt is None:
+        return {"answer": NO_TEXT_ANSWER, "pages": []}
+    answer = process_prompt(prompt, use_cache=use_cache)
+    return {"answer": answer, "pages": pages}
+
+
+def build_refine_prompt(chunk_answers, use_cache=True):
+    """Combine the per-chunk answers into one refine prompt that fits the model.
+
+    Answers that do not fit together are first condensed in a tree of refine calls, so none is dropped.
+    """
+    answers = tree_reduce(chunk_answers, generate_refined_answer, refine_answer_size(), use_cache)
+    return generate_refined_answer(REDUCE_SEPARATOR.join(answers))
+
+
+def ask_chunk(question, chunk, use_cache=True):
+    """Answer a question from one planned chunk with its "text"."""
+    make_prompt = partial(generate_answers_prompt, question=question)
+    return process_prompt(make_prompt(chunk["text"]), use_cache=use_cache,
+                          prompt_tokens=chunk_prompt_tokens(make_prompt, chunk))
+
+
+def get_answers_from_all_chunks(question, file, use_cache=True):
+    """Ask every chunk of the document, then refine the combined answers."""
+    meta = load_document(file)
+    chunks = file_chunks(file)
+    if not chunks:
+        return {"answer": NO_TEXT_ANSWER, "pages": []}
+    #chunks are independent, so they are asked concurrently as the pool takes them
+    logger.info("Processing %d chunks in parallel...", len(chunks))
+    chunk_answers = list(map_calls(lambda chunk: ask_chunk(question, chunk, use_cache),
+                                   decoded_chunks(meta["hash"], chunks)))
+
+    prompt= build_refine_prompt(chunk_answers, use_cache)
+    refined_answer= process_prompt(prompt, use_cache=use_cache)
     #print("\n"+refined_answer)
     #formatted_output = f"<pre>{refined_answer}</pre>"
-    return refined_answer
+    return {"answer": refined_answer, "pages": list(range(1, meta["page_count"] + 1))}
+
+
+def answer_scope(file):
+    """What a cached answer depends on besides the question: the document's content and the answer settings."""
+    meta = load_document(file)
+    if meta is None:
+        return None
+    return (meta["hash"], (MODEL, document_store.token_stream_name(MODEL), ASK_MODE, PASSAGE_TOKENS, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET, CHUNKING,
+                           CHUNK_OVERLAP_TOKENS, ANSWER_PROMPT_VERSION))
+
+
+def cached_answer_events(cached):
+    """The events of a streamed answer, for an answer served from the answer cache."""
+    yield {"event": "pages", "pages": cached["pages"]}
+    yield {"event": "token", "text": cached["answer"]}
+    yield dict(cached, event="done")
+
+
+def answer_flight_key(operation, question, file, use_cache):
+    """single_flight key of an answer: the same document, answer settings, normalized question and use_cache."""
+    scope = answer_scope(file)
+    return scope and single_flight.flight_key(scope[0], operation, question, [scope[1], use_cache])
+
+
+def get_answers(question,file, use_cache=True):
+    """Answer a question about a PDF.
+
+    Returns a dict with the answer text and the page numbers it was drawn from. The same or a very
+    similar question about the same document is answered from the answer cache, with "cached_question"
+    set to the question the answer was generated for. A question asked again while it is being answered,
+    in any worker process, waits for that answer (see single_flight).
+    """
+    return single_flight.run("answer", answer_flight_key("answer", question, file, use_cache),
+                             lambda: answer_question(question, file, use_cache))
+
+
+def answer_question(question, file, use_cache=True):
+    """get_answers, answered by this request."""
+    scope = answer_scope(file)
+    if use_cache and scope is not None:
+        cached = answer_cache.lookup(scope, question)
+        if cached is not None:
+            logger.info("Answering from the answer cache (cached for %r)", cached["cached_question"])
+            return cached
+
+    if ASK_MODE == "full":
+        result = get_answers_from_all_chunks(question, file, use_cache)
+    else:
+        result = get_answers_from_passages(question, file, use_cache)
+    if scope is not None:
+        answer_cache.store(scope, question, result)
+    return result
+
+
+def iter_answer_events(question, file, use_cache=True):
+    """Answer a question about a PDF as a stream of events.
+
+    Emits "progress" events while chunks are asked (full mode only), "pages" with the pages
+    the answer draws from, "token" pieces of the answer, and finally "done" with the whole answer.
+    The same question streamed while it is being answered, in any worker process, gets these events
+    from the start (see single_flight).
+    """
+    return single_flight.stream("answer_stream", answer_flight_key("answer_stream", question, file, use_cache),
+                                lambda: answer_events(question, file, use_cache))
+
+
+def answer_events(question, file, use_cache=True):
+    """The events of iter_answer_events, generated by this request."""
+    scope = answer_scope(file)
+    if use_cache and scope is not None:
+        cached = answer_cache.lookup(scope, question)
+        if cached is not None:
+            yield from cached_answer_events(cached)
+            return
+
+    if ASK_MODE == "full":
+        meta = load_document(file)
+        chunk_infos = file_chunks(file)
+        prompt, pages = None, []
+        if chunk_infos:
+            total = len(chunk_infos)
+            chunks = decoded_chunks(meta["hash"], chunk_infos)
+            chunk_answers = []
+            for i, answer in enumerate(map_calls(lambda chunk: ask_chunk(question, chunk, use_cache), chunks), 1):
+                chunk_answers.append(answer)
+                logger.debug("Processing chunk %d/%d...", i, total)
+                yield {"event": "progress", "chunk": i, "total": total, "pages": chunk_infos[i - 1]["pages"]}
+            prompt = build_refine_prompt(chunk_answers, use_cache)
+            pages = list(range(1, meta["page_count"] + 1))
+    else:
+        prompt, pages = build_passages_prompt(question, file)
+
+    yield {"event": "pages", "pages": pages}
+    if prompt is None:
+        yield {"event": "done", "answer": NO_TEXT_ANSWER, "pages": pages}
+        return
+
+    pieces = []
+    for piece in stream_prompt(prompt, use_cache=use_cache):
+        pieces.append(piece)
+        yield {"event": "token", "text": piece}
+    result = {"answer": "".join(pieces), "pages": pages}
+    if scope is not None:
+        answer_cache.store(scope, question, result)
+    yield dict(result, event="done")
+
+
+async def iter_full_answer_prompt_async(question, file, use_cache=True):
+    """Ask every chunk of the document at once, then build the refine prompt from the answers.
+
+    Yields a "progress" event as each chunk answer arrives, then {"event": "prompt", "prompt", "pages"};
+    the prompt is None if the document has no text.
+    Loading the chunks and any tree reduce of the answers run on worker threads. At most
+    PIPELINE_WINDOW chunks are decoded and waiting on the LLM at once.
+    """
+    meta = await asyncio.to_thread(load_document, file)
+    chunk_infos = await asyncio.to_thread(file_chunks, file)
+    if not chunk_infos:
+        yield {"event": "prompt", "prompt": None, "pages": []}
+        return
+    total = len(chunk_infos)
+    window = asyncio.Semaphore(PIPELINE_WINDOW)
+    make_prompt = partial(generate_answers_prompt, question=question)
+    if rate_limiter.enabled():
+        # Encodes the template once, off the event loop; every chunk's size is then known
+        await asyncio.to_thread(chunk_prompt_tokens, make_prompt, {"tokens": 0})
+
+    async def ask(i, chunk):
+        async with window:
+            text = await asyncio.to_thread(chunking.chunk_text, meta["hash"], MODEL, chunk)
+            return i, await process_prompt_async(make_prompt(text), use_cache=use_cache,
+                                                 prompt_tokens=chunk_prompt_tokens(make_prompt, chunk))
+
+    chunk_answers = [None] * total
+    for done, task in enumerate(asyncio.as_completed([ask(i, chunk) for i, chunk in enumerate(chunk_infos)]), 1):
+        i, chunk_answers[i] = await task
+        yield {"event": "progress", "chunk": done, "total": total, "pages": chunk_infos[i]["pages"]}
+
+    prompt = await asyncio.to_thread(build_refine_prompt, chunk_answers, use_cache)
+    yield {"event": "prompt", "prompt": prompt, "pages": list(range(1, meta["page_count"] + 1))}
+
+
+async def build_answer_prompt_async(question, file, use_cache=True):
+    """The final answer prompt and the pages it draws from, built without blocking the event loop."""
+    if ASK_MODE != "full":
+        return await asyncio.to_thread(build_passages_prompt, question, file)
+    async for event in iter_full_answer_prompt_async(question, file, use_cache):
+        if event["event"] == "prompt":
+            return event["prompt"], event["pages"]
+
+
+async def get_answers_async(question, file, use_cache=True):
+    """get_answers for the async server: the LLM calls wait on the network without holding a thread.
+
+    Joins the same question being answered by get_answers or get_answers_async in any worker process.
+    """
+    key = await asyncio.to_thread(answer_flight_key, "answer", question, file, use_cache)
+    # single_flight locks and reads its small local files on the event loop, between non-blocking sleeps
+    return await single_flight.run_async("answer", key, lambda: answer_question_async(question, file, use_cache))
+
+
+async def answer_question_async(question, file, use_cache=True):
+    """get_answers_async, answered by this request."""
+    scope = await asyncio.to_thread(answer_scope, file)
+    if use_cache and scope is not None:
+        # Synchronous, but only a scan of this process's in-memory cache
+        cached = answer_cache.lookup(scope, question)
+        if cached is not None:
+            return cached
+
+    prompt, pages = await build_answer_prompt_async(question, file, use_cache)
+    if prompt is None:
+        result = {"answer": NO_TEXT_ANSWER, "pages": []}
+    else:
+        result = {"answer": await process_prompt_async(prompt, use_cache=use_cache), "pages": pages}
+    if scope is not None:
+        answer_cache.store(scope, question, result)
+    return result
+
+
+async def iter_answer_events_async(question, file, use_cache=True):
+    """iter_answer_events as an async generator; progress events follow the order chunk answers arrive in.
+
+    Joins the same question being streamed by iter_answer_events or iter_answer_events_async in any
+    worker process.
+    """
+    key = await asyncio.to_thread(answer_flight_key, "answer_stream", question, file, use_cache)
+    # single_flight locks and reads its small local files on the event loop, between non-blocking sleeps
+    async for event in single_flight.stream_async("answer_stream", key,
+                                                  lambda: answer_events_async(question, file, use_cache)):
+        yield event
+
+
+async def answer_events_async(question, file, use_cache=True):
+    """The events of iter_answer_events_async, generated by this request."""
+    scope = await asyncio.to_thread(answer_scope, file)
+    if use_cache and scope is not None:
+        # Synchronous, but only a scan of this process's in-memory cache
+        cached = answer_cache.lookup(scope, question)
+        if cached is not None:
+            for event in cached_answer_events(cached):
+                yield event
+            return
+
+    if ASK_MODE == "full":
+        async for event in iter_full_answer_prompt_async(question, file, use_cache):
+            if event["event"] == "progress":
+                yield event
+            else:
+                prompt, pages = event["prompt"], event["pages"]
+    else:
+        prompt, pages = await asyncio.to_thread(build_passages_prompt, question, file)
+
+    yield {"event": "pages", "pages": pages}
+    if prompt is None:
+        yield {"event": "done", "answer": NO_TEXT_ANSWER, "pages": pages}
+        return
+
+    pieces = []
+    async for piece in stream_prompt_async(prompt, use_cache=use_cache):
+        pieces.append(piece)
+        yield {"event": "token", "text": piece}
+    result = {"answer": "".join(pieces), "pages": pages}
+    if scope is not None:
+        answer_cache.store(scope, question, result)
+    yield dict(result, event="done")
         
     
 
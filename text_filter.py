@@ -0,0 +1,111 @@
+import re
+from collections import Counter, deque
+
+
+# Bump when the cleaned text changes, so token streams, indexes and summaries built from the old one are rebuilt
+VERSION = 2
+
+# Running headers and footers: one of the first or last EDGE_LINES lines of a page that recurs, digits
+# aside, among the edge lines of at least REPEAT_MIN_PAGES pages (itself included) within REPEAT_WINDOW
+# pages of it. The window keeps the filter streaming: a page is cleaned once the pages after it are read.
+EDGE_LINES = 3
+REPEAT_WINDOW = 6
+REPEAT_MIN_PAGES = 3
+
+# A page number alone on an edge line: "12", "Page 12", "12 of 340", "- 12 -"
+PAGE_NUMBER_PATTERN = re.compile(r"(?i)(?:page\s+)?\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?|[-\u2013\u2014]\s*\d{1,4}\s*[-\u2013\u2014]")
+# A references section runs from its heading to the next heading, or to the end
+REFERENCES_PATTERN = re.compile(
+    r"(?i)(?:\d+(?:\.\d+)*\.?\s+)?(?:references|bibliography|works cited|literature cited|reference list)\s*:?")
+# A heading line: "Chapter 3 ...", "2.1 Results", or a short title-cased line. Numbered reference
+# entries ("1. Smith, J. ...") have commas or periods after the number, so they are not headings.
+HEADING_PATTERN = re.compile(
+    r"(?i:chapter|section|part|appendix)\b.{0,80}"
+    r"|\d+(?:\.\d+)*\.?\s+[A-Z][^,.;()\[\]]{0,80}"
+    r"|[A-Z][\w'-]*(?:\s+(?:[A-Z0-9][\w'-]*|of|and|the|in|for|to|on|with|a|an)){0,8}:?"
+)
+
+# A word broken across lines: "exam-\nple"
+HYPHENATION_PATTERN = re.compile(r"([a-z])-\n[ \t]*([a-z])")
+SPACE_PATTERN = re.compile(r"[ \t\f\v\u00a0\u2000-\u200a\u202f\u205f\u3000]+")
+INVISIBLE_PATTERN = re.compile(r"[\u00ad\u200b-\u200d\u2060\ufeff]")
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+DIGITS_PATTERN = re.compile(r"\d+")
+
+
+#helper functions:
+
+
+def edge_key(line):
+    """What running headers and footers of different pages have in common: the line without case or digits."""
+    return DIGITS_PATTERN.sub("#", line.casefold())
+
+
+def prepare_page(text, stats):
+    """Normalize a page's whitespace and join hyphenated words; returns its lines and their edge keys."""
+    text = INVISIBLE_PATTERN.sub("", text.replace("\r\n", "\n").replace("\r", "\n"))
+    text = SPACE_PATTERN.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    text, joined = HYPHENATION_PATTERN.subn(r"\1\2", text)
+    stats["hyphenations"] += joined
+
+    lines = text.split("\n")
+    filled = [i for i, line in enumerate(lines) if line]
+    edges = {i: edge_key(lines[i]) for i in filled[:EDGE_LINES] + filled[-EDGE_LINES:]}
+    return lines, edges
+
+
+def clean_page(lines, edges, neighbour_keys, state, stats):
+    """Drop a page's page numbers, running headers and footers and reference lines; returns its text."""
+    kept = []
+    for i, line in enumerate(lines):
+        if i in edges:
+            if PAGE_NUMBER_PATTERN.fullmatch(line):
+                stats["page_numbers"] += 1
+                continue
+            if 1 + sum(edges[i] in keys for keys in neighbour_keys) >= REPEAT_MIN_PAGES:
+                stats["repeated_lines"] += 1
+                continue
+        if state["references"]:
+            if not HEADING_PATTERN.fullmatch(line):
+                stats["reference_lines"] += bool(line)
+                continue
+            state["references"] = False
+        if REFERENCES_PATTERN.fullmatch(line):
+            state["references"] = True
+            stats["reference_lines"] += 1
+            continue
+        kept.append(line)
+    return BLANK_LINES_PATTERN.sub("\n\n", "\n".join(kept)).strip("\n")
+
+
+
+
+#filtering
+
+
+def clean_pages(pages, stats=None):
+    """Yield the text of every page with what only costs tokens removed, in page order.
+
+    Running headers and footers, page numbers and reference sections are dropped, words hyphenated
+    across lines are joined and runs of whitespace collapsed. Deterministic, and streaming: a page is
+    yielded once the REPEAT_WINDOW pages after it were read. `stats` (a Counter) is updated with the
+    lines removed for each reason and the hyphenations joined.
+    """
+    stats = Counter() if stats is None else stats
+    state = {"references": False}
+    behind = deque(maxlen=REPEAT_WINDOW)  # edge keys of the pages already yielded
+    ahead = deque()  # (lines, edges) of pages read but not yet yielded
+
+    def next_page():
+        lines, edges = ahead.popleft()
+        neighbour_keys = list(behind) + [set(page_edges.values()) for _, page_edges in ahead]
+        behind.append(set(edges.values()))
+        return clean_page(lines, edges, neighbour_keys, state, stats)
+
+    for text in pages:
+        ahead.append(prepare_page(text, stats))
+        if len(ahead) > REPEAT_WINDOW:
+            yield next_page()
+    while ahead:
+        yield next_page()
@@ -0,0 +1,49 @@
+from functools import lru_cache
+from itertools import islice
+
+
+# Pages encoded per batched call, so a stream of pages is never held whole
+ENCODE_BATCH_PAGES = 64
+
+
+#helper functions:
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model):
+    """Load a model's encoder once per process; loading the BPE ranks is the expensive part.
+
+    tiktoken itself is imported here too, so importing this module stays cheap until the first encode
+    (or the warm-up at startup).
+    """
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+def encode(text, model):
+    """Encode document text; special-token strings in a document are treated as plain text."""
+    return get_tokenizer(model).encode_ordinary(text)
+
+
+def count_page_tokens(pages, model):
+    """Length of the token stream encode_pages would return, without keeping it."""
+    return sum(len(page) for page in get_tokenizer(model).encode_ordinary_batch([page + "\n" for page in pages]))
+
+
+def encode_pages(pages, model):
+    """Encode pages in batched passes of ENCODE_BATCH_PAGES; `pages` may be a generator.
+
+    Returns the concatenated token stream of every page followed by a newline (the layout of the
+    stored document text) and the token offset where each page starts, plus the final length.
+    """
+    tokenizer = get_tokenizer(model)
+    pages = iter(pages)
+    tokens = []
+    offsets = [0]
+    while True:
+        batch = [page + "\n" for page in islice(pages, ENCODE_BATCH_PAGES)]
+        if not batch:
+            return tokens, offsets
+        for page in tokenizer.encode_ordinary_batch(batch):
+            tokens.extend(page)
+            offsets.append(len(tokens))
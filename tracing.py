@@ -0,0 +1,67 @@
+import contextvars
+import logging
+import uuid
+from functools import wraps
+
+from config import LOG_LEVEL
+
+
+# Trace ID of the request or job being handled; every log line carries it
+_trace_id = contextvars.ContextVar("trace_id", default="-")
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"
+
+# HTTP client libraries log every request; they only show warnings and errors
+QUIET_LOGGERS = ("httpx", "httpcore", "openai")
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+
+#helper functions:
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def get_trace_id():
+    return _trace_id.get()
+
+
+def set_trace_id(trace_id=None):
+    """Make `trace_id` (or a new one) the current trace ID and return it."""
+    trace_id = trace_id or new_trace_id()
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def carry(function):
+    """Wrap a function so it runs in the caller's context (trace ID, LLM priority), e.g. on a thread pool."""
+    context = contextvars.copy_context()
+
+    @wraps(function)
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so every call gets its own copy
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+def configure_logging(level=None):
+    """Send log records to stderr with their trace ID, at LOG_LEVEL unless `level` is given.
+
+    Calls below the level are dropped before their message is formatted.
+    """
+    root = logging.getLogger()
+    if not any(isinstance(f, TraceIdFilter) for handler in root.handlers for f in handler.filters):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(TraceIdFilter())
+        root.addHandler(handler)
+    root.setLevel((level or LOG_LEVEL).upper())
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
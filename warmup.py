@@ -0,0 +1,99 @@
+import importlib
+import logging
+import threading
+import time
+
+import llm_clients
+import metrics
+import summarizer_methods
+import tokenization
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds each warm-up step took, once it has run; "error" is set instead if a step failed
+_status = {"steps": {}, "error": None}
+# Set once warm-up is done; read without a lock, so /ready answers while the steps run
+_ready = threading.Event()
+# One warm-up runs the steps at a time; _lock only guards starting the background thread
+_warm_up_lock = threading.Lock()
+_lock = threading.Lock()
+_thread = None
+
+
+#helper functions:
+
+
+def load_pdf_reader():
+    # Worker processes import it again; this covers the page counts read in the request thread
+    importlib.import_module("PyPDF2")
+
+
+def compute_prompt_budgets():
+    summarizer_methods.extraction_chunk_size()
+    summarizer_methods.refine_answer_size()
+    summarizer_methods.merge_outlines_size()
+
+
+# Everything the first request would otherwise load while the user waits, in order
+STEPS = (
+    ("tokenizer", lambda: tokenization.get_tokenizer(summarizer_methods.MODEL)),
+    ("prompt_budgets", compute_prompt_budgets),
+    ("llm_client", llm_clients.get_client),
+    ("pdf_reader", load_pdf_reader),
+)
+
+
+
+
+#warm-up
+
+
+def warm_up():
+    """Load the tokenizer, LLM client and PDF reader now rather than on the first request.
+
+    Safe to call from several threads and more than once: later calls return at once, or retry the
+    steps if an earlier warm-up failed. Returns status().
+    """
+    with _warm_up_lock:
+        if _ready.is_set():
+            return status()
+        started = time.perf_counter()
+        _status["error"] = None
+        try:
+            for name, step in STEPS:
+                step_started = time.perf_counter()
+                step()
+                _status["steps"][name] = round(time.perf_counter() - step_started, 3)
+        except Exception as e:
+            logger.exception("Warm-up failed")
+            _status["error"] = str(e)
+            return status()
+        _ready.set()
+        logger.info("Warm-up done in %.2fs: %s", time.perf_counter() - started, _status["steps"])
+        return status()
+
+
+def start_background():
+    """Run warm_up in a background thread unless one is already running."""
+    global _thread
+    with _lock:
+        if _ready.is_set() or (_thread is not None and _thread.is_alive()):
+            return
+        _thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+        _thread.start()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def status():
+    return {"ready": _ready.is_set(), "steps": dict(_status["steps"]), "error": _status["error"]}
+
+
+def _collect_metrics():
+    return [("pdf_ready", "gauge", "1 once this process has finished warming up", int(_ready.is_set()))]
+
+
+metrics.register_collector(_collect_metrics)